@@ -11,8 +11,11 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import importlib.util
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -49,7 +52,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,16 +85,90 @@ WSGI_APPLICATION = 'api.wsgi.application'
 ASGI_APPLICATION = 'api.asgi.application'
 
 # Channels Configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
-        # For production, use Redis:
-        # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        # 'CONFIG': {
-        #     "hosts": [('127.0.0.1', 6379)],
-        # },
-    },
+# CHANNEL_LAYER picks the backend:
+#   memory - in-process only; groups do not reach other workers
+#   broker - core.channel_broker shared by all workers on one host
+#            (run_channel_broker)
+#   redis  - channels_redis (install it separately); use it when workers
+#            span several hosts
+CHANNEL_LAYER = os.getenv('CHANNEL_LAYER', 'memory')
+CHANNEL_LAYER_OPTIONS = {
+    'capacity': int(os.getenv('CHANNEL_CAPACITY', '100')),
+    'expiry': int(os.getenv('CHANNEL_EXPIRY', '60')),
+    'group_expiry': int(os.getenv('CHANNEL_GROUP_EXPIRY', '86400')),
 }
+CHANNEL_BROKER_URL = os.getenv('CHANNEL_BROKER_URL', 'unix:///tmp/weintegrity-channels.sock')
+# Shared secret workers present to the broker; required for a tcp:// broker
+# listening beyond loopback (which is still unencrypted: see core.channel_broker)
+CHANNEL_BROKER_SECRET = os.getenv('CHANNEL_BROKER_SECRET', '')
+if CHANNEL_LAYER == 'broker':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.layers.BrokerChannelLayer',
+            'CONFIG': {
+                'url': CHANNEL_BROKER_URL,
+                'secret': CHANNEL_BROKER_SECRET,
+                # group_send calls within this window share one broker frame
+                'batch_interval': float(os.getenv('CHANNEL_BATCH_INTERVAL_MS', '1')) / 1000,
+                **CHANNEL_LAYER_OPTIONS,
+            },
+        },
+    }
+elif CHANNEL_LAYER == 'redis':
+    if importlib.util.find_spec('channels_redis') is None:
+        raise ImproperlyConfigured('CHANNEL_LAYER=redis needs the channels_redis package: pip install channels-redis')
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')],
+                **CHANNEL_LAYER_OPTIONS,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': CHANNEL_LAYER_OPTIONS,
+        },
+    }
+
+# Background chat-notification fan-out (core.notifications)
+NOTIFICATION_DISPATCH_WORKERS = int(os.getenv('NOTIFICATION_DISPATCH_WORKERS', '2'))
+NOTIFICATION_DISPATCH_QUEUE_SIZE = int(os.getenv('NOTIFICATION_DISPATCH_QUEUE_SIZE', '10000'))
+
+# Chat history paging (messages per GET /api/<story|project>-chats/<id>/)
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', '200'))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', '500'))
+
+# WebSocket chat group commit: batch window and size for bulk message writes
+CHAT_COMMIT_INTERVAL_MS = float(os.getenv('CHAT_COMMIT_INTERVAL_MS', '5'))
+CHAT_COMMIT_MAX_BATCH = int(os.getenv('CHAT_COMMIT_MAX_BATCH', '200'))
+# Threads dedicated to WebSocket chat writes (0 = Django's shared sync thread)
+CHAT_PERSIST_WORKERS = int(os.getenv('CHAT_PERSIST_WORKERS', '4'))
+
+# How stale this worker's view of the revision counters may get before a
+# conditional GET re-reads them (core.revisions.RevisionClock; 0 = always)
+REVISION_CLOCK_MAX_AGE_MS = float(os.getenv('REVISION_CLOCK_MAX_AGE_MS', '250'))
+
+# Password hashing pool per worker (core.hashing): concurrent PBKDF2 runs and
+# how many more may wait before logins get a fast 503 (0 workers = inline)
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', '16'))
+
+# Verified JWT payloads kept per worker (core.auth.TokenCache)
+JWT_CACHE_MAX_ENTRIES = int(os.getenv('JWT_CACHE_MAX_ENTRIES', '10000'))
+
+# Read-through cache of users/teams/projects by id (core.cache); cross-worker
+# invalidation polls the revision counters every SYNC_INTERVAL (0 = TTL only)
+DOC_CACHE_MAX_ENTRIES = int(os.getenv('DOC_CACHE_MAX_ENTRIES', '5000'))
+DOC_CACHE_TTL_SECONDS = float(os.getenv('DOC_CACHE_TTL_SECONDS', '300'))
+DOC_CACHE_SYNC_INTERVAL_MS = float(os.getenv('DOC_CACHE_SYNC_INTERVAL_MS', '1000'))
+
+# Search (core.search): matches ranked per ?q= query (deeper pages rank
+# as many as they need); responses flag when more matched
+SEARCH_MAX_CANDIDATES = int(os.getenv('SEARCH_MAX_CANDIDATES', '1000'))
 
 
 # Database
@@ -156,6 +235,44 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# ASYNC_API=true serves the CRUD and chat routes with the async views in
+# core.async_views (motor on the event loop); only worthwhile under ASGI
+ASYNC_API = os.getenv('ASYNC_API', 'false').lower() == 'true'
+
+# Bearer token a Prometheus scraper presents to /api/ops/metrics/ (admins'
+# JWTs work too); empty = admins only
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Directory the worker processes share their metrics through, so a scrape
+# of any worker reports them all (see core.metrics; gunicorn.conf.py sets
+# and empties it); empty = each process reports only its own
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+# METRICS_REPLY_BYTES=true measures the size of every Mongo reply (a BSON
+# re-encode per command) for mongo_reply_bytes_total and X-Mongo-Commands
+METRICS_REPLY_BYTES = os.getenv('METRICS_REPLY_BYTES', 'false').lower() == 'true'
+
+# API_JSON_ENGINE=orjson renders and parses API JSON with orjson (install it
+# separately); the default is DRF's stdlib-json renderer
+API_JSON_ENGINE = os.getenv('API_JSON_ENGINE', 'std')
+if API_JSON_ENGINE == 'orjson':
+    if importlib.util.find_spec('orjson') is None:
+        raise ImproperlyConfigured('API_JSON_ENGINE=orjson needs the orjson package: pip install orjson')
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = (
+        'core.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    )
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'] = (
+        'core.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    )
+
+# Responses at least this large are gzip/brotli-compressed when the client
+# accepts it (core.middleware; brotli needs the brotli package)
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'WeIntegrity Project Management API',
     'DESCRIPTION': 'Backend API for the project management web app.',
@@ -0,0 +1,195 @@
+"""Sync (WSGI, thread per request) vs async (ASGI, core.async_views) API path.
+
+Fires ``--requests`` GETs, ``--concurrency`` at a time, at a story list page,
+a story and a chat history within one process:
+
+- ``wsgi``: Django's WSGI handler on a pool of ``--threads`` threads, like one
+  gunicorn gthread worker;
+- ``asgi``: Django's ASGI handler with ASYNC_API=true on one event loop, like
+  one Daphne process.
+
+Each mode runs in its own subprocess (the URLconf is chosen at import).
+Against a real MONGO_URI the driver does real I/O; under mongomock pass
+``--db-latency-ms`` to add that much simulated round-trip time to every
+query (blocking in the sync path, awaited in the async one):
+
+    USE_MONGOMOCK=true python -m benchmarks.async_api --db-latency-ms 5 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import percentile
+
+MODES = ('wsgi', 'asgi')
+PROJECT = 'bench-async'
+
+
+def add_latency(mode, seconds):
+    """Make every simulated query cost ``seconds`` of waiting."""
+    if mode == 'wsgi':
+        from mongomock.collection import Collection
+        for name in ('find', 'find_one', 'find_one_and_update'):
+            original = getattr(Collection, name)
+
+            def slow(self, *args, _original=original, **kwargs):
+                time.sleep(seconds)
+                return _original(self, *args, **kwargs)
+            setattr(Collection, name, slow)
+        return
+    from core import mongo
+    original_getattr = mongo._MockAsyncCollection.__getattr__
+    original_find = mongo._MockAsyncCollection.find
+
+    def slow_getattr(self, name):
+        call = original_getattr(self, name)
+
+        async def slow(*args, **kwargs):
+            await asyncio.sleep(seconds)
+            return await call(*args, **kwargs)
+        return slow
+
+    def slow_find(self, *args, **kwargs):
+        cursor = original_find(self, *args, **kwargs)
+        to_list = cursor.to_list
+
+        async def slow_to_list(length=None):
+            await asyncio.sleep(seconds)
+            return await to_list(length)
+        cursor.to_list = slow_to_list
+        return cursor
+    mongo._MockAsyncCollection.__getattr__ = slow_getattr
+    mongo._MockAsyncCollection.find = slow_find
+
+
+def seed(stories):
+    from core.mongo import get_db
+    from core.revisions import REVISION_FIELD, next_revision
+    db = get_db()
+    db['stories'].delete_many({'projectId': PROJECT})
+    rev = next_revision('stories')
+    db['stories'].insert_many([
+        {'id': f'{PROJECT}-{n}', 'number': f'STRY{n:07d}', 'projectId': PROJECT, 'state': 'New',
+         'shortDescription': f'Story {n}', 'description': 'Lorem ipsum dolor sit amet. ' * 20, REVISION_FIELD: rev}
+        for n in range(stories)
+    ])
+    db['chat_messages'].delete_many({'chatType': 'story', 'chatId': f'{PROJECT}-0'})
+    db['chat_messages'].insert_many([
+        {'chatType': 'story', 'chatId': f'{PROJECT}-0', 'id': f'msg-{n:04d}', 'authorId': 'u1',
+         'timestamp': f'2024-01-01T00:{n // 60:02d}:{n % 60:02d}Z', 'text': 'hello'}
+        for n in range(100)
+    ])
+
+
+def paths(requests):
+    endpoints = [f'/api/stories/?projectId={PROJECT}&page_size=50', f'/api/stories/{PROJECT}-1/',
+                 f'/api/story-chats/{PROJECT}-0/?limit=50']
+    return [endpoints[i % len(endpoints)] for i in range(requests)]
+
+
+def run_wsgi(args, headers):
+    import threading
+    from django.test import Client
+    local = threading.local()
+    # --concurrency client threads share --threads server threads; time spent
+    # waiting for one (gunicorn's accept queue) counts towards latency
+    server = threading.Semaphore(args.threads)
+
+    def call(path):
+        client = getattr(local, 'client', None) or Client()
+        local.client = client
+        started = time.perf_counter()
+        with server:
+            response = client.get(path, **headers)
+        return time.perf_counter() - started, response.status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        call(paths(1)[0])
+        started = time.perf_counter()
+        results = list(pool.map(call, paths(args.requests)))
+    return results, time.perf_counter() - started
+
+
+def run_asgi(args, headers):
+    from django.test import AsyncClient
+    client = AsyncClient()
+    async_headers = {'Authorization': headers['HTTP_AUTHORIZATION']}
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def call(path):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.get(path, headers=async_headers)
+                return time.perf_counter() - started, response.status_code
+        await call(paths(1)[0])
+        started = time.perf_counter()
+        results = await asyncio.gather(*(call(path) for path in paths(args.requests)))
+        return results, time.perf_counter() - started
+    return asyncio.run(main())
+
+
+def child(args):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+    import django
+    django.setup()
+    from core.auth import create_token
+    if args.db_latency_ms:
+        add_latency(args.child, args.db_latency_ms / 1000)
+    seed(args.stories)
+    headers = {'HTTP_AUTHORIZATION': 'Bearer ' + create_token({'id': 'u1', 'email': 'bench@example.com', 'role': 'Admin'})}
+    if args.child == 'wsgi':
+        results, elapsed = run_wsgi(args, headers)
+    else:
+        results, elapsed = run_asgi(args, headers)
+    latencies = [latency for latency, _ in results]
+    print(json.dumps({
+        'mode': args.child,
+        'requests': len(results),
+        'errors': sum(1 for _, code in results if code >= 400),
+        'throughput_rps': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200, help='requests in flight at once')
+    parser.add_argument('--threads', type=int, default=8, help='WSGI request threads (gunicorn --threads)')
+    parser.add_argument('--stories', type=int, default=200)
+    parser.add_argument('--db-latency-ms', type=float, default=0.0,
+                        help='simulated round-trip time added to every mongomock query')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    results = []
+    for mode in args.modes:
+        env = dict(os.environ, ASYNC_API='true' if mode == 'asgi' else 'false')
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.async_api', '--child', mode, *sys.argv[1:]],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print(f'{args.requests} requests, {args.concurrency} in flight, db latency {args.db_latency_ms} ms')
+    print(f"{'mode':<6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for row in results:
+        print(f"{row['mode']:<6} {row['throughput_rps']:>9.1f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['errors']:>7}")
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'args': {k: v for k, v in vars(args).items() if k != 'child'}, 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
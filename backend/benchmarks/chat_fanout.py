@@ -0,0 +1,331 @@
+"""Fan-out capacity of ChatConsumer: N rooms of M sockets at a set message rate.
+
+Opens ``--rooms`` rooms with ``--clients`` sockets each. For ``--duration``
+seconds, it sends ``--rate`` messages a second in total, round-robin over the
+rooms, each from a random socket in the room. Every message goes through
+``receive`` -> persist -> ``group_send`` -> ``chat_message``. Every socket in
+its room, the sender included, should get it back. The run reports:
+
+- delivery latency percentiles, from send to receipt on each socket;
+- dropped deliveries: expected minus received after ``--drain-seconds``,
+  not counting messages rejected with chat_error. Channel layers drop
+  silently once a socket's channel is over capacity;
+- chat_error replies: messages that could not be stored;
+- resident memory per open socket: RSS growth while the sockets connect,
+  divided by their number;
+- persistence lag: how long after sending a message can be read from
+  chat_messages. The collection is polled every ``--poll-ms``, so lags are
+  rounded up to that.
+
+By default sockets are Channels ``WebsocketCommunicator``s on the consumer in
+this process, over the configured channel layer. The memory figure then
+covers both ends of each socket. With ``--url`` the harness opens real
+sockets (a minimal RFC 6455 client, no extra dependency) to a running Daphne
+instead. ``--server-pid`` then reads that process's RSS; without it there is
+no memory figure. Persistence lag is
+only measured if the harness shares the server's MONGO_URI; mongomock is per
+process.
+
+    USE_MONGOMOCK=true python -m benchmarks.chat_fanout --rooms 50 --clients 10 50 --rate 200
+    python -m benchmarks.chat_fanout --url ws://localhost:8000 --server-pid 1234 --rooms 100 --clients 20
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import ssl
+import struct
+import time
+import uuid
+from urllib.parse import urlsplit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+
+from core import chats  # noqa: E402
+from core.mongo import get_async_collection, get_client  # noqa: E402
+from core.routing import websocket_urlpatterns  # noqa: E402
+
+from benchmarks.common import percentile  # noqa: E402
+
+CHAT_TYPE = 'project'
+
+
+def rss_kb(pid=None):
+    """Resident set size of ``pid`` (default: this process) in kB; None where /proc is missing."""
+    try:
+        with open(f'/proc/{pid or "self"}/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class SocketClient:
+    """The ``WebsocketCommunicator`` calls the harness uses, over a real socket.
+
+    Just enough of RFC 6455 for Daphne: masked text frames out, text (also
+    fragmented), ping and close frames in.
+    """
+
+    def __init__(self, url):
+        self.url = urlsplit(url)
+
+    async def connect(self):
+        secure = self.url.scheme == 'wss'
+        self.reader, self.writer = await asyncio.open_connection(
+            self.url.hostname, self.url.port or (443 if secure else 80),
+            ssl=ssl.create_default_context() if secure else None)
+        key = base64.b64encode(os.urandom(16)).decode()
+        origin = f"{'https' if secure else 'http'}://{self.url.netloc}"
+        self.writer.write((
+            f'GET {self.url.path or "/"} HTTP/1.1\r\nHost: {self.url.netloc}\r\nUpgrade: websocket\r\n'
+            f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n'
+            f'Origin: {origin}\r\n\r\n'
+        ).encode())
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        return head.split(b' ', 2)[1] == b'101', None
+
+    def _send_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes((mask * (length // 4 + 1))[:length], 'big'))
+        self.writer.write(header + mask + masked.to_bytes(length, 'big'))
+
+    async def send_json_to(self, data):
+        self._send_frame(0x1, json.dumps(data).encode())
+        await self.writer.drain()
+
+    async def receive_json_from(self, timeout=None):
+        return json.loads(await asyncio.wait_for(self._message(), timeout))
+
+    async def _message(self):
+        parts = []
+        while True:
+            first, second = await self.reader.readexactly(2)
+            opcode, length = first & 0x0F, second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            mask = await self.reader.readexactly(4) if second & 0x80 else None
+            payload = await self.reader.readexactly(length)
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+            if opcode == 0x8:
+                raise ConnectionError('closed by server')
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode in (0x0, 0x1, 0x2):
+                parts.append(payload)
+                if first & 0x80:
+                    return b''.join(parts)
+
+    async def disconnect(self):
+        try:
+            self._send_frame(0x8, struct.pack('!H', 1000))
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class Run:
+    """Send times and observations of one run, keyed by message id."""
+
+    def __init__(self):
+        self.sent = {}  # id -> (room index, perf_counter at send)
+        self.latencies = []
+        self.delivered = 0
+        self.errors = 0
+        self.persisted = {}  # id -> lag in seconds
+
+
+async def read(client, run):
+    """Record every broadcast this socket receives, until cancelled."""
+    while True:
+        event = await client.receive_json_from(timeout=3600)
+        if event.get('type') == 'chat_error':
+            run.errors += 1
+            continue
+        message_id = (event.get('message') or {}).get('message', {}).get('id')
+        sent = run.sent.get(message_id)
+        if sent is not None:
+            run.delivered += 1
+            run.latencies.append(time.perf_counter() - sent[1])
+
+
+async def poll_persistence(run, room_names, interval, stop):
+    """Note when each sent message first shows up in chat_messages."""
+    collection = get_async_collection(chats.MESSAGES)
+    while True:
+        pending = [message_id for message_id in run.sent if message_id not in run.persisted]
+        for start in range(0, len(pending), 1000):
+            batch = pending[start:start + 1000]
+            found = await collection.find({'chatType': CHAT_TYPE, 'chatId': {'$in': room_names}, 'id': {'$in': batch}},
+                                          {'_id': 0, 'id': 1}).to_list(None)
+            now = time.perf_counter()
+            for doc in found:
+                run.persisted[doc['id']] = now - run.sent[doc['id']][1]
+        if stop.is_set() and len(run.persisted) == len(run.sent):
+            return
+        await asyncio.sleep(interval)
+
+
+async def open_client(args, app, room):
+    path = f'/ws/chat/{CHAT_TYPE}/{room}/'
+    client = SocketClient(args.url.rstrip('/') + path) if args.url else WebsocketCommunicator(app, path)
+    connected, _ = await client.connect()
+    if not connected:
+        raise RuntimeError(f'could not connect to {path}')
+    return client
+
+
+async def fanout(args, clients_per_room, check_persistence):
+    run_id = uuid.uuid4().hex[:8]
+    rng = random.Random(args.seed)
+    room_names = [f'fanout-{run_id}-{r}' for r in range(args.rooms)]
+    app = None if args.url else URLRouter(websocket_urlpatterns)
+    # With --url the sockets live in another process, readable only by pid
+    def server_rss():
+        return rss_kb(args.server_pid) if args.server_pid or not args.url else None
+    rss_before = server_rss()
+    # Connect in bounded batches, like clients arriving over a few seconds
+    gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def join(room):
+        async with gate:
+            return await open_client(args, app, room)
+    rooms = [await asyncio.gather(*(join(room) for _ in range(clients_per_room))) for room in room_names]
+    rss_open = server_rss()
+    connections = args.rooms * clients_per_room
+
+    run = Run()
+    readers = [asyncio.create_task(read(client, run)) for room in rooms for client in room]
+    stop = asyncio.Event()
+    poller = (asyncio.create_task(poll_persistence(run, room_names, args.poll_ms / 1000, stop))
+              if check_persistence else None)
+    total = int(args.rate * args.duration)
+    started = time.perf_counter()
+    for n in range(total):
+        # Open loop: keep the schedule even when deliveries fall behind
+        delay = started + n / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        room = n % args.rooms
+        message_id = f'fanout-{run_id}-{n}'
+        run.sent[message_id] = (room, time.perf_counter())
+        await rng.choice(rooms[room]).send_json_to({
+            'type': 'chat_message', 'chat_type': CHAT_TYPE, 'chat_id': room_names[room],
+            'message': {'id': message_id, 'authorId': f'fanout-user-{room}',
+                        'timestamp': f'{time.time():.6f}', 'text': 'x' * args.message_bytes},
+        })
+    send_elapsed = time.perf_counter() - started
+    expected = total * clients_per_room
+    deadline = time.perf_counter() + args.drain_seconds
+    while run.delivered + run.errors * clients_per_room < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if poller is not None:
+        try:
+            await asyncio.wait_for(poller, args.drain_seconds)
+        except asyncio.TimeoutError:
+            pass
+    rss_end = server_rss()
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    await asyncio.gather(*(client.disconnect() for room in rooms for client in room), return_exceptions=True)
+    if check_persistence:
+        await get_async_collection(chats.MESSAGES).delete_many({'chatType': CHAT_TYPE, 'chatId': {'$in': room_names}})
+
+    lags = list(run.persisted.values())
+    # A chat_error message was never broadcast, so its deliveries are not drops
+    dropped = max(0, expected - run.errors * clients_per_room - run.delivered)
+    return {
+        'rooms': args.rooms,
+        'clients_per_room': clients_per_room,
+        'connections': connections,
+        'rate_msg_s': args.rate,
+        'messages_sent': total,
+        'send_rate_achieved_msg_s': round(total / send_elapsed, 1) if send_elapsed else None,
+        'expected_deliveries': expected,
+        'delivered': run.delivered,
+        'dropped': dropped,
+        'drop_rate': round(dropped / expected, 4) if expected else 0.0,
+        'chat_errors': run.errors,
+        'deliveries_per_s': round(run.delivered / elapsed, 1),
+        'p50_ms': round(percentile(run.latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(run.latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(run.latencies, 99) * 1000, 2),
+        'max_ms': round(max(run.latencies, default=0.0) * 1000, 2),
+        'rss_kb_per_connection': (round((rss_open - rss_before) / connections, 1)
+                                  if rss_before is not None and rss_open is not None else None),
+        'rss_kb_end': rss_end,
+        'persistence_lag_p50_ms': round(percentile(lags, 50) * 1000, 1) if check_persistence else None,
+        'persistence_lag_p99_ms': round(percentile(lags, 99) * 1000, 1) if check_persistence else None,
+        'persistence_lag_max_ms': round(max(lags, default=0.0) * 1000, 1) if check_persistence else None,
+        'unpersisted': total - len(lags) if check_persistence else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--clients', type=int, nargs='+', default=[10], help='sockets per room; one run per value')
+    parser.add_argument('--rate', type=float, default=100.0, help='messages per second, over all rooms')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending')
+    parser.add_argument('--message-bytes', type=int, default=200, help='length of each message text')
+    parser.add_argument('--drain-seconds', type=float, default=10.0,
+                        help='how long to wait for outstanding deliveries before counting them as dropped')
+    parser.add_argument('--poll-ms', type=float, default=20.0, help='persistence polling interval')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='sockets connecting at once')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--url', help='ws:// base URL of a running Daphne; default: in-process communicators')
+    parser.add_argument('--server-pid', type=int, help='with --url: the server process to read memory from')
+    parser.add_argument('--write-latency-ms', type=float, default=None,
+                        help='in-process: emulate the database, each chat bulk write just sleeps this long')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.write_latency_ms is not None:
+        def emulated_bulk_write(ops):
+            time.sleep(args.write_latency_ms / 1000)
+        chats.ChatWriter._bulk_write = staticmethod(emulated_bulk_write)
+    # A separate server only shares what this process sees through a real Mongo
+    check_persistence = args.write_latency_ms is None and (not args.url or isinstance(get_client(), MongoClient))
+
+    results = [asyncio.run(fanout(args, clients, check_persistence)) for clients in args.clients]
+    print(f"{'rooms':>6} {'clients':>8} {'sent':>7} {'dropped':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'kB/conn':>8} {'persist p99':>12}")
+    for r in results:
+        print(f"{r['rooms']:>6} {r['clients_per_room']:>8} {r['messages_sent']:>7} {r['dropped']:>8} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['p99_ms']:>8} {str(r['rss_kb_per_connection']):>8} "
+              f"{str(r['persistence_lag_p99_ms']):>12}")
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'benchmark': 'chat_fanout', 'target': args.url or 'in-process',
+                       'args': {k: v for k, v in vars(args).items() if k != 'output'}, 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Broadcast latency of ChatConsumer with many concurrent senders.
+
+Every sender opens a socket on one of ``--rooms`` rooms, sends its messages
+one after another and times each until its own broadcast comes back
+(persist -> group_send -> chat_message). The run is repeated for each
+``--workers`` value (0 = Django's shared thread-sensitive sync thread).
+
+Run from backend/ against a real MONGO_URI, or pass ``--write-latency-ms`` to
+replace each bulk write with a sleep of that length (mongomock's own CPU cost
+would otherwise swamp the measurement):
+
+    USE_MONGOMOCK=true python -m benchmarks.chat_persistence --senders 1000 --workers 0 4 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.db import database_sync_to_async  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from core import chats  # noqa: E402
+from core.routing import websocket_urlpatterns  # noqa: E402
+
+from benchmarks.common import percentile  # noqa: E402
+
+
+async def sender(client, room, index, messages, run_id):
+    latencies = []
+    for n in range(messages):
+        message_id = f'bench-{run_id}-{index}-{n}'
+        started = time.perf_counter()
+        await client.send_json_to({
+            'type': 'chat_message', 'chat_type': 'project', 'chat_id': room,
+            'message': {'id': message_id, 'authorId': f'bench-user-{index}',
+                        'timestamp': f'{time.time():.6f}', 'text': 'benchmark'},
+        })
+        # Other senders' broadcasts in the same room arrive in between
+        while True:
+            event = await client.receive_json_from(timeout=120)
+            if event.get('message', {}).get('message', {}).get('id') == message_id:
+                break
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def shared_thread_load(latency, stop):
+    """Other ``database_sync_to_async`` work queued on Django's shared thread."""
+    while not stop.is_set():
+        await database_sync_to_async(time.sleep)(latency)
+
+
+async def run(senders, rooms, messages, workers, load_tasks, load_latency):
+    chats.writer = chats.ChatWriter(
+        interval=settings.CHAT_COMMIT_INTERVAL_MS / 1000,
+        max_batch=settings.CHAT_COMMIT_MAX_BATCH,
+        workers=workers,
+    )
+    app = URLRouter(websocket_urlpatterns)
+    run_id = uuid.uuid4().hex[:8]
+    room_names = [f'bench-{run_id}-{r}' for r in range(rooms)]
+    clients = [WebsocketCommunicator(app, f'/ws/chat/project/{room_names[i % rooms]}/') for i in range(senders)]
+    await asyncio.gather(*(c.connect() for c in clients))
+    stop = asyncio.Event()
+    load = [asyncio.create_task(shared_thread_load(load_latency, stop)) for _ in range(load_tasks)]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        sender(c, room_names[i % rooms], i, messages, run_id) for i, c in enumerate(clients)
+    ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*load)
+    await asyncio.gather(*(c.disconnect() for c in clients))
+    latencies = [lat for per_sender in results for lat in per_sender]
+    return {
+        'workers': workers,
+        'senders': senders,
+        'rooms': rooms,
+        'messages': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_msg_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--senders', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=5, help='messages per sender')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, settings.CHAT_PERSIST_WORKERS])
+    parser.add_argument('--write-latency-ms', type=float, default=None,
+                        help='emulate the database: each bulk write just sleeps this long')
+    parser.add_argument('--shared-load', type=int, default=0,
+                        help='concurrent tasks keeping the shared sync thread busy')
+    parser.add_argument('--shared-load-ms', type=float, default=2.0,
+                        help='duration of each shared-thread call made by --shared-load')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.write_latency_ms is not None:
+        def emulated_bulk_write(ops):
+            time.sleep(args.write_latency_ms / 1000)
+        chats.ChatWriter._bulk_write = staticmethod(emulated_bulk_write)
+
+    results = [asyncio.run(run(args.senders, args.rooms, args.messages, w,
+                                                   args.shared_load, args.shared_load_ms / 1000)) for w in args.workers]
+    print(f"{'workers':>8} {'msgs':>7} {'msg/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for r in results:
+        print(f"{r['workers']:>8} {r['messages']:>7} {r['throughput_msg_s']:>9} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8}")
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'benchmark': 'chat_persistence', 'write_latency_ms': args.write_latency_ms,
+                       'shared_load': args.shared_load, 'shared_load_ms': args.shared_load_ms,
+                       'commit_interval_ms': settings.CHAT_COMMIT_INTERVAL_MS, 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
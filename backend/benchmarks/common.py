@@ -0,0 +1,10 @@
+"""Helpers shared by the benchmark scripts."""
+
+
+def percentile(values, pct):
+    """Nearest-rank ``pct`` percentile of ``values``; 0.0 when empty."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
@@ -0,0 +1,352 @@
+"""HTTP load test of the core API: throughput and p50/p95/p99 per endpoint.
+
+Seeds a synthetic dataset (users, teams, projects, epics, sprints, stories
+with generated text and some chat history; all ids start with ``lt-``) and
+then, endpoint by endpoint, sends ``--requests`` requests ``--concurrency``
+at a time. Paths are built with ``reverse()`` from the names in core/urls.py,
+and parameters (project, story, search word) are drawn from a generator
+seeded with ``--seed``, so two runs send the same requests.
+
+By default requests go through Django's full handler in this process, one
+test client per thread (middleware, URL resolution, views, rendering). With
+``--base-url`` they go over HTTP to a running server instead, which must use
+the same MONGO_URI so it sees the seeded data (the in-memory mongomock
+fallback is per process, and checks unique indexes by scanning, so seeding
+it takes minutes beyond a few thousand stories):
+
+    USE_MONGOMOCK=true python -m benchmarks.http_load --stories 2000 --output load.json
+    python -m benchmarks.http_load --base-url http://localhost:8000 --concurrency 64 --output load.json
+
+``--compare`` takes an earlier ``--output`` file and prints the p95 change
+per endpoint. It exits with status 1 when an endpoint got slower by more than
+``--max-regression`` percent, so a CI job can fail on it.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+
+import django  # noqa: E402
+from pymongo import UpdateOne  # noqa: E402
+
+django.setup()
+
+from django.test import Client  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from core import search  # noqa: E402
+from core.auth import create_token  # noqa: E402
+from core.mongo import get_db  # noqa: E402
+from core.notifications import dispatcher  # noqa: E402
+from core.revisions import REVISION_FIELD, bump_revisions, current_revisions  # noqa: E402
+
+from benchmarks.common import percentile  # noqa: E402
+
+PREFIX = 'lt-'
+STATES = ('New', 'Ready', 'In Progress', 'In Review', 'Testing', 'Done')
+PRIORITIES = ('1 - Critical', '2 - High', '3 - Moderate', '4 - Low')
+TYPES = ('Feature', 'Defect', 'Enhancement', 'Spike')
+WORDS = (
+    'account', 'admin', 'alert', 'api', 'approval', 'audit', 'backlog', 'billing', 'cache', 'calendar',
+    'checkout', 'client', 'config', 'customer', 'dashboard', 'data', 'deploy', 'email', 'export', 'filter',
+    'import', 'invoice', 'latency', 'login', 'migration', 'mobile', 'notification', 'onboarding', 'order',
+    'pagination', 'password', 'payment', 'permission', 'profile', 'report', 'retry', 'role', 'schedule',
+    'search', 'session', 'settings', 'signup', 'sprint', 'storage', 'sync', 'team', 'timeout', 'upload',
+    'user', 'validation', 'webhook', 'workflow',
+)
+VERBS = ('add', 'fix', 'improve', 'refactor', 'support', 'validate', 'show', 'hide', 'cache', 'retry')
+FIRST_NAMES = ('Ana', 'Ben', 'Chen', 'Dana', 'Eli', 'Farah', 'Gus', 'Hana', 'Ivan', 'Jo', 'Kofi', 'Lena')
+LAST_NAMES = ('Abbott', 'Baker', 'Costa', 'Diaz', 'Evans', 'Fischer', 'Garcia', 'Haddad', 'Ito', 'Jensen')
+ALL_COLLECTIONS = ('users', 'teams', 'projects', 'epics', 'sprints', 'stories')
+
+# name -> (method, URL name, URL kwargs, query); {project}, {story} and {word}
+# are filled in per request
+ENDPOINTS = {
+    'users-list': ('GET', 'users-list', {}, {'page_size': '50'}),
+    'teams-list-expand': ('GET', 'teams-list', {}, {'expand': 'leadId'}),
+    'projects-list': ('GET', 'projects-list', {}, {}),
+    'stories-list': ('GET', 'stories-list', {}, {'projectId': '{project}', 'page_size': '50'}),
+    'stories-board': ('GET', 'stories-list', {}, {'projectId': '{project}', 'state': 'In Progress', 'page_size': '100'}),
+    'stories-cursor': ('GET', 'stories-list', {}, {'projectId': '{project}', 'page_size': '50', 'cursor': ''}),
+    'stories-expand': ('GET', 'stories-list', {}, {'projectId': '{project}', 'page_size': '20',
+                                                   'expand': 'assignedToId,sprintId,epicId'}),
+    'stories-search': ('GET', 'stories-list', {}, {'q': '{word}', 'page_size': '20'}),
+    'stories-detail': ('GET', 'stories-detail', {'id': '{story}'}, {}),
+    'stories-detail-related': ('GET', 'stories-detail-related', {'id': '{story}'}, {}),
+    'story-chats': ('GET', 'story-chats', {'storyId': '{story}'}, {'limit': '50'}),
+    'story-chats-post': ('POST', 'story-chats', {'storyId': '{story}'}, {}),
+    'notifications-unread-count': ('GET', 'notifications-unread-count', {}, {}),
+}
+
+
+def sentence(rng, words):
+    text = ' '.join([rng.choice(VERBS)] + [rng.choice(WORDS) for _ in range(words - 1)])
+    return text[0].upper() + text[1:] + '.'
+
+
+def paragraph(rng, sentences):
+    return ' '.join(sentence(rng, rng.randint(6, 14)) for _ in range(sentences))
+
+
+def seed(args):
+    """Replace the ``lt-`` dataset; returns the ids requests are drawn from.
+
+    Documents of the previous dataset that this one does not re-create get
+    tombstones, so delta syncs and other processes' caches drop them.
+    """
+    rng = random.Random(args.seed)
+    db = get_db()
+    previous = {}
+    for name in ALL_COLLECTIONS:
+        previous[name] = {doc['id'] for doc in db[name].find({'id': {'$regex': f'^{PREFIX}'}}, {'_id': 0, 'id': 1})}
+        db[name].delete_many({'id': {'$regex': f'^{PREFIX}'}})
+    db['chat_messages'].delete_many({'chatId': {'$regex': f'^{PREFIX}'}})
+    rev = {name: rev + 1 for name, rev in current_revisions(ALL_COLLECTIONS).items()}
+
+    users = [{
+        'id': f'{PREFIX}user-{n}', 'employeeId': f'{PREFIX}E{n:05d}',
+        'firstName': rng.choice(FIRST_NAMES), 'lastName': rng.choice(LAST_NAMES),
+        'email': f'{PREFIX}user{n}@example.com', 'role': rng.choice(('Developer', 'Tester', 'ProductOwner')),
+        'department': rng.choice(('Engineering', 'QA', 'Product')), 'jobTitle': 'Engineer', 'status': 'active',
+        'dateOfJoining': f'20{rng.randint(15, 24)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}',
+        'notes': paragraph(rng, 2), REVISION_FIELD: rev['users'],
+    } for n in range(args.users)]
+    projects = [{
+        'id': f'{PREFIX}project-{n}', 'name': f'{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}',
+        'ownerId': rng.choice(users)['id'], 'status': rng.choice(('Not Started', 'In Progress', 'Completed')),
+        'startDate': '2024-01-01', 'endDate': f'2025-{rng.randint(1, 12):02d}-28',
+        'description': paragraph(rng, 4), 'memberIds': [u['id'] for u in rng.sample(users, min(10, len(users)))],
+        REVISION_FIELD: rev['projects'],
+    } for n in range(args.projects)]
+    teams = [{
+        'id': f'{PREFIX}team-{n}', 'name': f'Team {rng.choice(WORDS).title()}',
+        'leadId': rng.choice(users)['id'], 'projectId': rng.choice(projects)['id'],
+        'memberIds': [u['id'] for u in rng.sample(users, min(8, len(users)))], REVISION_FIELD: rev['teams'],
+    } for n in range(args.teams)]
+    epics = [{
+        'id': f'{PREFIX}epic-{n}', 'name': sentence(rng, 4), 'projectId': project['id'], REVISION_FIELD: rev['epics'],
+    } for n, project in enumerate(projects * 5)]
+    sprints = [{
+        'id': f'{PREFIX}sprint-{n}', 'name': f'Sprint {n}', 'projectId': project['id'],
+        'startDate': f'2024-{n % 12 + 1:02d}-01', 'endDate': f'2024-{n % 12 + 1:02d}-14', REVISION_FIELD: rev['sprints'],
+    } for n, project in enumerate(projects * 6)]
+    stories = []
+    for n in range(args.stories):
+        project = rng.choice(projects)
+        stories.append({
+            'id': f'{PREFIX}story-{n}', 'number': f'STRY{n:07d}', 'projectId': project['id'],
+            'epicId': rng.choice(epics)['id'], 'sprintId': rng.choice(sprints)['id'],
+            'assignedToId': rng.choice(users)['id'], 'assignedTeamId': rng.choice(teams)['id'],
+            'createdById': rng.choice(users)['id'], 'state': rng.choice(STATES),
+            'priority': rng.choice(PRIORITIES), 'type': rng.choice(TYPES), 'storyPoints': rng.choice((1, 2, 3, 5, 8, 13)),
+            'shortDescription': sentence(rng, rng.randint(5, 10)), 'description': paragraph(rng, rng.randint(3, 8)),
+            'acceptanceCriteria': paragraph(rng, 3), 'workNotes': paragraph(rng, rng.randint(0, 4)),
+            'plannedStartDate': '2024-03-01', 'plannedEndDate': '2024-03-15', REVISION_FIELD: rev['stories'],
+        })
+    for name, docs in (('users', users), ('projects', projects), ('teams', teams), ('epics', epics),
+                       ('sprints', sprints), ('stories', stories)):
+        db[name].insert_many(docs)
+        seeded = [doc['id'] for doc in docs]
+        # A re-seeded id is an upsert again, not a delete
+        db['tombstones'].delete_many({'collection': name, 'id': {'$in': seeded}})
+        gone = previous[name].difference(seeded)
+        if gone:
+            db['tombstones'].bulk_write([
+                UpdateOne({'collection': name, 'id': doc_id}, {'$set': {'rev': rev[name]}}, upsert=True)
+                for doc_id in gone
+            ])
+    chatted = stories[:max(1, len(stories) // 10)]
+    db['chat_messages'].insert_many([{
+        'chatType': 'story', 'chatId': story['id'], 'id': f'{PREFIX}msg-{story["id"]}-{m}',
+        'authorId': rng.choice(users)['id'], 'timestamp': f'2024-03-01T{m // 60:02d}:{m % 60:02d}:00Z',
+        'text': sentence(rng, rng.randint(4, 16)),
+    } for story in chatted for m in range(args.messages)])
+    bump_revisions(list(ALL_COLLECTIONS))
+    search.rebuild('stories')
+    return {
+        'projects': [p['id'] for p in projects],
+        'stories': [s['id'] for s in chatted],
+        'words': list(WORDS),
+        'admin': users[0],
+    }
+
+
+def plan(endpoint, count, dataset, rng):
+    """``count`` (method, path, body) requests for ``endpoint``."""
+    method, url_name, kwargs, query = ENDPOINTS[endpoint]
+    requests = []
+    for n in range(count):
+        values = {'project': rng.choice(dataset['projects']), 'story': rng.choice(dataset['stories']),
+                  'word': rng.choice(dataset['words'])}
+        path = reverse(url_name, kwargs={k: v.format(**values) for k, v in kwargs.items()})
+        params = {k: v.format(**values) for k, v in query.items()}
+        if params:
+            path += '?' + urlencode(params)
+        body = None
+        if method == 'POST':
+            body = json.dumps({'id': f'{PREFIX}post-{rng.getrandbits(64):x}-{n}', 'authorId': dataset['admin']['id'],
+                               'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                               'text': sentence(rng, 8)})
+        requests.append((method, path, body))
+    return requests
+
+
+class InProcessTarget:
+    """Django's handler in this process; one test client per thread."""
+
+    def __init__(self, token):
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+        self.local = threading.local()
+
+    def send(self, method, path, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = Client()
+        if method == 'POST':
+            response = client.post(path, data=body, content_type='application/json', **self.headers)
+        else:
+            response = client.get(path, **self.headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code
+
+
+class HTTPTarget:
+    """A running server; one keep-alive connection per thread."""
+
+    def __init__(self, base_url, token):
+        self.url = urlsplit(base_url)
+        self.headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+        self.local = threading.local()
+
+    def send(self, method, path, body):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            factory = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            connection = self.local.connection = factory(self.url.netloc, timeout=60)
+        try:
+            connection.request(method, self.url.path.rstrip('/') + path, body=body, headers=self.headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            return 599
+
+
+def run(target, requests, concurrency):
+    def call(request):
+        started = time.perf_counter()
+        status = target.send(*request)
+        return time.perf_counter() - started, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(call, requests))
+        elapsed = time.perf_counter() - started
+    latencies = [latency for latency, _ in results]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status >= 400),
+        'throughput_rps': len(results) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, max_regression):
+    """Print the p95 change against ``baseline_path``; True if within ``max_regression`` percent."""
+    with open(baseline_path) as fh:
+        baseline = {row['endpoint']: row for row in json.load(fh)['results']}
+    ok = True
+    print(f"\n{'endpoint':<28} {'base p95':>9} {'p95':>9} {'change':>8}")
+    for row in results:
+        before = baseline.get(row['endpoint'])
+        if not before or not before['p95_ms']:
+            continue
+        change = (row['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        flag = ''
+        if change > max_regression:
+            ok, flag = False, '  REGRESSION'
+        print(f"{row['endpoint']:<28} {before['p95_ms']:>9.1f} {row['p95_ms']:>9.1f} {change:>+7.1f}%{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--teams', type=int, default=20)
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--stories', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=50, help='chat messages on every tenth story')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the dataset and the requests')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight at once')
+    parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument('--base-url', help='send requests to this running server instead of in-process')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='earlier --output file to compare p95 against')
+    parser.add_argument('--max-regression', type=float, default=20.0,
+                        help='with --compare, exit 1 if any p95 grew by more than this many percent')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    dataset = seed(args)
+    print(f'seeded {args.stories} stories, {args.users} users in {time.perf_counter() - started:.1f}s')
+    admin = dataset['admin']
+    token = create_token({**admin, 'role': 'Admin'})
+    target = HTTPTarget(args.base_url, token) if args.base_url else InProcessTarget(token)
+    rng = random.Random(args.seed)
+
+    results = []
+    print(f"{'endpoint':<28} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for endpoint in args.endpoints:
+        run(target, plan(endpoint, args.warmup, dataset, rng), args.concurrency)
+        row = {'endpoint': endpoint, **run(target, plan(endpoint, args.requests, dataset, rng), args.concurrency)}
+        results.append(row)
+        print(f"{endpoint:<28} {row['throughput_rps']:>9.1f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['errors']:>7}")
+    # Let chat posts finish their background notification fan-out
+    dispatcher.drain()
+
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'target': args.base_url or 'in-process',
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+            'results': results,
+        }
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    if args.compare and not compare(results, args.compare, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
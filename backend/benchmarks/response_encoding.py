@@ -0,0 +1,104 @@
+"""Encode time and size of a 100-story list page, per renderer and encoding.
+
+Renders the same page of full story documents with DRF's ``JSONRenderer``
+and ``core.renderers.ORJSONRenderer``, then compresses the result with gzip
+(as ``CompressionMiddleware`` does) and brotli when it is installed:
+
+    python -m benchmarks.response_encoding --stories 100 --repeat 200
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from core.renderers import ORJSONRenderer  # noqa: E402
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WORDS = ('user', 'story', 'sprint', 'dashboard', 'filter', 'export', 'report', 'login', 'latency', 'cache',
+         'validate', 'form', 'notify', 'team', 'project', 'search', 'page', 'error', 'retry', 'timeout')
+STATES = ('New', 'In Progress', 'Ready for Testing', 'Done')
+
+
+def sentence(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+
+def story(rng, n):
+    """A story shaped like the frontend's ``Story`` type, with realistic text."""
+    return {
+        'id': f'story-{n}', 'number': f'STRY{n:07d}',
+        'shortDescription': sentence(rng, 8),
+        'description': ' '.join(sentence(rng, 14) for _ in range(12)),
+        'acceptanceCriteria': '\n'.join(f'- {sentence(rng, 10)}' for _ in range(5)),
+        'state': rng.choice(STATES), 'priority': '3 - Moderate', 'type': 'Feature',
+        'storyPoints': rng.choice((1, 2, 3, 5, 8)),
+        'assignedTeamId': f'team-{n % 7}', 'assignedToId': f'user-{n % 31}',
+        'businessOwnerId': 'user-1', 'testedById': f'user-{n % 5}',
+        'projectId': 'project-1', 'epicId': f'epic-{n % 9}', 'sprintId': f'sprint-{n % 4}',
+        'release': 'R2', 'plannedStartDate': '2024-03-01', 'plannedEndDate': '2024-03-15',
+        'progress': rng.randint(0, 100), 'deadline': '2024-03-20',
+        'workNotes': ' '.join(sentence(rng, 12) for _ in range(6)),
+        'attachments': [{'name': 'spec.pdf', 'url': f'https://files.example.com/{n}/spec.pdf'}],
+        'relatedStoryIds': [f'story-{n + 1}', f'story-{n + 2}'],
+        'createdById': 'user-1', 'createdOn': '2024-02-28T10:00:00Z',
+        'updatedById': 'user-2', 'updatedOn': '2024-03-02T16:30:00Z',
+    }
+
+
+def timed(fn, repeat):
+    """Median seconds per call of ``fn`` and its (last) result."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stories', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    page = [story(rng, n) for n in range(args.stories)]
+    results = []
+    for name, renderer in (('drf-json', JSONRenderer()), ('orjson', ORJSONRenderer())):
+        encode, body = timed(lambda: renderer.render(page, 'application/json'), args.repeat)
+        results.append({'renderer': name, 'encoding': 'identity', 'encode_ms': encode * 1000, 'bytes': len(body)})
+        compress, packed = timed(lambda: gzip.compress(body, compresslevel=6), args.repeat)
+        results.append({'renderer': name, 'encoding': 'gzip', 'encode_ms': (encode + compress) * 1000, 'bytes': len(packed)})
+        if brotli is not None:
+            compress, packed = timed(lambda: brotli.compress(body, quality=5), args.repeat)
+            results.append({'renderer': name, 'encoding': 'br', 'encode_ms': (encode + compress) * 1000, 'bytes': len(packed)})
+
+    print(f'{args.stories} stories, median of {args.repeat} runs')
+    print(f"{'renderer':<10} {'encoding':<9} {'encode ms':>10} {'bytes':>9}")
+    for row in results:
+        print(f"{row['renderer']:<10} {row['encoding']:<9} {row['encode_ms']:>10.3f} {row['bytes']:>9}")
+    if brotli is None:
+        print('(brotli not installed; br skipped)')
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'stories': args.stories, 'repeat': args.repeat, 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from django.apps import AppConfig
-import os
+from pymongo import ASCENDING, DESCENDING
 
 
 class CoreConfig(AppConfig):
@@ -9,6 +9,8 @@ class CoreConfig(AppConfig):
     def ready(self):
         # Create Mongo indexes at startup (id/email uniqueness, chat uniqueness)
         from .mongo import get_db
+        from .revisions import REVISION_FIELD
+        from .views import SYNC_VIEWS
         db = get_db()
         try:
             db['users'].create_index('id', unique=True)
@@ -16,15 +18,27 @@ class CoreConfig(AppConfig):
             db['users'].create_index('employeeId', unique=True)
             for col in ['teams','projects','stories','epics','sprints','notifications']:
                 db[col].create_index('id', unique=True)
-            db['story_chats'].create_index('storyId', unique=True)
-            db['project_chats'].create_index('projectId', unique=True)
+            # Delta-sync change feed (see core.revisions)
+            for col in ['users','teams','projects','stories','epics','sprints','notifications']:
+                db[col].create_index(REVISION_FIELD)
+            db['tombstones'].create_index([('collection', ASCENDING), ('rev', ASCENDING)])
+            db['tombstones'].create_index([('collection', ASCENDING), ('id', ASCENDING)], unique=True)
+            # Keyset pagination sort keys (see BaseCrudView.cursor_field)
+            db['stories'].create_index([('number', ASCENDING), ('id', ASCENDING)])
+            # Per-user listing (notifications are always scoped to their owner),
+            # unread badge count and bulk mark-read
+            db['notifications'].create_index([('userId', ASCENDING), ('timestamp', DESCENDING), ('id', DESCENDING)])
+            db['notifications'].create_index([('userId', ASCENDING), ('isRead', ASCENDING), ('timestamp', DESCENDING)])
+            # List filters (see BaseCrudView.filter_indexes)
+            for view in SYNC_VIEWS:
+                for fields in view.filter_indexes:
+                    db[view.collection_name].create_index([(field, ASCENDING) for field in fields])
+            # ?q= token index (see core.search)
+            db['search_index'].create_index([('collection', ASCENDING), ('id', ASCENDING)], unique=True)
+            db['search_index'].create_index([('collection', ASCENDING), ('terms', ASCENDING)])
+            # One document per chat message (see core.chats)
+            db['chat_messages'].create_index([('chatType', ASCENDING), ('chatId', ASCENDING), ('id', ASCENDING)], unique=True)
+            db['chat_messages'].create_index([('chatType', ASCENDING), ('chatId', ASCENDING), ('timestamp', DESCENDING), ('id', DESCENDING)])
         except Exception:
             # Ignore index errors in dev/tests; logs are handled by Mongo driver
             pass
-
-from django.apps import AppConfig
-
-
-class CoreConfig(AppConfig):
-    default_auto_field = 'django.db.models.BigAutoField'
-    name = 'core'
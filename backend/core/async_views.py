@@ -0,0 +1,275 @@
+"""Async (ASGI) twins of the CRUD and chat views, enabled with ASYNC_API=true.
+
+DRF views are sync, so under Daphne every request to them holds a thread
+for as long as pymongo blocks. These views keep the routes, configuration
+(filters, projections, references, permissions) and responses of their
+sync counterparts in core.views, but run on the event loop and talk to
+Mongo through motor (``get_async_db``), so one process can keep thousands
+of requests in flight.
+
+Views whose writes do more than the generic ones (users: password
+hashing, token revocation) hand those writes to the sync view.
+"""
+import io
+
+import jwt
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import ParseError
+from rest_framework.settings import api_settings
+
+from . import chats, etags, filters, search
+from .auth import AuthUser, adecode_token
+from .cache import documents
+from .mongo import get_async_collection, get_async_db
+from .revisions import REVISION_FIELD, areserved_revision, arecord_delete, clock
+from .views import (
+    BaseCrudView, CRUD_VIEWS, MAX_IDS, clean_doc, encode_cursor, owner_scope, page_params, search_limit,
+    search_offset, split_update,
+)
+
+
+def render(data, status=200):
+    """A response rendered like DRF's ``Response(data, status)``."""
+    if data is None:
+        return HttpResponse(status=status)
+    renderer = api_settings.DEFAULT_RENDERER_CLASSES[0]()
+    return HttpResponse(renderer.render(data, renderer.media_type), status=status, content_type=renderer.media_type)
+
+
+async def afetch_by_ids(name, ids, projection, query=None):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    cursor = get_async_db()[name].find({**(query or {}), 'id': {'$in': ids}}, projection)
+    return {doc['id']: doc async for doc in cursor}
+
+
+class AsyncAPIView(View):
+    """Authentication, permissions and request parsing as DRF does them for ``sync_view``."""
+    sync_view = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token-authenticated like the DRF views, which are CSRF-exempt too
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.jwt_payload = None
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            try:
+                request.jwt_payload = await adecode_token(header.split(' ', 1)[1].strip())
+            except jwt.InvalidTokenError:
+                return render({'detail': 'Invalid token'}, 403)
+        # Set here so permissions never reach the session-backed lazy user
+        request.user = AuthUser(request.jwt_payload) if request.jwt_payload else AnonymousUser()
+        for permission in self.sync_view.permission_classes:
+            if not permission().has_permission(request, self):
+                if request.jwt_payload is None:
+                    return render({'detail': 'Authentication credentials were not provided.'}, 403)
+                return render({'detail': 'You do not have permission to perform this action.'}, 403)
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            try:
+                request.data = self.parse(request.body)
+            except ParseError as e:
+                return render({'detail': str(e.detail)}, 400)
+        return await super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def parse(body):
+        if not body:
+            return {}
+        return api_settings.DEFAULT_PARSER_CLASSES[0]().parse(io.BytesIO(body))
+
+    async def sync_write(self, request, *args, **kwargs):
+        """Let the sync view handle this request, off the event loop.
+
+        Not thread-sensitive: the views hold no thread-bound state, and the
+        default would queue every fallback write on one shared thread.
+        """
+        response = await sync_to_async(self.sync_view.as_view(), thread_sensitive=False)(request, *args, **kwargs)
+        return await sync_to_async(response.render, thread_sensitive=False)()
+
+
+class AsyncCrudView(AsyncAPIView):
+    """``BaseCrudView`` on the event loop; ``sync_view`` is the view it stands in for."""
+
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        self.crud = self.sync_view()
+
+    def coll(self, route=None):
+        return get_async_collection(self.crud.collection_name, route)
+
+    def custom_write(self, method):
+        return getattr(self.sync_view, method) is not getattr(BaseCrudView, method)
+
+    async def get(self, request, id=None):
+        scope = owner_scope(self.crud, request)
+        if scope is None:
+            return render({'detail': 'Authentication required'}, 401)
+        names = [self.crud.collection_name]
+        if request.GET.get('expand'):
+            names += sorted(set(self.crud.references.values()))
+        revisions = await clock.aget(names)
+        return await etags.aconditional(request, revisions, lambda: self.read(request, id, scope),
+                                        *self.crud.validators(id, scope))
+
+    async def read(self, request, id, scope):
+        crud = self.crud
+        try:
+            expand = crud.expansions(request)
+            projection = crud.projection(request, summary=not id, expand=expand)
+        except ValueError as e:
+            return render({'detail': str(e)}, 400)
+        if id:
+            doc = await self.coll().find_one({'id': id, **scope}, projection)
+            if not doc:
+                return render(None, 404)
+            return render((await self.expand([clean_doc(doc)], expand))[0])
+        try:
+            query = {**filters.build_query(crud.filter_fields, request.GET), **scope}
+        except ValueError as e:
+            return render({'detail': str(e)}, 400)
+        page, page_size = page_params(request)
+        if 'ids' in request.GET:
+            ids = [i.strip() for i in request.GET['ids'].split(',') if i.strip()]
+            if len(ids) > MAX_IDS:
+                return render({'detail': f'At most {MAX_IDS} ids per request'}, 400)
+            found = await afetch_by_ids(crud.collection_name, ids, projection, query)
+            return render(await self.expand([clean_doc(found[i]) for i in dict.fromkeys(ids) if i in found], expand))
+        q = request.GET.get('q')
+        if q:
+            return await self.search_page(query, q, request, page, page_size, projection, expand)
+        if 'cursor' in request.GET:
+            try:
+                query, sort, projection = crud.keyset(query, request.GET.get('cursor'), projection)
+            except ValueError:
+                return render({'detail': 'Invalid cursor'}, 400)
+            docs = await self.coll('list').find(query, projection).sort(sort).limit(page_size + 1).to_list(None)
+            docs, next_cursor = crud.cursor_results(docs, page_size)
+            return render({'results': await self.expand(docs, expand), 'next_cursor': next_cursor})
+        cursor = self.coll('list').find(query, projection).skip((page - 1) * page_size).limit(page_size)
+        return render(await self.expand([clean_doc(d) async for d in cursor], expand))
+
+    async def search_page(self, scope, q, request, page, page_size, projection, expand):
+        try:
+            offset = search_offset(request, page, page_size)
+        except ValueError:
+            return render({'detail': 'Invalid cursor'}, 400)
+        ids, truncated = await search.asearch(self.crud.collection_name, q, search_limit(offset, page_size))
+        if scope and ids:
+            allowed = set(await afetch_by_ids(self.crud.collection_name, ids, {'id': 1}, scope))
+            ids = [doc_id for doc_id in ids if doc_id in allowed]
+        page_ids = ids[offset:offset + page_size]
+        found = await afetch_by_ids(self.crud.collection_name, page_ids, projection, scope)
+        docs = await self.expand([clean_doc(found[doc_id]) for doc_id in page_ids if doc_id in found], expand)
+        if 'cursor' not in request.GET:
+            response = render(docs)
+            if truncated:
+                response['X-Search-Truncated'] = 'true'
+            return response
+        more = offset + page_size < len(ids) or truncated
+        return render({'results': docs, 'next_cursor': encode_cursor({'o': offset + page_size}) if more else None,
+                       'truncated': truncated})
+
+    async def expand(self, docs, fields):
+        if not fields or not docs:
+            return docs
+        found = {name: await afetch_by_ids(name, ids, CRUD_VIEWS[name].expand_projection())
+                 for name, ids in self.crud.referenced_ids(docs, fields).items()}
+        return self.crud.embed(docs, fields, found)
+
+    async def post(self, request):
+        if self.custom_write('post'):
+            return await self.sync_write(request)
+        name = self.crud.collection_name
+        data = dict(request.data)
+        async with areserved_revision(name) as rev:
+            data[REVISION_FIELD] = rev
+            await self.coll().insert_one(data)
+        inserted = await self.coll().find_one({'id': data.get('id')})
+        documents.invalidate(name, data.get('id'))
+        await search.aindex_document(name, inserted)
+        return render(clean_doc(inserted or data), 201)
+
+    async def put(self, request, id):
+        if self.custom_write('put'):
+            return await self.sync_write(request, id=id)
+        crud = self.crud
+        scope = owner_scope(crud, request)
+        if scope is None:
+            return render({'detail': 'Authentication required'}, 401)
+        data = dict(request.data)
+        data.pop('_id', None)
+        data.pop(REVISION_FIELD, None)
+        update_data, unset_data = split_update(data)
+        update_op = {}
+        if update_data or unset_data:
+            update_op['$set'] = update_data
+        if unset_data:
+            update_op['$unset'] = unset_data
+        if update_op:
+            async with areserved_revision(crud.collection_name) as rev:
+                update_data[REVISION_FIELD] = rev
+                res = await self.coll().update_one({'id': id, **scope}, update_op)
+            if res.matched_count == 0:
+                return render(None, 404)
+            documents.invalidate(crud.collection_name, id)
+        updated = await self.coll().find_one({'id': id, **scope})
+        if updated:
+            await search.aindex_document(crud.collection_name, updated)
+            clean_doc(updated)
+            for field in crud.private_fields:
+                updated.pop(field, None)
+        return render(updated or {k: v for k, v in data.items() if k not in crud.private_fields})
+
+    async def delete(self, request, id):
+        if self.custom_write('delete'):
+            return await self.sync_write(request, id=id)
+        name = self.crud.collection_name
+        scope = owner_scope(self.crud, request)
+        if scope is None:
+            return render({'detail': 'Authentication required'}, 401)
+        async with areserved_revision(name) as rev:
+            res = await self.coll().delete_one({'id': id, **scope})
+            if res.deleted_count:
+                await arecord_delete(name, id, rev)
+        if res.deleted_count == 0:
+            return render(None, 404)
+        documents.invalidate(name, id)
+        await search.aremove_document(name, id)
+        return render(None, 204)
+
+
+class AsyncChatView(AsyncAPIView):
+    """``ChatView`` on the event loop; ``sync_view`` gives the chat type and URL kwarg."""
+
+    async def get(self, request, **kwargs):
+        chat_id = kwargs[self.sync_view.key_field]
+        revisions = await clock.aget([chats.chat_revision(self.sync_view.chat_type, chat_id)])
+        return await etags.aconditional(request, revisions, lambda: self.history(request, chat_id))
+
+    async def history(self, request, chat_id):
+        limit = self.sync_view.history_limit(request)
+        try:
+            messages, has_more = await chats.ahistory(self.sync_view.chat_type, chat_id, request.GET.get('before'), limit)
+        except LookupError:
+            return render({'detail': 'Unknown message in before'}, 400)
+        return render({self.sync_view.key_field: chat_id, 'messages': messages, 'hasMore': has_more})
+
+    async def post(self, request, **kwargs):
+        chat_id = kwargs[self.sync_view.key_field]
+        msg = await chats.apost_message(self.sync_view.chat_type, chat_id, request.data)
+        return render({self.sync_view.key_field: chat_id, 'messages': [msg]}, 201)
+
+    async def delete(self, request, **kwargs):
+        message_id = request.GET.get('messageId')
+        if not message_id:
+            return render({'detail': 'messageId required'}, 400)
+        await chats.adelete_message(self.sync_view.chat_type, kwargs[self.sync_view.key_field], message_id)
+        return render(None, 204)
@@ -1,9 +1,33 @@
 import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
 import jwt
 from django.conf import settings
 from rest_framework.authentication import BaseAuthentication
 from rest_framework import exceptions
 
+from .mongo import get_async_collection, get_collection
+from .revisions import clock, next_revision
+
+TOKEN_LIFETIME = datetime.timedelta(hours=12)
+# user id -> notBeforeMs: tokens that user was issued earlier are rejected
+REVOCATIONS = 'token_revocations'
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def issued_ms(payload) -> int:
+    """When the token was issued, in ms; tokens from before the ``iat_ms``
+    claim only carry whole seconds and count from the start of theirs."""
+    if 'iat_ms' in payload:
+        return payload['iat_ms']
+    return payload.get('iat', 0) * 1000
+
 
 class AuthUser:
     def __init__(self, payload: dict):
@@ -17,6 +41,115 @@ class AuthUser:
         return True
 
 
+class TokenCache:
+    """Verified token payloads keyed by the token's SHA-256 digest.
+
+    The SPA sends the same token with every request, so the HMAC check and
+    claim parsing run once per token rather than once per request. Entries
+    leave at the token's ``exp`` or when the LRU is full. Revocations
+    (``revoke_user``) are stored in Mongo and picked up by other workers
+    through the revision clock; both sides are compared in milliseconds
+    (the token's ``iat_ms`` claim), so a token issued right after a
+    revocation is not caught by it. Async callers use ``averify``, which
+    reads revocations through motor instead of blocking the event loop.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # digest -> payload
+        self._not_before = {}
+        self._revision = None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def verify(self, token: str) -> dict:
+        self._sync_revocations()
+        return self._check(token)
+
+    async def averify(self, token: str) -> dict:
+        await self._async_sync_revocations()
+        return self._check(token)
+
+    def _check(self, token):
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            payload = self._entries.get(digest)
+            if payload is not None and payload.get('exp', 0) > time.time():
+                self._entries.move_to_end(digest)
+                self._stats['hits'] += 1
+            else:
+                payload = None
+                self._entries.pop(digest, None)
+                self._stats['misses'] += 1
+        if payload is None:
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+            with self._lock:
+                self._entries[digest] = payload
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if issued_ms(payload) < self._not_before.get(payload.get('sub'), 0):
+            raise jwt.InvalidTokenError('Token revoked')
+        return payload
+
+    def revoke_user(self, user_id):
+        """Reject every token issued to ``user_id`` until now, in all workers."""
+        not_before = now_ms()
+        get_collection(REVOCATIONS).update_one({'_id': user_id}, {'$set': {'notBeforeMs': not_before}, '$unset': {'notBefore': ''}}, upsert=True)
+        next_revision(REVOCATIONS)
+        with self._lock:
+            self._not_before[user_id] = not_before
+            for digest in [d for d, p in self._entries.items() if p.get('sub') == user_id]:
+                del self._entries[digest]
+
+    def _sync_revocations(self):
+        revision = clock.get([REVOCATIONS])[REVOCATIONS]
+        if revision != self._revision:
+            self._load_revocations(get_collection(REVOCATIONS).find(self._revocations_query()), revision)
+
+    async def _async_sync_revocations(self):
+        revision = (await clock.aget([REVOCATIONS]))[REVOCATIONS]
+        if revision != self._revision:
+            docs = await get_async_collection(REVOCATIONS).find(self._revocations_query()).to_list(None)
+            self._load_revocations(docs, revision)
+
+    @staticmethod
+    def _revocations_query():
+        # Revocations older than a token's lifetime no longer matter
+        cutoff = now_ms() - int(TOKEN_LIFETIME.total_seconds() * 1000)
+        # (notBefore: revocations stored in float seconds before notBeforeMs)
+        return {'$or': [{'notBeforeMs': {'$gt': cutoff}}, {'notBefore': {'$gt': cutoff / 1000}}]}
+
+    def _load_revocations(self, docs, revision):
+        self._not_before = {doc['_id']: doc.get('notBeforeMs', int(doc.get('notBefore', 0) * 1000)) for doc in docs}
+        self._revision = revision
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._revision = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), revoked_users=len(self._not_before))
+
+
+tokens = TokenCache(max_entries=settings.JWT_CACHE_MAX_ENTRIES)
+
+
+def decode_token(token: str) -> dict:
+    """Verify a token and return its payload; raises jwt.InvalidTokenError."""
+    return tokens.verify(token)
+
+
+async def adecode_token(token: str) -> dict:
+    """``decode_token`` for code running on the event loop."""
+    return await tokens.averify(token)
+
+
+def revoke_user_tokens(user_id):
+    tokens.revoke_user(user_id)
+
+
 class JWTAuthentication(BaseAuthentication):
     keyword = 'Bearer'
 
@@ -26,7 +159,7 @@ class JWTAuthentication(BaseAuthentication):
             return None
         token = auth_header.split(' ', 1)[1].strip()
         try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+            payload = decode_token(token)
         except jwt.InvalidTokenError:
             raise exceptions.AuthenticationFailed('Invalid token')
         # Attach payload and return an authenticated stand-in user
@@ -35,12 +168,14 @@ class JWTAuthentication(BaseAuthentication):
 
 
 def create_token(user_doc: dict) -> str:
+    issued = now_ms()
     payload = {
         'sub': user_doc['id'],
         'email': user_doc['email'],
         'role': user_doc['role'],
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=12),
-        'iat': datetime.datetime.utcnow(),
+        'exp': issued // 1000 + int(TOKEN_LIFETIME.total_seconds()),
+        'iat': issued // 1000,
+        'iat_ms': issued,
     }
     return jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
 
@@ -0,0 +1,109 @@
+"""Process-local read-through cache for hot reference documents.
+
+Users, teams and projects are read by id on every chat message (sender
+name, team and project members) and every token refresh, but rarely
+change. ``get_document`` serves them from an LRU keyed by
+(collection, id), with entries living at most DOC_CACHE_TTL_SECONDS.
+
+Writes in this process invalidate their entry directly. Writes in other
+workers are picked up through the revision counters (see core.revisions):
+at most every DOC_CACHE_SYNC_INTERVAL_MS a read compares the counters with
+the ones last seen and drops whatever changed or was deleted since.
+Cached documents are shared; callers must not modify them.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .mongo import get_db
+from .revisions import REVISION_FIELD, current_revisions, deleted_since
+
+CACHED_COLLECTIONS = ('users', 'teams', 'projects')
+
+
+class DocumentCache:
+    def __init__(self, max_entries, ttl, sync_interval):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self._entries = OrderedDict()  # (collection, id) -> (expires_at, doc)
+        self._lock = threading.Lock()
+        self._revisions = None
+        self._next_sync = 0.0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'remote_invalidations': 0}
+
+    def get(self, name, doc_id):
+        """The document ``name``/``doc_id`` (None if missing), from cache when possible."""
+        if not doc_id:
+            return None
+        if name not in CACHED_COLLECTIONS:
+            return get_db()[name].find_one({'id': doc_id})
+        self._sync()
+        key = (name, doc_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+        doc = get_db()[name].find_one({'id': doc_id})
+        if doc is not None:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, doc)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return doc
+
+    def invalidate(self, name, doc_id):
+        with self._lock:
+            if self._entries.pop((name, doc_id), None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._revisions = None
+
+    def _sync(self):
+        """Drop entries other workers changed, at most once per sync interval."""
+        if not self.sync_interval:
+            return
+        now = time.monotonic()
+        if now < self._next_sync:
+            return
+        self._next_sync = now + self.sync_interval
+        seen = self._revisions
+        latest = current_revisions(CACHED_COLLECTIONS)
+        self._revisions = latest
+        if seen is None:
+            # First look: nothing cached predates these counters
+            return
+        for name in CACHED_COLLECTIONS:
+            if latest[name] <= seen.get(name, 0):
+                continue
+            changed = get_db()[name].find({REVISION_FIELD: {'$gt': seen.get(name, 0)}}, {'_id': 0, 'id': 1})
+            ids = [doc.get('id') for doc in changed] + deleted_since(name, seen.get(name, 0))
+            with self._lock:
+                for doc_id in ids:
+                    if self._entries.pop((name, doc_id), None) is not None:
+                        self._stats['remote_invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), max_entries=self.max_entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+documents = DocumentCache(
+    max_entries=settings.DOC_CACHE_MAX_ENTRIES,
+    ttl=settings.DOC_CACHE_TTL_SECONDS,
+    sync_interval=settings.DOC_CACHE_SYNC_INTERVAL_MS / 1000,
+)
@@ -0,0 +1,330 @@
+"""Standalone channel broker shared by every worker process.
+
+``core.layers.BrokerChannelLayer`` connects each Daphne/gunicorn worker to
+one broker (``python manage.py run_channel_broker``) over a Unix socket or
+TCP. The broker is where groups and queued messages live, so a
+``group_send`` in one process reaches sockets held by any other.
+
+Wire format: every frame is a 4-byte big-endian length followed by a UTF-8
+JSON object. Requests carry an ``id`` that the reply echoes. Message bodies
+travel as already-encoded JSON strings that the broker never parses, so a
+group send is encoded once however many members the group has.
+
+Security: a connection's first frame must be ``hello``, carrying the shared
+CHANNEL_BROKER_SECRET when the broker has one; anything else drops the
+connection. Frames are not encrypted. A unix:// socket only reaches
+workers on the same host, and TCP is meant for loopback (the default host):
+the broker refuses to listen on any other address without a secret. Workers
+spread across hosts should use CHANNEL_LAYER=redis, or TCP with a secret
+only over a private network that is itself encrypted (VPN, WireGuard).
+"""
+import asyncio
+import collections
+import hmac
+import ipaddress
+import json
+import os
+import re
+import struct
+import time
+from urllib.parse import urlparse
+
+HEADER = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+# Drop a client whose unread replies pile up beyond this many bytes
+MAX_CLIENT_BUFFER = 32 * 1024 * 1024
+SWEEP_INTERVAL = 1.0
+OPS = frozenset({'hello', 'send', 'group_add', 'group_discard', 'group_send', 'receive', 'cancel', 'flush'})
+
+
+def parse_url(url):
+    """``unix:///path.sock`` -> ('unix', path); ``tcp://host:port`` -> ('tcp', (host, port))."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'unix':
+        return 'unix', parsed.path
+    if parsed.scheme == 'tcp':
+        return 'tcp', (parsed.hostname or '127.0.0.1', parsed.port or 6380)
+    raise ValueError(f'Unsupported channel broker URL: {url}')
+
+
+async def open_connection(url):
+    kind, address = parse_url(url)
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def encode_frame(obj):
+    data = json.dumps(obj, separators=(',', ':')).encode()
+    return HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader):
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME:
+        raise ValueError(f'Frame of {size} bytes exceeds {MAX_FRAME}')
+    return json.loads(await reader.readexactly(size))
+
+
+class _Session:
+    """One connected layer (one event loop in one worker process)."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.token = None
+        self.capacity = 100
+        self.channel_capacity = []
+        self.expiry = 60
+        self.group_expiry = 86400
+        self.waiting = {}  # request id -> channel
+        self.authenticated = False
+        self.closed = False
+
+    def configure(self, frame):
+        self.token = frame.get('token')
+        self.capacity = frame.get('capacity', self.capacity)
+        self.channel_capacity = [(re.compile(p), n) for p, n in frame.get('channel_capacity', [])]
+        self.expiry = frame.get('expiry', self.expiry)
+        self.group_expiry = frame.get('group_expiry', self.group_expiry)
+
+    def get_capacity(self, channel):
+        for pattern, capacity in self.channel_capacity:
+            if pattern.match(channel):
+                return capacity
+        return self.capacity
+
+    def reply(self, frame):
+        if self.closed:
+            return
+        self.writer.write(encode_frame(frame))
+        if self.writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            # The worker stopped reading; cut it loose rather than grow forever
+            self.closed = True
+            self.writer.transport.abort()
+
+
+class Broker:
+    """Channels, groups and pending receives for all connected workers.
+
+    Capacity and expiry come from the sending worker's layer config, as
+    with the other Channels backends. Expired messages are swept once a
+    second rather than on every receive; as in ``InMemoryChannelLayer``, a
+    channel whose message expired unread is dropped from its groups.
+    """
+
+    def __init__(self, secret=''):
+        self.secret = secret
+        self.queues = {}   # channel -> deque of (deadline, body)
+        self.waiters = {}  # channel -> deque of (session, request id)
+        self.groups = {}   # group -> {channel: deadline}
+        self.sessions = set()
+        self._handlers = set()
+        self.counters = collections.Counter()
+
+    # Server
+
+    async def start(self, url):
+        kind, address = parse_url(url)
+        if kind == 'unix':
+            if os.path.exists(address):
+                os.unlink(address)
+            server = await asyncio.start_unix_server(self._serve, address)
+        else:
+            if not self.secret and not _is_loopback(address[0]):
+                raise ValueError(f'Refusing to listen on {address[0]} without CHANNEL_BROKER_SECRET')
+            server = await asyncio.start_server(self._serve, *address)
+        self._sweeper = asyncio.get_running_loop().create_task(self._sweep_forever())
+        return server
+
+    async def serve_forever(self, url):
+        server = await self.start(url)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        """Stop sweeping and disconnect every worker (the server is closed separately)."""
+        self._sweeper.cancel()
+        for session in list(self.sessions):
+            session.writer.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers, timeout=1)
+
+    async def _serve(self, reader, writer):
+        session = _Session(writer)
+        self.sessions.add(session)
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            while not session.closed:
+                self.handle(session, await read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            session.closed = True
+            self.sessions.discard(session)
+            self._forget(session)
+            self._handlers.discard(handler)
+            writer.close()
+
+    def handle(self, session, frame):
+        if not isinstance(frame, dict):
+            frame = {}
+        op = frame.get('op')
+        # Count only known ops, so junk frames cannot grow the counters
+        self.counters[f'{op}_frames' if op in OPS else 'invalid_frames'] += 1
+        if not session.authenticated:
+            self.authenticate(session, frame)
+            return
+        try:
+            self.dispatch(session, frame, op)
+        except (KeyError, TypeError, ValueError) as error:
+            # A malformed request gets an error reply rather than dropping the connection
+            self.counters['invalid_frames'] += 1
+            session.reply({'id': frame.get('id'), 'error': f'malformed {op!r} frame: missing or invalid {error}'})
+
+    def dispatch(self, session, frame, op):
+        if op == 'send':
+            full = not self.deliver(frame['channel'], frame['body'], session)
+            session.reply({'id': frame['id'], 'full': full})
+        elif op == 'group_add':
+            expiry = frame.get('expiry', session.group_expiry)
+            self.groups.setdefault(frame['group'], {})[frame['channel']] = time.time() + expiry
+            session.reply({'id': frame['id']})
+        elif op == 'group_discard':
+            members = self.groups.get(frame['group'], {})
+            members.pop(frame['channel'], None)
+            if not members:
+                self.groups.pop(frame['group'], None)
+            session.reply({'id': frame['id']})
+        elif op == 'group_send':
+            # A batch of [group, body] pairs from one event-loop tick
+            for group, body in frame['sends']:
+                self.counters['group_sends'] += 1
+                for channel in list(self.groups.get(group, ())):
+                    self.deliver(channel, body, session)
+            session.reply({'id': frame['id']})
+        elif op == 'receive':
+            self.receive(session, frame['id'], frame['channel'])
+        elif op == 'cancel':
+            channel = session.waiting.pop(frame['ref'], None)
+            if channel is not None:
+                waiters = self.waiters.get(channel, ())
+                if (session, frame['ref']) in waiters:
+                    waiters.remove((session, frame['ref']))
+                    if not waiters:
+                        del self.waiters[channel]
+        elif op == 'flush':
+            self.queues.clear()
+            self.groups.clear()
+            session.reply({'id': frame['id']})
+        else:
+            session.reply({'id': frame.get('id'), 'error': f'unknown op {op!r}'})
+
+    def authenticate(self, session, frame):
+        if frame.get('op') == 'hello' and hmac.compare_digest(str(frame.get('secret', '')).encode(), self.secret.encode()):
+            session.authenticated = True
+            session.configure(frame)
+            session.reply({'id': frame.get('id')})
+            return
+        self.counters['rejected_connections'] += 1
+        session.reply({'id': frame.get('id'), 'error': 'authentication failed'})
+        session.closed = True
+        session.writer.close()
+
+    def deliver(self, channel, body, sender):
+        """Hand ``body`` to a waiting receive or queue it; False if the channel is full."""
+        waiters = self.waiters.get(channel)
+        while waiters:
+            session, request_id = waiters.popleft()
+            if not waiters:
+                del self.waiters[channel]
+            if session.closed or session.waiting.pop(request_id, None) is None:
+                continue
+            session.reply({'id': request_id, 'body': body})
+            self.counters['delivered'] += 1
+            return True
+        queue = self.queues.setdefault(channel, collections.deque())
+        if len(queue) >= sender.get_capacity(channel):
+            self.counters['dropped_full'] += 1
+            return False
+        queue.append((time.time() + sender.expiry, body))
+        return True
+
+    def receive(self, session, request_id, channel):
+        queue = self.queues.get(channel)
+        now = time.time()
+        while queue:
+            deadline, body = queue.popleft()
+            if not queue:
+                del self.queues[channel]
+            if deadline >= now:
+                session.reply({'id': request_id, 'body': body})
+                self.counters['delivered'] += 1
+                return
+            self.counters['expired'] += 1
+        session.waiting[request_id] = channel
+        self.waiters.setdefault(channel, collections.deque()).append((session, request_id))
+
+    def _forget(self, session):
+        """Drop what a disconnected worker owned: its receives, channels and memberships."""
+        for request_id, channel in session.waiting.items():
+            waiters = self.waiters.get(channel)
+            if waiters and (session, request_id) in waiters:
+                waiters.remove((session, request_id))
+                if not waiters:
+                    del self.waiters[channel]
+        session.waiting.clear()
+        if not session.token:
+            return
+        marker = f'.{session.token}!'
+        for channel in [c for c in self.queues if marker in c]:
+            del self.queues[channel]
+        for group in list(self.groups):
+            members = self.groups[group]
+            for channel in [c for c in members if marker in c]:
+                del members[channel]
+            if not members:
+                del self.groups[group]
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        expired = set()
+        for channel in list(self.queues):
+            queue = self.queues[channel]
+            while queue and queue[0][0] < now:
+                queue.popleft()
+                expired.add(channel)
+                self.counters['expired'] += 1
+            if not queue:
+                del self.queues[channel]
+        for group in list(self.groups):
+            members = self.groups[group]
+            for channel, deadline in list(members.items()):
+                if deadline < now or channel in expired:
+                    del members[channel]
+            if not members:
+                del self.groups[group]
+
+    def stats(self):
+        return {
+            **self.counters,
+            'sessions': len(self.sessions),
+            'channels_queued': len(self.queues),
+            'messages_queued': sum(len(q) for q in self.queues.values()),
+            'receivers_waiting': sum(len(w) for w in self.waiters.values()),
+            'groups': len(self.groups),
+        }
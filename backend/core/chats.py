@@ -0,0 +1,237 @@
+"""Chat message storage: one document per message in ``chat_messages``.
+
+Messages are keyed by (chatType, chatId, id) and read newest-first through
+the (chatType, chatId, timestamp, id) index, so posting is one small insert
+and history pages cost the same however long a chat gets.
+
+Both the REST chat views and ChatConsumer post through this module; the
+consumer goes through ``ChatWriter`` to group-commit busy rooms.
+"""
+import asyncio
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .mongo import get_async_collection, get_collection
+from .revisions import anext_revision, bump_revisions, next_revision
+from .notifications import dispatcher, story_chat_notifications, project_chat_notifications
+
+MESSAGES = 'chat_messages'
+# Chat type -> builder of notification drafts for a new message
+NOTIFIERS = {
+    'story': story_chat_notifications,
+    'project': project_chat_notifications,
+}
+CHAT_TYPES = tuple(NOTIFIERS)
+DUPLICATE_KEY = 11000
+# Keys stored alongside each message but not part of it (copy before use:
+# mongomock edits projections in place while applying them)
+_ROUTING_FIELDS = {'_id': 0, 'chatType': 0, 'chatId': 0}
+NEWEST_FIRST = [('timestamp', -1), ('id', -1)]
+
+
+def messages():
+    return get_collection(MESSAGES)
+
+
+def chat_revision(chat_type, chat_id):
+    """Name of the revision counter bumped by every change to one chat."""
+    return f'{MESSAGES}:{chat_type}:{chat_id}'
+
+
+def message_upsert(chat_type, chat_id, message):
+    """Filter and update for an idempotent insert of ``message``."""
+    message = dict(message)
+    message.pop('_id', None)
+    if not message.get('id'):
+        message['id'] = f'msg-{uuid.uuid4().hex}'
+    key = {'chatType': chat_type, 'chatId': chat_id, 'id': message['id']}
+    return key, {'$setOnInsert': {k: v for k, v in message.items() if k != 'id'}}, message
+
+
+def append_message(chat_type, chat_id, message):
+    """Store one message; re-sending the same message id is a no-op."""
+    key, update, message = message_upsert(chat_type, chat_id, message)
+    messages().update_one(key, update, upsert=True)
+    next_revision(chat_revision(chat_type, chat_id))
+    return message
+
+
+async def aappend_message(chat_type, chat_id, message):
+    key, update, message = message_upsert(chat_type, chat_id, message)
+    await get_async_collection(MESSAGES).update_one(key, update, upsert=True)
+    await anext_revision(chat_revision(chat_type, chat_id))
+    return message
+
+
+def notify(chat_type, chat_id, message):
+    """Queue notifications for the chat's audience (excluding the sender)."""
+    dispatcher.submit(chat_id, NOTIFIERS[chat_type], chat_id, message)
+
+
+async def anotify(chat_type, chat_id, message):
+    await dispatcher.asubmit(chat_id, NOTIFIERS[chat_type], chat_id, message)
+
+
+def post_message(chat_type, chat_id, message):
+    message = append_message(chat_type, chat_id, message)
+    notify(chat_type, chat_id, message)
+    return message
+
+
+async def apost_message(chat_type, chat_id, message):
+    message = await aappend_message(chat_type, chat_id, message)
+    await anotify(chat_type, chat_id, message)
+    return message
+
+
+def delete_message(chat_type, chat_id, message_id):
+    if messages().delete_one({'chatType': chat_type, 'chatId': chat_id, 'id': message_id}).deleted_count:
+        next_revision(chat_revision(chat_type, chat_id))
+
+
+async def adelete_message(chat_type, chat_id, message_id):
+    res = await get_async_collection(MESSAGES).delete_one({'chatType': chat_type, 'chatId': chat_id, 'id': message_id})
+    if res.deleted_count:
+        await anext_revision(chat_revision(chat_type, chat_id))
+
+
+def history(chat_type, chat_id, before=None, limit=200):
+    """Return ``(messages, has_more)``: up to ``limit`` messages, oldest first.
+
+    ``before`` is a message id; only messages older than it are returned.
+    Raises LookupError if that message does not exist.
+    """
+    query = {'chatType': chat_type, 'chatId': chat_id}
+    if before:
+        anchor = messages().find_one({**query, 'id': before}, {'timestamp': 1})
+        if not anchor:
+            raise LookupError(before)
+        query['$or'] = _older_than(anchor, before)
+    cursor = messages().find(query, dict(_ROUTING_FIELDS)).sort(NEWEST_FIRST).limit(limit + 1)
+    return _history_page(list(cursor), limit)
+
+
+async def ahistory(chat_type, chat_id, before=None, limit=200):
+    query = {'chatType': chat_type, 'chatId': chat_id}
+    if before:
+        anchor = await get_async_collection(MESSAGES).find_one({**query, 'id': before}, {'timestamp': 1})
+        if not anchor:
+            raise LookupError(before)
+        query['$or'] = _older_than(anchor, before)
+    cursor = get_async_collection(MESSAGES).find(query, dict(_ROUTING_FIELDS)).sort(NEWEST_FIRST).limit(limit + 1)
+    return _history_page(await cursor.to_list(None), limit)
+
+
+def _older_than(anchor, anchor_id):
+    ts = anchor.get('timestamp')
+    return [{'timestamp': {'$lt': ts}}, {'timestamp': ts, 'id': {'$lt': anchor_id}}]
+
+
+def _history_page(docs, limit):
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    docs.reverse()
+    return docs, has_more
+
+
+class ChatWriter:
+    """Group commit for WebSocket chat messages.
+
+    Messages arriving within ``interval`` seconds of each other (or until
+    ``max_batch`` accumulate) are written with a single unordered
+    ``bulk_write``. ``write`` only returns once the batch holding the message
+    is stored, so nothing is broadcast or acknowledged before it is durable.
+
+    Writes run on a dedicated pool of ``workers`` threads rather than
+    Django's single thread-sensitive sync thread, which every
+    ``database_sync_to_async`` call in the process queues behind. With
+    ``workers=0`` they go through that shared thread instead.
+    """
+
+    def __init__(self, interval, max_batch, workers):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.workers = workers
+        self._loop = None
+        self._pending = []
+        self._timer = None
+        self._executor = None
+        self._executor_pid = None
+
+    async def write(self, chat_type, chat_id, message):
+        key, update, message = message_upsert(chat_type, chat_id, message)
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Pending work belongs to a loop that no longer runs (tests)
+            self._loop, self._pending, self._timer = loop, [], None
+        done = loop.create_future()
+        self._pending.append((UpdateOne(key, update, upsert=True), chat_revision(chat_type, chat_id), done))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self._flush)
+        await done
+        return message
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._loop.create_task(self._commit(batch))
+
+    async def _commit(self, batch):
+        errors = {}
+        try:
+            await self._run_write([op for op, _, _ in batch], [name for _, name, _ in batch])
+        except BulkWriteError as e:
+            # Duplicate keys are re-sent messages: already stored, so fine
+            errors = {err['index']: e for err in e.details.get('writeErrors', []) if err.get('code') != DUPLICATE_KEY}
+        except Exception as e:
+            errors = dict.fromkeys(range(len(batch)), e)
+        for i, (_, _, done) in enumerate(batch):
+            if done.done():
+                continue
+            if i in errors:
+                done.set_exception(errors[i])
+            else:
+                done.set_result(None)
+
+    async def _run_write(self, ops, revisions):
+        if not self.workers:
+            return await database_sync_to_async(self._persist)(ops, revisions)
+        if self._executor_pid != os.getpid():
+            # Executor threads do not survive a fork
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='chat-persist')
+            self._executor_pid = os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._persist, ops, revisions)
+
+    def _persist(self, ops, revisions):
+        try:
+            self._bulk_write(ops)
+        finally:
+            # Even a partly failed batch may have stored some messages
+            bump_revisions(revisions)
+
+    @staticmethod
+    def _bulk_write(ops):
+        messages().bulk_write(ops, ordered=False)
+
+    async def post(self, chat_type, chat_id, message):
+        message = await self.write(chat_type, chat_id, message)
+        await anotify(chat_type, chat_id, message)
+        return message
+
+
+writer = ChatWriter(
+    interval=settings.CHAT_COMMIT_INTERVAL_MS / 1000,
+    max_batch=settings.CHAT_COMMIT_MAX_BATCH,
+    workers=settings.CHAT_PERSIST_WORKERS,
+)
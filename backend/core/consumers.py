@@ -1,17 +1,27 @@
 import json
+import logging
+import time
+from urllib.parse import parse_qs
+import jwt
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .mongo import get_db
+from . import chats, metrics
+from .auth import adecode_token
+from .realtime import notification_group
+
+logger = logging.getLogger(__name__)
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    opened = False
+
     async def connect(self):
         try:
             # Get chat_id and chat_type from URL
             self.chat_id = self.scope['url_route']['kwargs']['chat_id']
             self.chat_type = self.scope['url_route']['kwargs']['chat_type']
             self.room_group_name = f'chat_{self.chat_type}_{self.chat_id}'
-
-            print(f"[Consumer] Connecting to room: {self.room_group_name}")
+            if self.chat_type not in chats.CHAT_TYPES:
+                await self.close()
+                return
 
             # Join room group
             await self.channel_layer.group_add(
@@ -20,13 +30,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
 
             await self.accept()
-            print(f"[Consumer] Connection accepted for room: {self.room_group_name}")
-        except Exception as e:
-            print(f"[Consumer] Error in connect: {e}")
-            import traceback
-            traceback.print_exc()
+            self.opened = True
+            metrics.ws_connects.inc(chat_type=self.chat_type)
+            metrics.ws_open.inc(chat_type=self.chat_type)
+            logger.debug("Connection accepted for room: %s", self.room_group_name)
+        except Exception:
+            logger.exception("Error in connect")
 
     async def disconnect(self, close_code):
+        if self.opened:
+            self.opened = False
+            metrics.ws_disconnects.inc(chat_type=self.chat_type)
+            metrics.ws_open.inc(-1, chat_type=self.chat_type)
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -36,33 +51,38 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # Receive message from WebSocket
     async def receive(self, text_data):
         try:
-            print(f"[Consumer] Received message: {text_data}")
             data = json.loads(text_data)
             message_type = data.get('type')
 
             if message_type == 'chat_message':
-                print(f"[Consumer] Processing chat message for room: {self.room_group_name}")
-                # Save message to database
-                await self.save_message(data)
+                # Save message to database; broadcast only once it is stored
+                try:
+                    data['message'] = await self.save_message(data)
+                except Exception:
+                    metrics.ws_messages.inc(chat_type=self.chat_type, outcome='failed')
+                    await self.send(text_data=json.dumps({
+                        'type': 'chat_error',
+                        'id': (data.get('message') or {}).get('id'),
+                    }))
+                    raise
+                metrics.ws_messages.inc(chat_type=self.chat_type, outcome='stored')
 
-                # Send message to room group
+                # Send message to room group; storedAt (wall clock, as the
+                # receiving consumers may run in other processes) times the fan-out
                 await self.channel_layer.group_send(
                     self.room_group_name,
                     {
                         'type': 'chat_message',
-                        'message': data
+                        'message': data,
+                        'storedAt': time.time(),
                     }
                 )
-                print(f"[Consumer] Message broadcasted to room: {self.room_group_name}")
-        except Exception as e:
-            print(f"[Consumer] Error in receive: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error in receive")
 
     # Receive message from room group
     async def chat_message(self, event):
         try:
-            print(f"[Consumer] Sending message to WebSocket client")
             message = event['message']
 
             # Send message to WebSocket
@@ -70,31 +90,43 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'type': 'chat_message',
                 'message': message
             }))
-            print(f"[Consumer] Message sent to WebSocket client")
-        except Exception as e:
-            print(f"[Consumer] Error in chat_message: {e}")
-            import traceback
-            traceback.print_exc()
-
-    @database_sync_to_async
-    def save_message(self, data):
-        """Save message to MongoDB"""
-        db = get_db()
-        collection_name = f"{data['chat_type']}_chats"
-        collection = db[collection_name]
-        
-        # Find the chat document
-        chat = collection.find_one({"chat_id": data['chat_id']})
-        
-        if chat:
-            # Add message to messages array
-            collection.update_one(
-                {"chat_id": data['chat_id']},
-                {"$push": {"messages": data['message']}}
-            )
-        else:
-            # Create new chat document
-            collection.insert_one({
-                "chat_id": data['chat_id'],
-                "messages": [data['message']]
-            })
+            if 'storedAt' in event:
+                metrics.ws_broadcast_seconds.observe(max(0.0, time.time() - event['storedAt']), chat_type=self.chat_type)
+        except Exception:
+            logger.exception("Error in chat_message")
+
+    async def save_message(self, data):
+        """Store through the same chat service as the REST views (see core.chats)"""
+        return await chats.writer.post(self.chat_type, self.chat_id, data['message'])
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """Pushes new notifications to the authenticated user's open tabs.
+
+    Browsers cannot set headers on a WebSocket handshake, so the JWT is
+    passed as ``?token=``.
+    """
+
+    async def connect(self):
+        self.group_name = None
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        token = (query.get('token') or [''])[0]
+        try:
+            payload = await adecode_token(token)
+        except jwt.InvalidTokenError:
+            await self.close(code=4401)
+            return
+        self.group_name = notification_group(payload.get('sub'))
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.group_name:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    # Receive notification from user group
+    async def notification(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'notification',
+            'notification': event['notification']
+        }))
@@ -0,0 +1,62 @@
+"""Conditional GET: ETags derived from revision counters, not response bodies.
+
+The tag covers the request (path, query string, caller's scope) and the
+revisions of everything the response is built from. Counters come from
+``revisions.clock``, so answering ``304 Not Modified`` does not touch
+Mongo while the clock is fresh.
+
+The clock may lag behind writes (another worker's, or one whose revision is
+still pending), and the body can then hold changes the tag does not name.
+So a 200 is tagged only when the counters, re-read after the body was built,
+still stand where the tag says; otherwise it goes out untagged and the next
+request gets a tag again.
+"""
+import hashlib
+import json
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.response import Response
+
+from .revisions import asettled, settled
+
+
+def make_etag(request, revisions, *extra):
+    basis = json.dumps([request.path, sorted(request.GET.lists()), revisions, extra], sort_keys=True, default=str)
+    return '"%s"' % hashlib.sha1(basis.encode()).hexdigest()
+
+
+def matches(request, etag):
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # Compression middleware may have weakened the tag we sent
+    return etag in (tag.strip().removeprefix('W/') for tag in header.split(','))
+
+
+def conditional(request, revisions, render, *extra):
+    """``render()`` unless the client already holds this exact version."""
+    etag = make_etag(request, revisions, *extra)
+    if matches(request, etag):
+        return tag(Response(status=304), etag)
+    response = render()
+    return tag(response, etag) if response.status_code == 200 and settled(revisions) else response
+
+
+async def aconditional(request, revisions, render, *extra):
+    """``conditional`` for async views: ``render()`` returns an awaitable."""
+    etag = make_etag(request, revisions, *extra)
+    if matches(request, etag):
+        return tag(HttpResponse(status=304), etag)
+    response = await render()
+    return tag(response, etag) if response.status_code == 200 and await asettled(revisions) else response
+
+
+def tag(response, etag):
+    response['ETag'] = etag
+    # Let browsers keep the body but revalidate it on every use
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ('Authorization',))
+    return response
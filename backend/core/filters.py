@@ -0,0 +1,62 @@
+"""Declarative list filters for BaseCrudView (``filter_fields``).
+
+``?field=v`` matches one value (empty = field missing or null),
+``?field__in=a,b`` any of several and ``?field__gte=x`` (also ``gt``, ``lt``,
+``lte``) a range, for the fields and lookups a view declares.
+"""
+
+RANGE_OPS = ('gt', 'gte', 'lt', 'lte')
+
+
+def number(value):
+    return float(value) if '.' in value else int(value)
+
+
+def boolean(value):
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError(f'Not a boolean: {value}')
+
+
+class Filter:
+    """Lookups allowed on one field and how query-string values are parsed."""
+
+    def __init__(self, lookups=('exact', 'in'), cast=str):
+        self.lookups = lookups
+        self.cast = cast
+
+    def parse(self, value):
+        return None if value == '' else self.cast(value)
+
+
+def build_query(spec, params):
+    """Mongo filter for the ``spec`` lookups present in ``params``.
+
+    Raises ValueError for a lookup the spec does not allow or a value that
+    does not parse; parameters naming other fields are left alone.
+    """
+    query = {}
+    for param in params:
+        field, _, lookup = param.partition('__')
+        if field not in spec:
+            continue
+        lookup = lookup or 'exact'
+        allowed = spec[field]
+        if lookup not in allowed.lookups and not (lookup in RANGE_OPS and 'range' in allowed.lookups):
+            raise ValueError(f'Unsupported filter: {param}')
+        value = params.get(param)
+        is_range = lookup in RANGE_OPS
+        if field in query and not (is_range and isinstance(query[field], dict) and '$in' not in query[field]):
+            raise ValueError(f'Conflicting filters on {field}')
+        if lookup == 'exact':
+            query[field] = allowed.parse(value)
+        elif lookup == 'in':
+            query[field] = {'$in': [allowed.parse(v.strip()) for v in value.split(',')]}
+        else:
+            bound = allowed.parse(value)
+            if bound is None:
+                raise ValueError(f'Missing value for {param}')
+            query.setdefault(field, {})[f'${lookup}'] = bound
+    return query
@@ -0,0 +1,79 @@
+"""Password hashing on a small, bounded pool of threads.
+
+PBKDF2 takes tens of milliseconds of CPU per call. Running it inline lets
+a burst of logins occupy every request thread; here at most
+PASSWORD_HASH_WORKERS hashes run at once per process (hashlib releases the
+GIL, so other requests keep being served) and at most
+PASSWORD_HASH_MAX_QUEUE more wait. Anything beyond that is turned away at
+once with a 503 rather than queueing behind the burst.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework.exceptions import APIException
+
+
+class HashingBusy(APIException):
+    status_code = 503
+    default_detail = 'Too many sign-ins at once. Please try again in a moment.'
+    default_code = 'hashing_busy'
+    # DRF turns this into a Retry-After header
+    wait = 1
+
+
+class HashingPool:
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {'completed': 0, 'rejected': 0, 'peak_queued': 0, 'queue_wait_seconds': 0.0}
+
+    def run(self, fn, *args):
+        """``fn(*args)`` on the pool; raises HashingBusy when it is full."""
+        if not self.workers:
+            return fn(*args)
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self._stats['rejected'] += 1
+                raise HashingBusy()
+            self._in_flight += 1
+            self._stats['peak_queued'] = max(self._stats['peak_queued'], self._in_flight - self.workers)
+            if self._executor_pid != os.getpid():
+                # Executor threads do not survive a fork
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                self._executor_pid = os.getpid()
+        queued_at = time.monotonic()
+
+        def task():
+            with self._lock:
+                self._stats['queue_wait_seconds'] += time.monotonic() - queued_at
+            return fn(*args)
+        try:
+            return self._executor.submit(task).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._stats['completed'] += 1
+
+    def make_password(self, password):
+        return self.run(hashers.make_password, password)
+
+    def check_password(self, password, encoded):
+        return self.run(hashers.check_password, password, encoded)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, workers=self.workers, max_queue=self.max_queue,
+                         in_flight=self._in_flight, queued=max(0, self._in_flight - self.workers))
+        stats['avg_queue_wait_ms'] = stats.pop('queue_wait_seconds') / stats['completed'] * 1000 if stats['completed'] else 0.0
+        return stats
+
+
+passwords = HashingPool(workers=settings.PASSWORD_HASH_WORKERS, max_queue=settings.PASSWORD_HASH_MAX_QUEUE)
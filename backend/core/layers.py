@@ -0,0 +1,240 @@
+"""Channel layer backed by ``core.channel_broker``, shared across processes."""
+import asyncio
+import itertools
+import json
+import random
+import string
+import uuid
+import weakref
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .channel_broker import encode_frame, open_connection, read_frame
+
+
+class _BrokerConnection:
+    """One socket to the broker, bound to a single event loop."""
+
+    def __init__(self, layer):
+        self.layer = layer
+        # Channels named "specific.<token>!<suffix>" belong to this
+        # connection; the broker drops them and their memberships with it
+        self.token = uuid.uuid4().hex[:16]
+        self._ids = itertools.count(1)
+        self._replies = {}
+        self._sends = []
+        self._send_timer = None
+        self._writer = None
+        self._reader_task = None
+        self.closed = False
+
+    async def open(self):
+        reader, self._writer = await open_connection(self.layer.url)
+        self._reader_task = asyncio.get_running_loop().create_task(self._read(reader))
+        try:
+            reply = await self.call(
+                'hello',
+                secret=self.layer.secret,
+                token=self.token,
+                capacity=self.layer.capacity,
+                channel_capacity=[(pattern.pattern, n) for pattern, n in self.layer.channel_capacity],
+                expiry=self.layer.expiry,
+                group_expiry=self.layer.group_expiry,
+            )
+        except ConnectionError:
+            await self.close()
+            raise
+        if 'error' in reply:
+            await self.close()
+            raise ConnectionError(f"Channel broker refused the connection: {reply['error']}")
+
+    async def _read(self, reader):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                future = self._replies.pop(frame.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            self._fail(ConnectionError(f'Lost connection to channel broker: {e}'))
+        except asyncio.CancelledError:
+            self._fail(ConnectionError('Channel broker connection closed'))
+            raise
+
+    def _fail(self, error):
+        self.closed = True
+        replies, self._replies = self._replies, {}
+        for future in replies.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def request(self, op, **fields):
+        """Write one request; returns (request id, future of the reply)."""
+        if self.closed:
+            raise ConnectionError('Channel broker connection closed')
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = future
+        self._writer.write(encode_frame({'op': op, 'id': request_id, **fields}))
+        return request_id, future
+
+    async def call(self, op, **fields):
+        _, future = self.request(op, **fields)
+        return await future
+
+    async def receive(self, channel):
+        request_id, future = self.request('receive', channel=channel)
+        try:
+            frame = await future
+        except asyncio.CancelledError:
+            # The consumer went away; stop the broker handing it a message
+            self._replies.pop(request_id, None)
+            if not self.closed:
+                self._writer.write(encode_frame({'op': 'cancel', 'ref': request_id}))
+            raise
+        return frame['body']
+
+    async def group_send(self, group, body):
+        """Queue a group send; sends from the same batch window share one frame."""
+        future = asyncio.get_running_loop().create_future()
+        self._sends.append((group, body, future))
+        if len(self._sends) >= self.layer.batch_size:
+            self._flush_sends()
+        elif self._send_timer is None:
+            self._send_timer = asyncio.get_running_loop().call_later(self.layer.batch_interval, self._flush_sends)
+        await future
+
+    def _flush_sends(self):
+        if self._send_timer is not None:
+            self._send_timer.cancel()
+            self._send_timer = None
+        batch, self._sends = self._sends, []
+        if not batch:
+            return
+        try:
+            _, reply = self.request('group_send', sends=[(group, body) for group, body, _ in batch])
+        except ConnectionError as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        def settle(reply):
+            error = reply.exception() if not reply.cancelled() else ConnectionError('Channel broker connection closed')
+            for _, _, future in batch:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+        reply.add_done_callback(settle)
+
+    async def close(self):
+        self._flush_sends()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """Channels layer whose channels and groups live in a shared broker.
+
+    Configure with the broker ``url`` (``unix:///path.sock`` or
+    ``tcp://host:port``), the broker's shared ``secret`` if it has one, plus
+    the usual ``capacity``, ``channel_capacity``,
+    ``expiry`` and ``group_expiry``. ``group_send`` calls made within
+    ``batch_interval`` seconds of each other (up to ``batch_size``) go to
+    the broker as a single frame.
+
+    Messages must be JSON-serialisable. Each event loop gets its own
+    connection, kept for the life of the loop, so sync code should publish
+    through one long-lived loop (see ``core.realtime``) rather than
+    ``async_to_sync``, which would open a connection per call.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, url, secret='', expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 batch_interval=0.001, batch_size=500, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.url = url
+        self.secret = secret
+        self.group_expiry = group_expiry
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self._connections = weakref.WeakKeyDictionary()
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        pending = self._connections.get(loop)
+        if pending is None or (pending.done() and (pending.exception() or pending.result().closed)):
+            pending = loop.create_task(self._connect())
+            self._connections[loop] = pending
+        return await asyncio.shield(pending)
+
+    async def _connect(self):
+        connection = _BrokerConnection(self)
+        await connection.open()
+        return connection
+
+    @staticmethod
+    def _encode(message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert '__asgi_channel__' not in message
+        return json.dumps(message, separators=(',', ':'))
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        connection = await self._connection()
+        reply = await connection.call('send', channel=channel, body=self._encode(message))
+        if reply.get('full'):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        connection = await self._connection()
+        return json.loads(await connection.receive(channel))
+
+    async def new_channel(self, prefix='specific.'):
+        connection = await self._connection()
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f'{prefix}{connection.token}!{suffix}'
+
+    async def flush(self):
+        connection = await self._connection()
+        await connection.call('flush')
+
+    async def close(self):
+        for pending in list(self._connections.values()):
+            if pending.done() and not pending.exception():
+                await pending.result().close()
+        self._connections.clear()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        connection = await self._connection()
+        await connection.call('group_add', group=group, channel=channel, expiry=self.group_expiry)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        connection = await self._connection()
+        await connection.call('group_discard', group=group, channel=channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Invalid group name'
+        connection = await self._connection()
+        await connection.group_send(group, self._encode(message))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from core.chats import message_upsert, messages
+from core.mongo import get_db
+
+# Legacy collection -> (chat type, field holding the chat id)
+LEGACY_CHATS = {
+    'story_chats': ('story', 'storyId'),
+    'project_chats': ('project', 'projectId'),
+}
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Copy messages from the array-per-chat collections into chat_messages (idempotent).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-legacy', action='store_true',
+                            help='Drop each legacy chat document once its messages are copied.')
+
+    def handle(self, *args, **options):
+        db = get_db()
+        for name, (chat_type, key_field) in LEGACY_CHATS.items():
+            chats = moved = 0
+            for doc in db[name].find({}):
+                # Documents written by the old WebSocket consumer used chat_id
+                chat_id = doc.get(key_field) or doc.get('chat_id')
+                if not chat_id:
+                    continue
+                ops = []
+                for message in doc.get('messages') or []:
+                    key, update, _ = message_upsert(chat_type, chat_id, message)
+                    ops.append(UpdateOne(key, update, upsert=True))
+                for i in range(0, len(ops), BATCH_SIZE):
+                    messages().bulk_write(ops[i:i + BATCH_SIZE], ordered=False)
+                if options['delete_legacy']:
+                    db[name].delete_one({'_id': doc['_id']})
+                chats += 1
+                moved += len(ops)
+            self.stdout.write(f'{name}: {moved} messages from {chats} chats')
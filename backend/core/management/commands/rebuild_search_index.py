@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.search import SEARCH_FIELDS, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ?q= search index from the searchable collections.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collections', nargs='*', help=f'Default: all of {", ".join(SEARCH_FIELDS)}')
+
+    def handle(self, *args, **options):
+        names = options['collections'] or list(SEARCH_FIELDS)
+        unknown = [name for name in names if name not in SEARCH_FIELDS]
+        if unknown:
+            raise CommandError(f'Not searchable: {", ".join(unknown)}')
+        for name in names:
+            self.stdout.write(f'{name}: indexed {rebuild(name)} documents')
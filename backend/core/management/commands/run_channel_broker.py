@@ -0,0 +1,21 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.channel_broker import Broker
+
+
+class Command(BaseCommand):
+    help = 'Run the channel broker that CHANNEL_LAYER=broker workers share.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=settings.CHANNEL_BROKER_URL,
+                            help='unix:///path.sock or tcp://host:port (default: CHANNEL_BROKER_URL)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Channel broker listening on {options['url']}")
+        try:
+            asyncio.run(Broker(secret=settings.CHANNEL_BROKER_SECRET).serve_forever(options['url']))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,356 @@
+"""Process-local request, Mongo and WebSocket metrics in Prometheus text format.
+
+- ``requests``/``request_seconds``: per-route latency, filled by
+  core.middleware.MetricsMiddleware;
+- ``mongo_*``: every command the driver runs, per collection, through
+  ``CommandMetrics`` (a pymongo CommandListener registered by core.mongo).
+  Commands are also tallied on the current request's ``RequestCommands``,
+  which the middleware reports in ``X-Mongo-Commands`` when DEBUG is on;
+- ``ws_*``: ChatConsumer connects, messages and broadcast latency.
+
+``exposition()`` renders these plus the ``stats()`` of the per-worker caches
+and pools. Each worker process keeps its own numbers, while gunicorn runs
+several workers behind one port and a scrape reaches any one of them. With
+METRICS_MULTIPROC_DIR set, every worker writes its numbers to a file there
+every METRICS_FLUSH_SECONDS (and at exit) and a scrape merges all the files:
+counters and histograms are summed over every worker that ever wrote one,
+so a restarted worker does not look like a reset; gauges are summed over
+live workers only, and the per-worker ``stats()`` carry a ``pid`` label.
+The directory must be emptied when the server starts (gunicorn.conf.py does).
+"""
+import atexit
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+import bson
+from django.conf import settings
+from pymongo.monitoring import CommandListener
+
+PREFIX = 'weintegrity'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    # Whether the values of workers that have exited still count
+    keep_dead = True
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = f'{PREFIX}_{name}'
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        if not flusher.running:
+            flusher.start()
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[n] for n in self.labelnames), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(values, snapshot):
+        for key, value in snapshot:
+            values[tuple(key)] = values.get(tuple(key), 0) + value
+
+    def expose(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        lines += [f'{self.name}{_label_text(self.labelnames, key)} {value}' for key, value in sorted(values.items())]
+        return lines
+
+
+class Gauge(Counter):
+    keep_dead = False
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(labels[n] for n in self.labelnames)] = value
+        if not flusher.running:
+            flusher.start()
+
+    def expose(self, values=None):
+        lines = super().expose(values)
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class Histogram:
+    keep_dead = True
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = f'{PREFIX}_{name}'
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [per-bucket counts (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+        if not flusher.running:
+            flusher.start()
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[n] for n in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self._values.items()]
+
+    @staticmethod
+    def merge(values, snapshot):
+        for key, counts, total in snapshot:
+            entry = values.setdefault(tuple(key), [[0] * len(counts), 0.0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+
+    def expose(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        if values is None:
+            values = {tuple(key): (counts, total) for key, counts, total in self.snapshot()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                labels = _label_text((*self.labelnames, 'le'), (*key, bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _label_text(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+requests = Counter('http_requests_total', 'HTTP responses by route, method and status.', ('route', 'method', 'status'))
+request_seconds = Histogram('http_request_duration_seconds', 'Time to build the response, by route and method.',
+                            ('route', 'method'))
+mongo_commands = Counter('mongo_commands_total', 'Mongo commands by collection, command and outcome.',
+                         ('collection', 'command', 'outcome'))
+mongo_seconds = Histogram('mongo_command_duration_seconds', 'Mongo command round trips by collection and command.',
+                          ('collection', 'command'))
+mongo_reply_bytes = Counter('mongo_reply_bytes_total',
+                            'BSON bytes returned by Mongo, by collection (only with METRICS_REPLY_BYTES on).',
+                            ('collection',))
+ws_connects = Counter('ws_connects_total', 'Accepted chat WebSocket connections by chat type.', ('chat_type',))
+ws_disconnects = Counter('ws_disconnects_total', 'Closed chat WebSocket connections by chat type.', ('chat_type',))
+ws_open = Gauge('ws_open_connections', 'Chat WebSocket connections open in this worker.', ('chat_type',))
+ws_messages = Counter('ws_messages_total', 'Chat messages received over WebSockets, by outcome.',
+                      ('chat_type', 'outcome'))
+ws_broadcast_seconds = Histogram('ws_broadcast_seconds',
+                                 'From a chat message being stored to it being sent to one socket.', ('chat_type',))
+
+METRICS = [requests, request_seconds, mongo_commands, mongo_seconds, mongo_reply_bytes,
+           ws_connects, ws_disconnects, ws_open, ws_messages, ws_broadcast_seconds]
+
+
+class RequestCommands:
+    """Mongo commands run on behalf of one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.reply_bytes = 0
+        self.by_collection = {}
+
+    def add(self, collection, seconds, reply_bytes):
+        self.count += 1
+        self.seconds += seconds
+        self.reply_bytes += reply_bytes
+        self.by_collection[collection] = self.by_collection.get(collection, 0) + 1
+
+
+current_request = contextvars.ContextVar('current_request_commands', default=None)
+
+
+class CommandMetrics(CommandListener):
+    """Feeds the ``mongo_*`` metrics and the current ``RequestCommands``.
+
+    Only a started event names the collection, so it is kept until the
+    command's succeeded or failed event arrives (on the same thread, except
+    under motor, whose executor threads do not see the request's context).
+    Reply sizes cost a BSON re-encode of every reply, so they are measured
+    only with ``reply_bytes`` on (METRICS_REPLY_BYTES).
+    """
+
+    def __init__(self, reply_bytes=False):
+        self.reply_bytes = reply_bytes
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        # getMore carries the cursor id where other commands name the collection
+        value = event.command.get('collection' if event.command_name == 'getMore' else event.command_name)
+        collection = value if isinstance(value, str) else '-'
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = (collection, current_request.get())
+
+    def _finished(self, event, outcome, reply_bytes=0):
+        with self._lock:
+            collection, tally = self._started.pop((event.connection_id, event.request_id), ('-', None))
+        seconds = event.duration_micros / 1e6
+        mongo_commands.inc(collection=collection, command=event.command_name, outcome=outcome)
+        mongo_seconds.observe(seconds, collection=collection, command=event.command_name)
+        if reply_bytes:
+            mongo_reply_bytes.inc(reply_bytes, collection=collection)
+        if tally is not None:
+            tally.add(collection, seconds, reply_bytes)
+
+    def succeeded(self, event):
+        self._finished(event, 'ok', len(bson.encode(event.reply)) if self.reply_bytes else 0)
+
+    def failed(self, event):
+        self._finished(event, 'error')
+
+
+commands = CommandMetrics(reply_bytes=settings.METRICS_REPLY_BYTES)
+
+
+def track_commands():
+    """Start tallying commands for the current request (or task); returns
+    the tally and the token to ``current_request.reset`` with."""
+    tally = RequestCommands()
+    return tally, current_request.set(tally)
+
+
+def worker_stats():
+    """Numeric ``stats()`` of the per-worker caches and pools, as ``[name, value]``."""
+    from .auth import tokens
+    from .cache import documents
+    from .hashing import passwords
+    from .mongo import pool_metrics
+    from .notifications import dispatcher
+    values = []
+    for component, stats in (('document_cache', documents.stats()), ('token_cache', tokens.stats()),
+                             ('password_hashing', passwords.stats()), ('mongo_pool', pool_metrics.stats()),
+                             ('notification_dispatcher', dispatcher.stats())):
+        for key, value in sorted(stats.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values.append([f'{PREFIX}_{component}_{key}', value])
+    return values
+
+
+class Flusher:
+    """Writes this worker's metrics to METRICS_MULTIPROC_DIR from a daemon
+    thread, started by the first update in each process."""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        # Without a directory there is nothing to start
+        self.running = not directory
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+
+    def after_fork(self):
+        # The parent's thread does not exist in the child
+        self.running = not self.directory
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing metrics: {e}")
+
+    def path(self, pid):
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    def flush(self):
+        if not self.directory:
+            return
+        data = {'metrics': {m.name: m.snapshot() for m in METRICS}, 'stats': worker_stats()}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path(os.getpid()))
+
+    def collect(self):
+        """``(merged values per metric, stats lines)`` over every worker's file."""
+        self.flush()
+        merged = {m.name: {} for m in METRICS}
+        by_name = {m.name: m for m in METRICS}
+        stats = []
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if not (entry.name.startswith('metrics-') and entry.name.endswith('.json')):
+                continue
+            pid = int(entry.name[len('metrics-'):-len('.json')])
+            try:
+                with open(entry.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(pid)
+            for name, snapshot in data['metrics'].items():
+                metric = by_name.get(name)
+                if metric is not None and (alive or metric.keep_dead):
+                    metric.merge(merged[name], snapshot)
+            if alive:
+                stats += [f'{name}{{pid="{pid}"}} {value}' for name, value in data['stats']]
+        return merged, stats
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+flusher = Flusher(settings.METRICS_MULTIPROC_DIR, settings.METRICS_FLUSH_SECONDS)
+os.register_at_fork(after_in_child=flusher.after_fork)
+atexit.register(flusher.flush)
+
+
+def exposition():
+    lines = []
+    if flusher.directory:
+        merged, stats = flusher.collect()
+        for metric in METRICS:
+            lines += metric.expose(merged[metric.name])
+        lines += stats
+    else:
+        for metric in METRICS:
+            lines += metric.expose()
+        lines += [f'{name} {value}' for name, value in worker_stats()]
+    return '\n'.join(lines) + '\n'
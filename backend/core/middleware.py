@@ -0,0 +1,92 @@
+"""Request metrics and response compression.
+
+``MetricsMiddleware`` times every request into the per-route histograms of
+core.metrics and tallies the Mongo commands it runs; with DEBUG on, the
+count is sent back in ``X-Mongo-Commands`` (and their time in
+``X-Mongo-Time-Ms``) to make N+1 query patterns easy to spot.
+
+``CompressionMiddleware`` negotiates on ``Accept-Encoding``: brotli when the client accepts it and the ``brotli`` package is installed,
+gzip otherwise (Django's ``GZipMiddleware``, which also covers streamed and
+async-streamed bodies). Bodies smaller than COMPRESS_MIN_BYTES are sent as
+they are. Works unchanged under WSGI and ASGI.
+"""
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+
+from . import metrics
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+re_accepts_brotli = _lazy_re_compile(r'\bbr\b')
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        tally, token = metrics.track_commands()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        return self.record(request, response, tally, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        tally, token = metrics.track_commands()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        return self.record(request, response, tally, time.perf_counter() - started)
+
+    @staticmethod
+    def record(request, response, tally, seconds):
+        match = getattr(request, 'resolver_match', None)
+        # The URL pattern, not the path: one series per route, not per id
+        route = match.route if match else 'unmatched'
+        metrics.request_seconds.observe(seconds, route=route, method=request.method)
+        metrics.requests.inc(route=route, method=request.method, status=response.status_code)
+        if settings.DEBUG:
+            response.headers['X-Mongo-Commands'] = str(tally.count)
+            response.headers['X-Mongo-Time-Ms'] = f'{tally.seconds * 1000:.1f}'
+        return response
+
+
+class CompressionMiddleware(GZipMiddleware):
+    def process_response(self, request, response):
+        if not response.streaming and len(response.content) < settings.COMPRESS_MIN_BYTES:
+            return response
+        if (brotli is None or response.streaming or response.has_header('Content-Encoding')
+                or not re_accepts_brotli.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))):
+            return super().process_response(request, response)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        compressed = brotli.compress(response.content, quality=settings.COMPRESS_BROTLI_QUALITY)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        # The body is no longer byte-for-byte what the strong ETag described
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Length'] = str(len(response.content))
+        response.headers['Content-Encoding'] = 'br'
+        return response
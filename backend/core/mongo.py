@@ -1,44 +1,235 @@
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
+"""The process's Mongo clients: pool sizing, read routing and write concerns.
+
+One ``MongoClient`` per process (re-created in a forked child, e.g. a
+gunicorn worker after ``preload_app``) and one motor client per event loop,
+both built from ``client_options()``:
+
+- pool size, idle time, wait-queue and network timeouts come from the
+  MONGO_* environment variables;
+- ``get_collection(name, route)`` applies the read preference of a route
+  (``'list'``: paged list GETs, secondaryPreferred by default) and the write
+  concern of the collection's profile (chat messages acknowledged by the
+  primary only, user records by a journaled majority);
+- ``pool_metrics`` counts connection checkouts and the time spent waiting
+  for one; ``core.metrics.commands`` times every command.
+"""
+from pymongo import MongoClient, WriteConcern
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+import asyncio
 import logging
 import os
+import threading
+import time
+import weakref
+
+from .metrics import commands
+
+logger = logging.getLogger(__name__)
 
 _CLIENT = None
+# Event loop -> motor client (motor clients are bound to the loop that made them)
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+# Collection -> write concern profile; unlisted collections use the client default
+WRITE_PROFILES = {
+    'chat_messages': 'chat',
+    'users': 'records',
+    'token_revocations': 'records',
+}
+
+
+def mongo_uri() -> str:
+    return os.getenv('MONGO_URI', 'mongodb://localhost:27017')
+
+
+def db_name() -> str:
+    return os.getenv('MONGO_DBNAME', 'weintegrity')
+
+
+def env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def client_options() -> dict:
+    """Connection options shared by the sync and the async (motor) client."""
+    return dict(
+        maxPoolSize=env_int('MONGO_MAX_POOL_SIZE', 100),
+        minPoolSize=env_int('MONGO_MIN_POOL_SIZE', 0),
+        maxIdleTimeMS=env_int('MONGO_MAX_IDLE_TIME_MS', 300000),
+        waitQueueTimeoutMS=env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000),
+        serverSelectionTimeoutMS=env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        connectTimeoutMS=env_int('MONGO_CONNECT_TIMEOUT_MS', 5000),
+        socketTimeoutMS=env_int('MONGO_SOCKET_TIMEOUT_MS', 20000),
+        tls=True,
+        tlsAllowInvalidCertificates=True,
+        event_listeners=[pool_metrics, commands],
+    )
+
+
+def read_preference(route):
+    """Read preference for ``route``; routes without a setting read from the primary."""
+    mode = os.getenv('MONGO_LIST_READ_PREFERENCE', 'secondaryPreferred') if route == 'list' else 'primary'
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference: {mode}')
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=env_int('MONGO_MAX_STALENESS_SECONDS', 90))
+
+
+def stale_read_epoch(route):
+    """For routes that may read from a secondary: a number that changes every
+    MONGO_MAX_STALENESS_SECONDS, None for routes that read from the primary.
+
+    Validators computed from the (primary's) revision counters may be paired
+    with a lagging secondary's body; mixing this into them bounds how long
+    such a response can keep being revalidated.
+    """
+    if isinstance(read_preference(route), Primary):
+        return None
+    return int(time.time() // env_int('MONGO_MAX_STALENESS_SECONDS', 90))
+
+
+def write_concern(profile):
+    """``'chat'``: acknowledged by the primary (MONGO_CHAT_WRITE_CONCERN, default 1);
+    ``'records'``: journaled on a majority (MONGO_RECORDS_WRITE_CONCERN, default majority)."""
+    if profile == 'chat':
+        w = os.getenv('MONGO_CHAT_WRITE_CONCERN', '1')
+        return WriteConcern(w=int(w) if w.isdigit() else w)
+    if profile == 'records':
+        w = os.getenv('MONGO_RECORDS_WRITE_CONCERN', 'majority')
+        return WriteConcern(w=int(w) if w.isdigit() else w, j=True)
+    raise ValueError(f'Unknown write concern profile: {profile}')
+
+
+def collection_options(name, route=None) -> dict:
+    options = {}
+    if route is not None:
+        options['read_preference'] = read_preference(route)
+    if name in WRITE_PROFILES:
+        options['write_concern'] = write_concern(WRITE_PROFILES[name])
+    return options
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """Connection pool counters of this process, across all servers and clients.
+
+    A checkout happens on the thread that needs the connection, so the time
+    from ``check_out_started`` to ``checked_out`` (or ``check_out_failed``)
+    on that thread is the time spent waiting for the pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {'checkouts': 0, 'checkout_failures': 0, 'checkins': 0, 'connections_created': 0,
+                           'connections_closed': 0, 'pools_cleared': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+    def _waited(self):
+        started = getattr(self._local, 'started', None)
+        self._local.started = None
+        return (time.perf_counter() - started) * 1000 if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = self._waited()
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['wait_ms_total'] += waited
+            self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], waited)
+
+    def connection_check_out_failed(self, event):
+        waited = self._waited()
+        with self._lock:
+            self._stats['checkout_failures'] += 1
+            self._stats['wait_ms_total'] += waited
+            self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], waited)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._stats['checkins'] += 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self._stats['connections_created'] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._stats['connections_closed'] += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._stats['pools_cleared'] += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        attempts = stats['checkouts'] + stats['checkout_failures']
+        stats['avg_wait_ms'] = stats['wait_ms_total'] / attempts if attempts else 0.0
+        stats['in_use'] = stats['checkouts'] - stats['checkins']
+        stats['open'] = stats['connections_created'] - stats['connections_closed']
+        stats['max_pool_size'] = env_int('MONGO_MAX_POOL_SIZE', 100)
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+def _after_fork():
+    """A forked child must not use its parent's sockets: drop the clients so
+    the next call opens its own (mongomock's in-memory store is kept)."""
+    global _CLIENT
+    if isinstance(_CLIENT, MongoClient):
+        _CLIENT = None
+    _ASYNC_CLIENTS.clear()
+    pool_metrics.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
 
 
 def get_client() -> MongoClient:
     global _CLIENT
     if _CLIENT is not None:
         return _CLIENT
-    uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
+    uri = mongo_uri()
     # Use mock if explicitly set to true
     use_mock = os.getenv('USE_MONGOMOCK', 'false').lower() == 'true'
-    logger = logging.getLogger(__name__)
-    
-    # Debug logging
-    print(f"[DEBUG] MONGO_URI from env: {uri}")
-    print(f"[DEBUG] USE_MONGOMOCK from env: {use_mock}")
-    
     try:
-        client = MongoClient(
-            uri,
-            serverSelectionTimeoutMS=20000,
-            connectTimeoutMS=20000,
-            socketTimeoutMS=20000,
-            tls=True,
-            tlsAllowInvalidCertificates=True
-        )
+        client = MongoClient(uri, **client_options())
         # trigger a selection attempt
         client.admin.command('ping')
         logger.info("Connected to MongoDB at %s (real instance)", uri)
-        print(f"[SUCCESS] Connected to MongoDB Atlas!")
         _CLIENT = client
         return _CLIENT
     except Exception as exc:
-        print(f"[ERROR] MongoDB connection failed: {exc}")
-        logger.error("MongoDB connection to %s failed: %s", uri, exc)
         if not use_mock:
-            print("[ERROR] USE_MONGOMOCK is false, raising exception")
+            logger.error("MongoDB connection to %s failed: %s", uri, exc)
             raise
         try:
             import mongomock
@@ -47,7 +238,6 @@ def get_client() -> MongoClient:
                 uri,
                 exc,
             )
-            print("[WARNING] Falling back to mongomock (in-memory database)")
             _CLIENT = mongomock.MongoClient()
             return _CLIENT
         except Exception as mock_exc:
@@ -58,9 +248,92 @@ def get_client() -> MongoClient:
 
 
 def get_db():
-    client = get_client()
-    db_name = os.getenv('MONGO_DBNAME', 'weintegrity')
-    print(f"[DEBUG] Using database: {db_name}")
-    return client[db_name]
+    return get_client()[db_name()]
+
+
+def get_collection(name, route=None):
+    """Collection ``name`` with the read preference of ``route`` and the
+    write concern of its profile (see WRITE_PROFILES)."""
+    return get_db().get_collection(name, **collection_options(name, route))
+
+
+def get_async_db():
+    """The database through motor, for async views, on the running event loop.
+
+    Same URI, database and options as ``get_db``. When the sync client fell
+    back to mongomock, the mock is wrapped instead (see ``_MockAsyncDatabase``).
+    """
+    sync_client = get_client()
+    if not isinstance(sync_client, MongoClient):
+        return _MockAsyncDatabase(sync_client[db_name()])
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_CLIENTS.get(loop)
+    if client is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = _ASYNC_CLIENTS[loop] = AsyncIOMotorClient(mongo_uri(), **client_options())
+    return client[db_name()]
+
+
+def get_async_collection(name, route=None):
+    """``get_collection`` through motor."""
+    return get_async_db().get_collection(name, **collection_options(name, route))
+
+
+class _MockAsyncCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, n):
+        self._cursor.skip(n)
+        return self
+
+    def limit(self, n):
+        self._cursor.limit(n)
+        return self
+
+    async def to_list(self, length=None):
+        return list(self._cursor if length is None else self._cursor.limit(length))
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._cursor:
+            yield doc
+
+
+class _MockAsyncCollection:
+    """The slice of motor's collection API the async views use, over mongomock."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return _MockAsyncCursor(self._collection.find(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        return _MockAsyncCursor(self._collection.aggregate(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class _MockAsyncDatabase:
+    def __init__(self, db):
+        self._db = db
+
+    def __getitem__(self, name):
+        return _MockAsyncCollection(self._db[name])
+
+    def get_collection(self, name, **options):
+        return _MockAsyncCollection(self._db.get_collection(name, **options))
 
 
@@ -0,0 +1,234 @@
+"""Chat notification fan-out, off the request path.
+
+Chat POSTs enqueue a job and return immediately. Worker threads resolve the
+recipients, write every notification with a single ``insert_many`` and push
+them to the recipients' sockets.
+"""
+import asyncio
+import atexit
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from .cache import documents
+from .mongo import get_db
+from .realtime import publish_notifications
+from .revisions import REVISION_FIELD, reserved_revision
+
+
+def _sender_name(author_id):
+    sender = documents.get('users', author_id)
+    return f"{sender.get('firstName', '')} {sender.get('lastName', '')}".strip() if sender else 'Someone'
+
+
+def story_chat_notifications(story_id, msg):
+    """Notifications for a story chat message (team, assignee, creator, updater)."""
+    db = get_db()
+    author_id = msg.get('authorId')
+    story = db['stories'].find_one({'id': story_id})
+    if not story or not author_id:
+        return []
+    sender_name = _sender_name(author_id)
+
+    notify_user_ids = []
+    # Get team members if team is assigned
+    if story.get('assignedTeamId'):
+        team = documents.get('teams', story['assignedTeamId'])
+        if team:
+            notify_user_ids.extend(team.get('memberIds', []))
+            if team.get('leadId'):
+                notify_user_ids.append(team['leadId'])
+    # Add assigned user, story creator and updater
+    for user_id in (story.get('assignedToId'), story.get('createdById'), story.get('updatedById')):
+        if user_id and user_id not in notify_user_ids:
+            notify_user_ids.append(user_id)
+    # Exclude the sender
+    notify_user_ids = [uid for uid in notify_user_ids if uid and uid != author_id]
+
+    message_preview = msg.get('text', '')[:100]  # First 100 chars
+    story_number = story.get('number', story_id)
+    return [
+        {
+            'userId': user_id,
+            'message': f'{sender_name} sent a message on story {story_number}: {message_preview}',
+            'link': f'/stories/{story_id}',
+        }
+        for user_id in notify_user_ids
+    ]
+
+
+def project_chat_notifications(project_id, msg):
+    """Notifications for a project chat message (all members but the sender)."""
+    author_id = msg.get('authorId')
+    project = documents.get('projects', project_id)
+    if not project or not author_id:
+        return []
+    sender_name = _sender_name(author_id)
+    message_preview = msg.get('text', '')[:100]  # First 100 chars
+    return [
+        {
+            'userId': user_id,
+            'message': f'{sender_name} sent a message in {project.get("name", "project")}: {message_preview}',
+            'link': f'/projects/{project_id}',
+        }
+        for user_id in project.get('memberIds', [])
+        if user_id != author_id
+    ]
+
+
+def store_notifications(chat_id, drafts):
+    """Complete ``drafts`` (one per recipient) and write them in one unordered
+    ``insert_many``; returns the notifications stored."""
+    drafts = list({draft['userId']: draft for draft in drafts}.values())
+    if not drafts:
+        return []
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+    with reserved_revision('notifications') as rev:
+        docs = [
+            {
+                # Random suffix: jobs for one chat and recipient may run in the same millisecond
+                'id': f"notif-{chat_id}-{draft['userId']}-{uuid.uuid4().hex}",
+                **draft,
+                'isRead': False,
+                'timestamp': timestamp,
+                REVISION_FIELD: rev,
+            }
+            for draft in drafts
+        ]
+        try:
+            get_db()['notifications'].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Keep what landed, and say what did not
+            errors = e.details.get('writeErrors', [])
+            for err in errors:
+                print(f"Error storing notification {docs[err['index']]['id']}: {err.get('errmsg')}")
+            failed = {err['index'] for err in errors}
+            docs = [doc for i, doc in enumerate(docs) if i not in failed]
+    return docs
+
+
+class NotificationDispatcher:
+    """In-process queue drained by a small pool of daemon worker threads.
+
+    When the queue is full, jobs run inline on the caller's thread, so
+    callers slow down instead of losing notifications. Code on an event loop
+    uses ``asubmit``, whose inline jobs run in the loop's default executor:
+    they do blocking Mongo writes and publish through ``async_to_sync``,
+    which cannot run inside a running loop.
+    """
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {
+            'enqueued': 0, 'inline': 0, 'processed': 0, 'failed': 0,
+            'notifications_inserted': 0, 'last_lag_seconds': 0.0, 'max_lag_seconds': 0.0,
+        }
+        self._lag_total = 0.0
+
+    def _ensure_started(self):
+        # Threads do not survive fork (e.g. gunicorn --preload), so start per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'notification-dispatch-{i}', daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, chat_id, build, *args):
+        """Queue ``build(*args)``, whose notification drafts are stored for ``chat_id``."""
+        job = self._enqueue(chat_id, build, args)
+        if job is not None:
+            self._execute(*job)
+
+    async def asubmit(self, chat_id, build, *args):
+        """``submit`` for coroutines."""
+        job = self._enqueue(chat_id, build, args)
+        if job is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._execute, *job)
+
+    def _enqueue(self, chat_id, build, args):
+        """Queue the job, or return it to run inline when the queue is full."""
+        self._ensure_started()
+        job = (time.monotonic(), chat_id, build, args)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._stats['inline'] += 1
+            return job
+        with self._lock:
+            self._stats['enqueued'] += 1
+        return None
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._execute(*job)
+            finally:
+                self._queue.task_done()
+
+    def _execute(self, enqueued_at, chat_id, build, args):
+        lag = time.monotonic() - enqueued_at
+        try:
+            stored = store_notifications(chat_id, build(*args))
+            publish_notifications(stored)
+        except Exception as e:
+            with self._lock:
+                self._stats['failed'] += 1
+            print(f"Error creating notifications: {e}")
+            traceback.print_exc()
+            return
+        with self._lock:
+            self._stats['processed'] += 1
+            self._stats['notifications_inserted'] += len(stored)
+            self._stats['last_lag_seconds'] = lag
+            self._stats['max_lag_seconds'] = max(self._stats['max_lag_seconds'], lag)
+            self._lag_total += lag
+
+    def drain(self, timeout=5.0):
+        """Wait until every queued job has finished; False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._queue.mutex:
+            depth = len(self._queue.queue)
+            oldest = self._queue.queue[0][0] if depth else None
+        with self._lock:
+            stats = dict(self._stats)
+            done = stats['processed'] + stats['failed']
+            stats['avg_lag_seconds'] = self._lag_total / stats['processed'] if stats['processed'] else 0.0
+        stats.update({
+            'workers': self.workers,
+            'queue_depth': depth,
+            'in_flight': stats['enqueued'] + stats['inline'] - done - depth,
+            'oldest_pending_seconds': time.monotonic() - oldest if oldest is not None else 0.0,
+        })
+        return stats
+
+
+dispatcher = NotificationDispatcher(
+    workers=settings.NOTIFICATION_DISPATCH_WORKERS,
+    max_queue=settings.NOTIFICATION_DISPATCH_QUEUE_SIZE,
+)
+# Give queued fan-out a chance to finish when the worker process exits
+atexit.register(dispatcher.drain, 5.0)
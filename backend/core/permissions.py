@@ -1,5 +1,10 @@
+import jwt
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from rest_framework.permissions import BasePermission
 
+from .auth import decode_token
+
 
 class IsAdminOrPOForWrites(BasePermission):
     def has_permission(self, request, view):
@@ -33,3 +38,26 @@ class IsAdminForUserWrites(BasePermission):
         return role == 'Admin'
 
 
+class IsAdmin(BasePermission):
+    def has_permission(self, request, view):
+        payload = getattr(request, 'jwt_payload', None)
+        if not payload:
+            return False
+        return payload.get('role') == 'Admin'
+
+
+class IsAdminOrMetricsScraper(BasePermission):
+    """An admin's JWT or the METRICS_TOKEN, for views without authentication
+    classes (a scraper's token is not a JWT and would be rejected by them)."""
+
+    def has_permission(self, request, view):
+        header = request.headers.get('Authorization', '')
+        token = header[7:].strip() if header.startswith('Bearer ') else ''
+        if not token:
+            return False
+        if settings.METRICS_TOKEN and constant_time_compare(token, settings.METRICS_TOKEN):
+            return True
+        try:
+            return decode_token(token).get('role') == 'Admin'
+        except jwt.InvalidTokenError:
+            return False
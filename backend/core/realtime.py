@@ -0,0 +1,50 @@
+"""Server-to-browser pushes over the Channels layer."""
+import asyncio
+import os
+import re
+import threading
+from channels.layers import get_channel_layer
+
+
+def notification_group(user_id: str) -> str:
+    # Group names only allow ASCII alphanumerics, hyphens, underscores and periods
+    return 'notifications_' + re.sub(r'[^\w.-]', '_', str(user_id), flags=re.ASCII)
+
+
+_publisher = {'pid': None, 'loop': None}
+_publisher_lock = threading.Lock()
+
+
+def _publisher_loop():
+    # Threads do not survive fork (e.g. gunicorn --preload), so start per process
+    if _publisher['pid'] != os.getpid():
+        with _publisher_lock:
+            if _publisher['pid'] != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='realtime-publisher', daemon=True).start()
+                _publisher['loop'], _publisher['pid'] = loop, os.getpid()
+    return _publisher['loop']
+
+
+def publish_notifications(notifications):
+    """Deliver freshly stored notifications to their owners' open sockets."""
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    sends = [
+        (notification_group(n['userId']), {'type': 'notification', 'notification': {k: v for k, v in n.items() if not k.startswith('_')}})
+        for n in notifications
+        if n.get('userId')
+    ]
+    if sends:
+        # One long-lived loop for every fan-out, so the sends share a batch and
+        # the layer's connection outlives the call
+        asyncio.run_coroutine_threadsafe(_group_send_all(layer, sends), _publisher_loop()).result()
+
+
+async def _group_send_all(layer, sends):
+    results = await asyncio.gather(*(layer.group_send(group, event) for group, event in sends), return_exceptions=True)
+    for error in results:
+        if isinstance(error, Exception):
+            # Clients still pick the notification up on their next sync
+            print(f"Error publishing notification: {error}")
@@ -0,0 +1,48 @@
+"""orjson-backed JSON renderer and parser (opt-in: API_JSON_ENGINE=orjson).
+
+Install orjson separately. Output matches DRF's ``JSONRenderer``: compact
+UTF-8 with U+2028/U+2029 escaped, datetimes and decimals formatted by DRF's encoder, ObjectId and
+Decimal128 as strings (as in the streamed snapshot, see core.streaming).
+Indented output (``Accept: application/json; indent=2``) still goes through
+the stdlib encoder.
+"""
+import orjson
+from bson import Decimal128, ObjectId
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+_drf_encoder = JSONEncoder()
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def default(value):
+    if isinstance(value, (ObjectId, Decimal128)):
+        return str(value)
+    return _drf_encoder.default(value)
+
+
+def dumps(value) -> bytes:
+    # Escape U+2028/U+2029 as DRF does (they end a line in JavaScript source)
+    return (orjson.dumps(value, default=default, option=OPTIONS)
+            .replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029'))
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
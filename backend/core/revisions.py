@@ -0,0 +1,262 @@
+"""Per-collection change revisions backing the delta-sync endpoint.
+
+Every write through the CRUD views stamps the document with the next value
+of its collection's counter (stored in ``revisions``); deletes leave a
+tombstone carrying the revision at which the document disappeared.
+Chats keep one counter each (see core.chats.chat_revision) and the ETags
+of conditional GETs are derived from these counters (see core.etags).
+
+A revision is taken before the write that carries it, so the counter can
+run ahead of what is stored. ``reserved_revision`` therefore records the
+revision as pending in the counter document until its write is done, and
+``current_revisions`` reports, per counter, the highest revision up to which
+every write has finished. Sync tokens and ETags built from it never claim a
+write that readers cannot see yet. A pending revision whose writer died is
+ignored after REVISION_LEASE_SECONDS.
+"""
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from .mongo import get_async_db, get_db
+
+REVISION_FIELD = '_rev'
+REVISION_LEASE_SECONDS = 30
+
+
+def next_revision(name: str) -> int:
+    """Advance a counter whose change is already stored (chats, revocations)."""
+    counter = get_db()['revisions'].find_one_and_update(
+        {'_id': name},
+        {'$inc': {'rev': 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    clock.observe(name, counter['rev'])
+    return counter['rev']
+
+
+async def anext_revision(name: str) -> int:
+    counter = await get_async_db()['revisions'].find_one_and_update(
+        {'_id': name},
+        {'$inc': {'rev': 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    clock.observe(name, counter['rev'])
+    return counter['rev']
+
+
+def bump_revisions(names) -> None:
+    """Advance several counters with one bulk write."""
+    names = list(dict.fromkeys(names))
+    if not names:
+        return
+    get_db()['revisions'].bulk_write([UpdateOne({'_id': n}, {'$inc': {'rev': 1}}, upsert=True) for n in names], ordered=False)
+    clock.forget(names)
+
+
+def completed_revision(counter, now=None) -> int:
+    """Highest revision of ``counter`` (a ``revisions`` document) below every
+    pending write."""
+    if counter is None:
+        return 0
+    cutoff = (now or time.time()) - REVISION_LEASE_SECONDS
+    pending = [p['rev'] for p in counter.get('pending', ()) if p['at'] > cutoff]
+    return min(pending) - 1 if pending else counter['rev']
+
+
+def _reservation(counter, name):
+    """Filter, update and revision taking the next revision of ``counter`` as pending."""
+    rev = (counter['rev'] if counter else 0) + 1
+    lease = {'rev': rev, 'at': time.time()}
+    if counter is None:
+        return None, {'_id': name, 'rev': rev, 'pending': [lease]}, rev
+    return {'_id': name, 'rev': rev - 1}, {'$set': {'rev': rev}, '$push': {'pending': lease}}, rev
+
+
+def reserve_revision(name: str) -> int:
+    """Take the next revision of ``name`` for a write not done yet; pair with
+    ``complete_revision`` (or use ``reserved_revision``)."""
+    revisions = get_db()['revisions']
+    while True:
+        query, update, rev = _reservation(revisions.find_one({'_id': name}, {'rev': 1}), name)
+        try:
+            if query is None:
+                revisions.insert_one(update)
+                return rev
+            if revisions.update_one(query, update).modified_count:
+                return rev
+        except DuplicateKeyError:
+            pass
+        # Another writer took that revision first
+
+
+async def areserve_revision(name: str) -> int:
+    revisions = get_async_db()['revisions']
+    while True:
+        query, update, rev = _reservation(await revisions.find_one({'_id': name}, {'rev': 1}), name)
+        try:
+            if query is None:
+                await revisions.insert_one(update)
+                return rev
+            if (await revisions.update_one(query, update)).modified_count:
+                return rev
+        except DuplicateKeyError:
+            pass
+
+
+def _expired(counter):
+    cutoff = time.time() - REVISION_LEASE_SECONDS
+    return [p['rev'] for p in counter.get('pending', ()) if p['at'] <= cutoff]
+
+
+def complete_revision(name: str, rev: int) -> None:
+    """The write stamped with ``rev`` is stored (or abandoned)."""
+    revisions = get_db()['revisions']
+    counter = revisions.find_one_and_update({'_id': name}, {'$pull': {'pending': {'rev': rev}}},
+                                            return_document=ReturnDocument.AFTER)
+    expired = _expired(counter)
+    if expired:
+        revisions.update_one({'_id': name}, {'$pull': {'pending': {'rev': {'$in': expired}}}})
+    clock.observe(name, completed_revision(counter))
+
+
+async def acomplete_revision(name: str, rev: int) -> None:
+    revisions = get_async_db()['revisions']
+    counter = await revisions.find_one_and_update({'_id': name}, {'$pull': {'pending': {'rev': rev}}},
+                                                  return_document=ReturnDocument.AFTER)
+    expired = _expired(counter)
+    if expired:
+        await revisions.update_one({'_id': name}, {'$pull': {'pending': {'rev': {'$in': expired}}}})
+    clock.observe(name, completed_revision(counter))
+
+
+@contextmanager
+def reserved_revision(name: str):
+    """``with reserved_revision('stories') as rev:`` write the document stamped with ``rev``."""
+    rev = reserve_revision(name)
+    try:
+        yield rev
+    finally:
+        complete_revision(name, rev)
+
+
+@asynccontextmanager
+async def areserved_revision(name: str):
+    rev = await areserve_revision(name)
+    try:
+        yield rev
+    finally:
+        await acomplete_revision(name, rev)
+
+
+def current_revisions(names) -> dict:
+    """Per counter, the revision up to which every write is stored."""
+    names = list(names)
+    now = time.time()
+    found = {d['_id']: completed_revision(d, now) for d in get_db()['revisions'].find({'_id': {'$in': names}})}
+    return {name: found.get(name, 0) for name in names}
+
+
+async def acurrent_revisions(names) -> dict:
+    names = list(names)
+    now = time.time()
+    found = {d['_id']: completed_revision(d, now) async for d in get_async_db()['revisions'].find({'_id': {'$in': names}})}
+    return {name: found.get(name, 0) for name in names}
+
+
+def settled(revisions) -> bool:
+    """Whether no revision past ``revisions`` (name -> rev) has been taken,
+    even by a write still pending."""
+    found = {d['_id']: d['rev'] for d in get_db()['revisions'].find({'_id': {'$in': list(revisions)}}, {'rev': 1})}
+    return all(found.get(name, 0) == rev for name, rev in revisions.items())
+
+
+async def asettled(revisions) -> bool:
+    found = {d['_id']: d['rev'] async for d in
+             get_async_db()['revisions'].find({'_id': {'$in': list(revisions)}}, {'rev': 1})}
+    return all(found.get(name, 0) == rev for name, rev in revisions.items())
+
+
+def record_delete(name: str, doc_id: str, rev: int) -> None:
+    """Leave the tombstone of ``doc_id``, deleted under reserved revision ``rev``."""
+    get_db()['tombstones'].update_one(
+        {'collection': name, 'id': doc_id},
+        {'$set': {'rev': rev}},
+        upsert=True,
+    )
+
+
+async def arecord_delete(name: str, doc_id: str, rev: int) -> None:
+    await get_async_db()['tombstones'].update_one(
+        {'collection': name, 'id': doc_id},
+        {'$set': {'rev': rev}},
+        upsert=True,
+    )
+
+
+def deleted_since(name: str, since: int) -> list:
+    cursor = get_db()['tombstones'].find({'collection': name, 'rev': {'$gt': since}}, {'id': 1})
+    return [t['id'] for t in cursor]
+
+
+class RevisionClock:
+    """Revision counters as this process last read them.
+
+    A counter is re-read once it is older than ``max_age`` seconds, so
+    checking whether anything changed usually costs no query at all; bumps
+    made by this process are seen at once, other workers' within
+    ``max_age``. ``max_age=0`` reads the counters on every call.
+    """
+    MAX_NAMES = 10000
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._seen = {}  # name -> (rev, fresh until)
+        self._lock = threading.Lock()
+
+    def get(self, names) -> dict:
+        names, known, stale = self._lookup(names)
+        if stale:
+            known.update(self._store(current_revisions(stale)))
+        return {n: known[n] for n in names}
+
+    async def aget(self, names) -> dict:
+        names, known, stale = self._lookup(names)
+        if stale:
+            known.update(self._store(await acurrent_revisions(stale)))
+        return {n: known[n] for n in names}
+
+    def _lookup(self, names):
+        names = list(dict.fromkeys(names))
+        now = time.monotonic()
+        with self._lock:
+            known = {n: self._seen[n][0] for n in names if n in self._seen and self._seen[n][1] > now}
+        return names, known, [n for n in names if n not in known]
+
+    def _store(self, fresh):
+        fresh_until = time.monotonic() + self.max_age
+        with self._lock:
+            if len(self._seen) > self.MAX_NAMES:
+                self._seen.clear()
+            for name, rev in fresh.items():
+                self._seen[name] = (rev, fresh_until)
+        return fresh
+
+    def observe(self, name, rev):
+        with self._lock:
+            seen = self._seen.get(name)
+            if seen is None or rev > seen[0]:
+                self._seen[name] = (rev, time.monotonic() + self.max_age)
+
+    def forget(self, names):
+        with self._lock:
+            for name in names:
+                self._seen.pop(name, None)
+
+
+clock = RevisionClock(max_age=settings.REVISION_CLOCK_MAX_AGE_MS / 1000)
@@ -0,0 +1,157 @@
+"""Token index behind the ``q`` filter of the list endpoints.
+
+Every searchable document has one entry in ``search_index`` holding its
+terms (each word plus the word's prefixes) and a weight per term. A query
+is an ``$all`` lookup on the multikey (collection, terms) index instead of
+an unanchored regex scan, so its cost follows the number of matches rather
+than the size of the collection. Matches are scored and sorted in Mongo, so
+the best ones come first however many there are.
+
+Identifiers such as story numbers are also indexed by their digits, so
+``0042`` (or ``42``) finds ``STRY0042``; entries written before that need
+``manage.py rebuild_search_index``.
+"""
+import math
+import re
+
+from django.conf import settings
+from pymongo import ReplaceOne
+
+from .mongo import get_async_db, get_db
+
+SEARCH_INDEX = 'search_index'
+# Collection -> {field: weight}; a word in a heavier field ranks higher
+SEARCH_FIELDS = {
+    'users': {'firstName': 3, 'lastName': 3, 'email': 3, 'employeeId': 3, 'jobTitle': 1, 'department': 1},
+    'teams': {'name': 3},
+    'projects': {'name': 3, 'description': 1},
+    'stories': {'number': 4, 'shortDescription': 3, 'description': 1, 'acceptanceCriteria': 1},
+    'epics': {'name': 3},
+    'sprints': {'name': 3},
+}
+# Words are indexed by every prefix of at least MIN_PREFIX characters (so
+# "auth" finds "authentication"); prefix hits count for less than whole words
+MIN_PREFIX = 2
+MAX_TERM = 24
+PREFIX_WEIGHT = 0.5
+WORD = re.compile(r'\w+')
+DIGIT_SUFFIX = re.compile(r'[^\W\d]+(\d+)$')
+
+
+def index():
+    return get_db()[SEARCH_INDEX]
+
+
+def tokenize(text):
+    return [word[:MAX_TERM] for word in WORD.findall(str(text).lower())]
+
+
+def words(text):
+    """``tokenize(text)`` plus the digits ending each identifier ("stry0042"
+    adds "0042" and "42")."""
+    found = []
+    for word in tokenize(text):
+        found.append(word)
+        match = DIGIT_SUFFIX.match(word)
+        if match:
+            digits = match.group(1)
+            found += [digits] + ([digits.lstrip('0')] if digits.lstrip('0') not in ('', digits) else [])
+    return found
+
+
+def _text(value):
+    if isinstance(value, (list, tuple)):
+        return ' '.join(str(v) for v in value)
+    return '' if value is None else str(value)
+
+
+def document_scores(name, doc):
+    """Weight of each term in ``doc``: best field weight, plus a little per repeat."""
+    best, counts = {}, {}
+    for field, weight in SEARCH_FIELDS[name].items():
+        for word in words(_text(doc.get(field))):
+            for term, w in [(word, weight)] + [(word[:n], weight * PREFIX_WEIGHT) for n in range(MIN_PREFIX, len(word))]:
+                best[term] = max(best.get(term, 0), w)
+                counts[term] = counts.get(term, 0) + 1
+    return {term: round(w + 0.1 * math.log(counts[term]), 3) for term, w in best.items()}
+
+
+def _entry(name, doc):
+    scores = document_scores(name, doc)
+    return {'collection': name, 'id': doc['id'], 'terms': list(scores), 'scores': scores}
+
+
+def index_document(name, doc):
+    """(Re-)index one document after it was written; no-op for unsearchable collections."""
+    if name not in SEARCH_FIELDS or not doc or not doc.get('id'):
+        return
+    index().replace_one({'collection': name, 'id': doc['id']}, _entry(name, doc), upsert=True)
+
+
+async def aindex_document(name, doc):
+    if name not in SEARCH_FIELDS or not doc or not doc.get('id'):
+        return
+    await get_async_db()[SEARCH_INDEX].replace_one({'collection': name, 'id': doc['id']}, _entry(name, doc), upsert=True)
+
+
+def remove_document(name, doc_id):
+    if name in SEARCH_FIELDS:
+        index().delete_one({'collection': name, 'id': doc_id})
+
+
+async def aremove_document(name, doc_id):
+    if name in SEARCH_FIELDS:
+        await get_async_db()[SEARCH_INDEX].delete_one({'collection': name, 'id': doc_id})
+
+
+def rebuild(name, batch_size=1000):
+    """Index every document of ``name``; returns how many were indexed."""
+    ops, total = [], 0
+    for doc in get_db()[name].find({}, {field: 1 for field in SEARCH_FIELDS[name]} | {'id': 1}):
+        if not doc.get('id'):
+            continue
+        ops.append(ReplaceOne({'collection': name, 'id': doc['id']}, _entry(name, doc), upsert=True))
+        if len(ops) >= batch_size:
+            index().bulk_write(ops, ordered=False)
+            total += len(ops)
+            ops = []
+    if ops:
+        index().bulk_write(ops, ordered=False)
+        total += len(ops)
+    return total
+
+
+def search(name, q, limit=None):
+    """``(ids, truncated)``: the best ``limit`` (default SEARCH_MAX_CANDIDATES)
+    documents of ``name`` matching every word of ``q``, best first, and
+    whether more matched. Ties keep id order.
+    """
+    terms = list(dict.fromkeys(tokenize(q)))
+    if not terms or name not in SEARCH_FIELDS:
+        return [], False
+    limit = limit or settings.SEARCH_MAX_CANDIDATES
+    return _ranked(list(index().aggregate(_pipeline(name, terms, limit))), limit)
+
+
+async def asearch(name, q, limit=None):
+    terms = list(dict.fromkeys(tokenize(q)))
+    if not terms or name not in SEARCH_FIELDS:
+        return [], False
+    limit = limit or settings.SEARCH_MAX_CANDIDATES
+    hits = await get_async_db()[SEARCH_INDEX].aggregate(_pipeline(name, terms, limit)).to_list(None)
+    return _ranked(hits, limit)
+
+
+def _pipeline(name, terms, limit):
+    """Index entries matching all ``terms``, scored, best ``limit + 1`` first."""
+    score = {'$add': [{'$ifNull': [f'$scores.{term}', 0]} for term in terms]}
+    return [
+        {'$match': {'collection': name, 'terms': {'$all': terms}}},
+        {'$project': {'_id': 0, 'id': 1, 'score': score}},
+        {'$sort': {'score': -1, 'id': 1}},
+        {'$limit': limit + 1},
+    ]
+
+
+def _ranked(hits, limit):
+    return [hit['id'] for hit in hits[:limit]], len(hits) > limit
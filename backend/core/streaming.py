@@ -0,0 +1,78 @@
+"""Streaming JSON/NDJSON bodies built straight from Mongo cursors.
+
+Documents are encoded one at a time and flushed in ~64 KB chunks, so memory
+stays flat regardless of collection size.
+"""
+import json
+from datetime import date, datetime
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+CHUNK_SIZE = 64 * 1024
+CURSOR_BATCH_SIZE = 500
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    # ObjectId, Decimal128 and friends
+    return str(value)
+
+
+def dumps(value) -> str:
+    return json.dumps(value, default=json_default, separators=(',', ':'))
+
+
+def buffered(parts, size=CHUNK_SIZE):
+    """Join small string parts into byte chunks of roughly ``size`` bytes."""
+    buf, length = [], 0
+    for part in parts:
+        buf.append(part)
+        length += len(part)
+        if length >= size:
+            yield ''.join(buf).encode()
+            buf, length = [], 0
+    if buf:
+        yield ''.join(buf).encode()
+
+
+def snapshot_parts(sources, header, fmt='json'):
+    """Yield the encoded snapshot for ``sources`` (name -> cursor factory).
+
+    JSON matches the full-snapshot shape of the sync feed:
+    ``{..header, "collections": {name: {"upserts": [...], "deletes": []}}}``.
+    NDJSON emits the header line, then one ``{"collection", "doc"}`` per line.
+    """
+    if fmt == 'ndjson':
+        yield dumps(header) + '\n'
+        for name, find in sources.items():
+            for doc in find().batch_size(CURSOR_BATCH_SIZE):
+                yield dumps({'collection': name, 'doc': doc}) + '\n'
+        return
+    yield dumps(header)[:-1] + ',"collections":{'
+    for i, (name, find) in enumerate(sources.items()):
+        yield ('' if i == 0 else ',') + dumps(name) + ':{"upserts":['
+        for j, doc in enumerate(find().batch_size(CURSOR_BATCH_SIZE)):
+            yield ('' if j == 0 else ',') + dumps(doc)
+        yield '],"deletes":[]}'
+    yield '}}'
+
+
+async def _iterate_async(chunks):
+    # Pull one chunk at a time off the event loop; Django would otherwise
+    # buffer a sync iterator completely before sending it over ASGI.
+    step = sync_to_async(next, thread_sensitive=False)
+    while True:
+        chunk = await step(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def streaming_response(request, parts, content_type):
+    chunks = buffered(parts)
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        chunks = _iterate_async(chunks)
+    return StreamingHttpResponse(chunks, content_type=content_type)
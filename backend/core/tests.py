@@ -1,3 +1,6 @@
+import importlib.util
+import json
+from unittest import skipUnless
 from django.test import TestCase, Client
 from django.urls import reverse
 from core.mongo import get_db
@@ -9,7 +12,7 @@ class ApiSmokeTests(TestCase):
     def setUpTestData(cls):
         # Ensure Mongo is accessible and clean minimal data
         db = get_db()
-        for name in ['users','teams','projects','stories','epics','sprints','notifications','story_chats','project_chats']:
+        for name in ['users','teams','projects','stories','epics','sprints','notifications','story_chats','project_chats','chat_messages','search_index','token_revocations']:
             db[name].delete_many({})
 
     def setUp(self):
@@ -87,3 +90,676 @@ class ApiSmokeTests(TestCase):
         self.assertIn(r.status_code, (200, 403))  # schema may be public; tolerate both
         r = self.client.get('/api/docs/', **self.auth)
         self.assertIn(r.status_code, (200, 302))
+
+    def test_cursor_pagination(self):
+        for n in [3, 1, 5, 2, 4]:
+            story = {'id': f'cs{n}', 'number': f'STRY{n:04d}', 'shortDescription': f'Story {n}'}
+            r = self.client.post('/api/stories/', data=story, content_type='application/json', **self.auth)
+            self.assertEqual(r.status_code, 201)
+        seen, cursor = [], ''
+        while cursor is not None:
+            r = self.client.get(f'/api/stories/?page_size=2&cursor={cursor}', **self.auth)
+            self.assertEqual(r.status_code, 200)
+            body = r.json()
+            self.assertLessEqual(len(body['results']), 2)
+            seen.extend(s['id'] for s in body['results'])
+            cursor = body['next_cursor']
+        self.assertEqual([s for s in seen if s.startswith('cs')], ['cs1', 'cs2', 'cs3', 'cs4', 'cs5'])
+        r = self.client.get('/api/stories/?cursor=not-a-cursor', **self.auth)
+        self.assertEqual(r.status_code, 400)
+        # Legacy page/page_size clients still get a plain list
+        r = self.client.get('/api/stories/?page=1&page_size=2', **self.auth)
+        self.assertIsInstance(r.json(), list)
+
+    def test_delta_sync(self):
+        r = self.client.get('/api/sync/', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        snapshot = json.loads(b''.join(r.streaming_content))
+        since = snapshot['since']
+        self.assertTrue(any(u['id'] == 'u1' for u in snapshot['collections']['users']['upserts']))
+        self.client.post('/api/epics/', data={'id': 'se1', 'name': 'Synced'}, content_type='application/json', **self.auth)
+        self.client.post('/api/epics/', data={'id': 'se2', 'name': 'Gone'}, content_type='application/json', **self.auth)
+        self.client.delete('/api/epics/se2/', **self.auth)
+        r = self.client.get(f'/api/sync/?since={since}', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        epics = r.json()['collections']['epics']
+        self.assertEqual([e['id'] for e in epics['upserts']], ['se1'])
+        self.assertNotIn('_rev', epics['upserts'][0])
+        self.assertEqual(epics['deletes'], ['se2'])
+        self.assertEqual(r.json()['collections']['stories']['upserts'], [])
+        # Nothing changed since the latest token
+        r = self.client.get(f"/api/sync/?since={r.json()['since']}", **self.auth)
+        self.assertEqual(r.json()['collections']['epics'], {'upserts': [], 'deletes': []})
+        r = self.client.get('/api/sync/?since=@@', **self.auth)
+        self.assertEqual(r.status_code, 400)
+
+    def test_sync_waits_for_pending_revisions(self):
+        from core.revisions import REVISION_FIELD, reserve_revision, complete_revision
+        since = json.loads(b''.join(self.client.get('/api/sync/', **self.auth).streaming_content))['since']
+        # A writer has taken its revision but not stored the document yet
+        rev = reserve_revision('epics')
+        self.client.post('/api/epics/', data={'id': 'sp2', 'name': 'After'}, content_type='application/json', **self.auth)
+        r = self.client.get(f'/api/sync/?since={since}', **self.auth)
+        self.assertEqual(r.json()['revisions']['epics'], rev - 1)
+        self.assertEqual([e['id'] for e in r.json()['collections']['epics']['upserts']], ['sp2'])
+        # An ETag must not name a revision its body may not hold
+        self.assertNotIn('ETag', self.client.get('/api/epics/?projectId=spp', **self.auth))
+        get_db()['epics'].insert_one({'id': 'sp1', 'name': 'Slow', 'projectId': 'spp', REVISION_FIELD: rev})
+        complete_revision('epics', rev)
+        r = self.client.get(f"/api/sync/?since={r.json()['since']}", **self.auth)
+        self.assertEqual(sorted(e['id'] for e in r.json()['collections']['epics']['upserts']), ['sp1', 'sp2'])
+        r = self.client.get('/api/epics/?projectId=spp', **self.auth)
+        self.assertEqual(([e['id'] for e in r.json()], r.has_header('ETag')), (['sp1'], True))
+
+    def test_bootstrap_stream(self):
+        self.client.post('/api/teams/', data={'id': 'bt1', 'name': 'Boot'}, content_type='application/json', **self.auth)
+        r = self.client.get('/api/bootstrap/', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        body = json.loads(b''.join(r.streaming_content))
+        self.assertIn('since', body)
+        self.assertEqual(set(body['collections']), {'users', 'teams', 'projects', 'stories', 'epics', 'sprints', 'notifications'})
+        self.assertTrue(any(t['id'] == 'bt1' for t in body['collections']['teams']['upserts']))
+        self.assertNotIn('_id', body['collections']['teams']['upserts'][0])
+        r = self.client.get('/api/bootstrap/?stream=ndjson', **self.auth)
+        self.assertEqual(r['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(r.streaming_content).splitlines()]
+        self.assertIn('since', lines[0])
+        self.assertIn({'collection': 'teams', 'doc': {'id': 'bt1', 'name': 'Boot'}}, lines[1:])
+
+    async def test_notification_push(self):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+        from core.routing import websocket_urlpatterns
+        app = URLRouter(websocket_urlpatterns)
+        rejected = WebsocketCommunicator(app, '/ws/notifications/?token=bogus')
+        connected, _ = await rejected.connect()
+        self.assertFalse(connected)
+        token = self.auth['HTTP_AUTHORIZATION'].split(' ', 1)[1]
+        socket = WebsocketCommunicator(app, f'/ws/notifications/?token={token}')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        note = {'id': 'n-push', 'userId': 'u1', 'message': 'hello', 'isRead': False, 'timestamp': '2024-01-01T00:00:00Z'}
+        r = await self.async_client.post('/api/notifications/', data=note, content_type='application/json',
+                                         headers={'Authorization': self.auth['HTTP_AUTHORIZATION']})
+        self.assertEqual(r.status_code, 201)
+        event = await socket.receive_json_from(timeout=2)
+        self.assertEqual(event, {'type': 'notification', 'notification': note})
+        await socket.disconnect()
+
+    def test_notifications_scoped_to_user(self):
+        get_db()['notifications'].delete_many({})
+        notes = [
+            {'id': 'n1', 'userId': 'u1', 'message': 'a', 'isRead': False, 'timestamp': '2024-01-01T00:00:00Z'},
+            {'id': 'n2', 'userId': 'u1', 'message': 'b', 'isRead': False, 'timestamp': '2024-01-02T00:00:00Z'},
+            {'id': 'n3', 'userId': 'u2', 'message': 'c', 'isRead': False, 'timestamp': '2024-01-03T00:00:00Z'},
+        ]
+        for n in notes:
+            r = self.client.post('/api/notifications/', data=n, content_type='application/json', **self.auth)
+            self.assertEqual(r.status_code, 201)
+        r = self.client.get('/api/notifications/', **self.auth)
+        self.assertEqual(sorted(n['id'] for n in r.json()), ['n1', 'n2'])
+        self.assertEqual(self.client.get('/api/notifications/n3/', **self.auth).status_code, 404)
+        self.assertEqual(self.client.get('/api/notifications/').status_code, 401)
+        r = self.client.get('/api/notifications/unread-count/', **self.auth)
+        self.assertEqual(r.json(), {'count': 2})
+        r = self.client.post('/api/notifications/mark-read/', data={'ids': ['n1', 'n3']}, content_type='application/json', **self.auth)
+        self.assertEqual(r.json(), {'updated': 1})
+        self.assertEqual(self.client.get('/api/notifications/unread-count/', **self.auth).json(), {'count': 1})
+        r = self.client.post('/api/notifications/mark-read/', data={}, content_type='application/json', **self.auth)
+        self.assertEqual(r.json(), {'updated': 1})
+        self.assertEqual(get_db()['notifications'].find_one({'id': 'n3'})['isRead'], False)
+
+    def test_chat_notification_fanout(self):
+        from core.notifications import dispatcher
+        db = get_db()
+        db['users'].insert_one({'id': 'u2', 'email': 'u2@example.com', 'employeeId': 'E-2', 'firstName': 'C', 'lastName': 'D'})
+        db['projects'].insert_one({'id': 'fp1', 'name': 'Fanout', 'memberIds': ['u1', 'u2', 'u3']})
+        db['notifications'].delete_many({'link': '/projects/fp1'})
+        m = {'id': 'fm1', 'authorId': 'u1', 'timestamp': '2024-01-01', 'text': 'ping'}
+        r = self.client.post('/api/project-chats/fp1/', data=m, content_type='application/json', **self.auth)
+        self.assertEqual(r.status_code, 201)
+        self.assertTrue(dispatcher.drain(timeout=5))
+        notes = list(db['notifications'].find({'link': '/projects/fp1'}))
+        self.assertEqual(sorted(n['userId'] for n in notes), ['u2', 'u3'])
+        self.assertTrue(all(n['message'] == 'A B sent a message in Fanout: ping' for n in notes))
+        r = self.client.get('/api/ops/notification-dispatcher/', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['queue_depth'], 0)
+        self.assertGreaterEqual(r.json()['notifications_inserted'], 2)
+        # Jobs for one chat and recipient never collide, even within a millisecond
+        from core.notifications import store_notifications
+        draft = {'userId': 'u2', 'message': 'burst', 'link': '/projects/fp1'}
+        stored = store_notifications('fp1', [draft, dict(draft)]) + store_notifications('fp1', [dict(draft)])
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(db['notifications'].count_documents({'link': '/projects/fp1', 'message': 'burst'}), 2)
+        # With the queue full, async callers run the job off the event loop
+        import asyncio
+        from asgiref.sync import async_to_sync
+        from core.notifications import NotificationDispatcher
+        full = NotificationDispatcher(workers=0, max_queue=1)
+        loops = []
+
+        def build():
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return []
+
+        async def post_twice():
+            await full.asubmit('fp1', build)
+            await full.asubmit('fp1', build)
+        async_to_sync(post_twice)()
+        self.assertEqual((loops, full.stats()['inline'], full.stats()['failed']), ([None], 1, 0))
+
+    def test_chat_history_paging(self):
+        for i in range(5):
+            m = {'id': f'hm{i}', 'authorId': 'u1', 'timestamp': f'2024-01-0{i + 1}T00:00:00Z', 'text': str(i)}
+            r = self.client.post('/api/story-chats/hs1/', data=m, content_type='application/json', **self.auth)
+            self.assertEqual(r.status_code, 201)
+        r = self.client.get('/api/story-chats/hs1/?limit=2', **self.auth)
+        self.assertEqual([m['id'] for m in r.json()['messages']], ['hm3', 'hm4'])
+        self.assertTrue(r.json()['hasMore'])
+        r = self.client.get('/api/story-chats/hs1/?limit=2&before=hm3', **self.auth)
+        self.assertEqual([m['id'] for m in r.json()['messages']], ['hm1', 'hm2'])
+        r = self.client.get('/api/story-chats/hs1/?limit=2&before=hm1', **self.auth)
+        self.assertEqual([m['id'] for m in r.json()['messages']], ['hm0'])
+        self.assertFalse(r.json()['hasMore'])
+        self.assertEqual(self.client.get('/api/story-chats/hs1/?before=nope', **self.auth).status_code, 400)
+
+    def test_migrate_chat_messages(self):
+        from django.core.management import call_command
+        from io import StringIO
+        db = get_db()
+        db['project_chats'].insert_one({'projectId': 'lp1', 'messages': [
+            {'id': 'lm1', 'authorId': 'u1', 'timestamp': '2024-01-01', 'text': 'old'},
+            {'id': 'lm2', 'authorId': 'u1', 'timestamp': '2024-01-02', 'text': 'older'},
+        ]})
+        call_command('migrate_chat_messages', stdout=StringIO())
+        call_command('migrate_chat_messages', '--delete-legacy', stdout=StringIO())  # idempotent
+        r = self.client.get('/api/project-chats/lp1/', **self.auth)
+        self.assertEqual([m['id'] for m in r.json()['messages']], ['lm1', 'lm2'])
+        self.assertIsNone(db['project_chats'].find_one({'projectId': 'lp1'}))
+
+    async def test_websocket_chat_shares_rest_storage(self):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+        from core import metrics
+        from core.routing import websocket_urlpatterns
+        stored = metrics.ws_messages.value(chat_type='story', outcome='stored')
+        app = URLRouter(websocket_urlpatterns)
+        sender = WebsocketCommunicator(app, '/ws/chat/story/wss1/')
+        listener = WebsocketCommunicator(app, '/ws/chat/story/wss1/')
+        self.assertTrue((await sender.connect())[0])
+        self.assertTrue((await listener.connect())[0])
+        for i in range(3):
+            await sender.send_json_to({'type': 'chat_message', 'chat_id': 'wss1', 'chat_type': 'story',
+                                       'message': {'id': f'wm{i}', 'authorId': 'u1', 'timestamp': f'2024-01-0{i + 1}', 'text': 'hi'}})
+        received = [await listener.receive_json_from(timeout=2) for _ in range(3)]
+        self.assertEqual(sorted(e['message']['message']['id'] for e in received), ['wm0', 'wm1', 'wm2'])
+        self.assertNotIn('storedAt', received[0])
+        self.assertEqual(metrics.ws_messages.value(chat_type='story', outcome='stored') - stored, 3)
+        self.assertGreaterEqual(metrics.ws_broadcast_seconds.count(chat_type='story'), 3)
+        # Broadcast happens after the write, so REST readers already see it
+        r = await self.async_client.get('/api/story-chats/wss1/', headers={'Authorization': self.auth['HTTP_AUTHORIZATION']})
+        self.assertEqual([m['id'] for m in r.json()['messages']], ['wm0', 'wm1', 'wm2'])
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_broker_channel_layer_across_processes(self):
+        import asyncio
+        import tempfile
+        import time
+        from channels.exceptions import ChannelFull
+        from core.channel_broker import Broker
+        from core.layers import BrokerChannelLayer
+        url = f'unix://{tempfile.mkdtemp()}/channels.sock'
+        broker = Broker()
+        server = await broker.start(url)
+        # Two layers with separate connections stand in for two worker processes
+        a = BrokerChannelLayer(url, capacity=2)
+        b = BrokerChannelLayer(url, capacity=2)
+        try:
+            channel = await a.new_channel()
+            await a.group_add('room', channel)
+            await asyncio.gather(*(b.group_send('room', {'type': 'chat.message', 'n': n}) for n in range(2)))
+            self.assertEqual(broker.counters['group_send_frames'], 1)
+            received = [await asyncio.wait_for(a.receive(channel), 2) for _ in range(2)]
+            self.assertEqual(sorted(m['n'] for m in received), [0, 1])
+            await b.send(channel, {'type': 'x'})
+            await b.send(channel, {'type': 'x'})
+            with self.assertRaises(ChannelFull):
+                await b.send(channel, {'type': 'x'})
+            # Dropping a worker's connection drops its channels and memberships
+            await a.close()
+            deadline = time.monotonic() + 2
+            while broker.stats()['groups'] and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            self.assertEqual(broker.stats()['groups'], 0)
+            self.assertEqual(broker.stats()['messages_queued'], 0)
+        finally:
+            await b.close()
+            await broker.close()
+            server.close()
+
+    async def test_broker_requires_secret(self):
+        import tempfile
+        from core.channel_broker import Broker
+        from core.layers import BrokerChannelLayer
+        url = f'unix://{tempfile.mkdtemp()}/channels.sock'
+        broker = Broker(secret='s3cret')
+        server = await broker.start(url)
+        try:
+            with self.assertRaises(ConnectionError):
+                await BrokerChannelLayer(url, secret='wrong').new_channel()
+            with self.assertRaises(ConnectionError):
+                await BrokerChannelLayer(url).group_add('room', 'specific.x!y')
+            layer = BrokerChannelLayer(url, secret='s3cret')
+            await layer.group_add('room', await layer.new_channel())
+            self.assertEqual((broker.stats()['groups'], broker.counters['rejected_connections']), (1, 2))
+            # Unknown ops and malformed frames get an error reply; the connection stays up
+            connection = await layer._connection()
+            self.assertIn('unknown op', (await connection.call(None))['error'])
+            self.assertIn('unknown op', (await connection.call('bogus'))['error'])
+            self.assertIn('malformed', (await connection.call('send'))['error'])
+            await layer.group_add('room2', await layer.new_channel())
+            self.assertEqual(broker.stats()['groups'], 2)
+            await layer.close()
+        finally:
+            await broker.close()
+            server.close()
+        # Plain TCP only on loopback unless a secret is set
+        with self.assertRaises(ValueError):
+            await Broker().start('tcp://0.0.0.0:6399')
+
+    def test_story_search_ranks_by_relevance(self):
+        stories = [
+            {'id': 'ss1', 'number': 'STR9001', 'shortDescription': 'Checkout flow', 'description': 'Uses the payment gateway'},
+            {'id': 'ss2', 'number': 'STR9002', 'shortDescription': 'Payment gateway retries', 'description': 'Retry failed payments'},
+            {'id': 'ss3', 'number': 'STR9003', 'shortDescription': 'Profile page', 'description': 'Avatar upload',
+             'acceptanceCriteria': 'Shows gateway status'},
+        ]
+        for story in stories:
+            self.client.post('/api/stories/', data=story, content_type='application/json', **self.auth)
+        r = self.client.get('/api/stories/?q=payment gateway', **self.auth)
+        self.assertEqual([s['id'] for s in r.json()], ['ss2', 'ss1'])
+        r = self.client.get('/api/stories/?q=gatew', **self.auth)  # prefixes match, description ranks low
+        self.assertEqual([s['id'] for s in r.json()], ['ss2', 'ss1', 'ss3'])
+        self.assertEqual([s['id'] for s in self.client.get('/api/stories/?q=str9003', **self.auth).json()], ['ss3'])
+        r = self.client.get('/api/stories/?q=gateway&cursor=&page_size=2', **self.auth).json()
+        r = self.client.get(f"/api/stories/?q=gateway&cursor={r['next_cursor']}&page_size=2", **self.auth).json()
+        self.assertEqual(([s['id'] for s in r['results']], r['next_cursor']), (['ss3'], None))
+        # Story numbers are found by their digits too
+        for q in ('9003', '900', 'str9003'):
+            self.assertEqual([s['id'] for s in self.client.get(f'/api/stories/?q={q}', **self.auth).json()][-1:], ['ss3'], q)
+        # Past SEARCH_MAX_CANDIDATES the best matches still come first, and the response says more matched
+        with self.settings(SEARCH_MAX_CANDIDATES=1):
+            r = self.client.get('/api/stories/?q=gateway&page_size=1', **self.auth)
+            self.assertEqual(([s['id'] for s in r.json()], r.headers.get('X-Search-Truncated')), (['ss2'], 'true'))
+            r = self.client.get('/api/stories/?q=gateway&cursor=&page_size=1', **self.auth).json()
+            self.assertEqual(([s['id'] for s in r['results']], r['truncated']), (['ss2'], True))
+            r = self.client.get('/api/stories/?q=gateway&page=3&page_size=1', **self.auth)
+            self.assertEqual(([s['id'] for s in r.json()], r.has_header('X-Search-Truncated')), (['ss3'], False))
+        # Edits and deletes keep the index current
+        self.client.put('/api/stories/ss3/', data={'acceptanceCriteria': 'Avatar only'}, content_type='application/json', **self.auth)
+        self.client.delete('/api/stories/ss1/', **self.auth)
+        self.assertEqual([s['id'] for s in self.client.get('/api/stories/?q=gateway', **self.auth).json()], ['ss2'])
+
+    def test_list_projections(self):
+        story = {'id': 'sp1', 'number': 'STR9101', 'shortDescription': 'Short', 'description': 'Long text',
+                 'acceptanceCriteria': 'AC', 'attachments': [{'name': 'a.png', 'data': 'xxx'}], 'state': 'Draft'}
+        self.client.post('/api/stories/', data=story, content_type='application/json', **self.auth)
+        listed = {s['id']: s for s in self.client.get('/api/stories/?page_size=100', **self.auth).json()}
+        self.assertNotIn('description', listed['sp1'])
+        self.assertNotIn('attachments', listed['sp1'])
+        self.assertEqual(self.client.get('/api/stories/sp1/', **self.auth).json()['description'], 'Long text')
+        r = self.client.get('/api/stories/?fields=number,state&page_size=100', **self.auth)
+        self.assertIn({'id': 'sp1', 'number': 'STR9101', 'state': 'Draft'}, r.json())
+        r = self.client.get('/api/stories/?exclude=&page_size=100', **self.auth)
+        self.assertIn('attachments', {s['id']: s for s in r.json()}['sp1'])
+        self.assertEqual(self.client.get('/api/stories/?fields=$where', **self.auth).status_code, 400)
+        # id is kept whatever ?exclude= says: lookups and cursors depend on it
+        for url in ['/api/stories/?exclude=id&ids=sp1', '/api/stories/?exclude=id&q=STR9101']:
+            self.assertEqual([s['id'] for s in self.client.get(url, **self.auth).json()], ['sp1'], url)
+        r = self.client.get('/api/stories/?cursor=&exclude=id,number&page_size=1', **self.auth)
+        from core.views import decode_cursor
+        self.assertNotIn(None, decode_cursor(r.json()['next_cursor']).values())
+        for url in ['/api/stories/?fields=state,state.x', '/api/stories/?exclude=description,description.x',
+                    '/api/stories/?fields=assignedToId.x&expand=assignedToId']:
+            self.assertEqual(self.client.get(url, **self.auth).status_code, 400, url)
+        # The password hash never leaves the server
+        get_db()['users'].update_one({'id': 'u1'}, {'$set': {'password': 'pbkdf2_sha256$x'}})
+        for url in ['/api/users/', '/api/users/u1/', '/api/users/?fields=password,email', '/api/users/?exclude=']:
+            body = json.dumps(self.client.get(url, **self.auth).json())
+            self.assertNotIn('pbkdf2', body, url)
+        self.assertNotIn('pbkdf2', json.dumps(json.loads(b''.join(self.client.get('/api/sync/', **self.auth).streaming_content))))
+
+    def test_story_filters(self):
+        stories = [
+            {'id': 'sf1', 'number': 'STR9201', 'projectId': 'fp1', 'sprintId': 'fs1', 'state': 'Draft', 'storyPoints': 3},
+            {'id': 'sf2', 'number': 'STR9202', 'projectId': 'fp1', 'sprintId': 'fs1', 'state': 'Done', 'storyPoints': 8},
+            {'id': 'sf3', 'number': 'STR9203', 'projectId': 'fp1', 'state': 'Ready', 'storyPoints': 5},
+            {'id': 'sf4', 'number': 'STR9204', 'projectId': 'fp2', 'sprintId': 'fs2', 'state': 'Draft', 'storyPoints': 1},
+        ]
+        for story in stories:
+            self.client.post('/api/stories/', data=story, content_type='application/json', **self.auth)
+
+        def ids(query):
+            r = self.client.get(f'/api/stories/?{query}', **self.auth)
+            self.assertEqual(r.status_code, 200, r.content)
+            return sorted(s['id'] for s in r.json())
+        self.assertEqual(ids('projectId=fp1'), ['sf1', 'sf2', 'sf3'])
+        self.assertEqual(ids('projectId=fp1&state__in=Draft,Ready'), ['sf1', 'sf3'])
+        self.assertEqual(ids('projectId=fp1&sprintId='), ['sf3'])  # backlog: no sprint
+        self.assertEqual(ids('projectId=fp1&storyPoints__gte=4&storyPoints__lt=8'), ['sf3'])
+        self.assertEqual(self.client.get('/api/stories/?state__gte=A', **self.auth).status_code, 400)
+        self.assertEqual(self.client.get('/api/stories/?storyPoints=lots', **self.auth).status_code, 400)
+
+    def test_multi_get_and_story_detail(self):
+        for sprint in ({'id': 'mg-s1', 'name': 'S1'}, {'id': 'mg-s2', 'name': 'S2'}, {'id': 'mg-s3', 'name': 'S3'}):
+            self.client.post('/api/sprints/', data=sprint, content_type='application/json', **self.auth)
+        r = self.client.get('/api/sprints/?ids=mg-s3,missing,mg-s1,mg-s3', **self.auth)
+        self.assertEqual([s['id'] for s in r.json()], ['mg-s3', 'mg-s1'])
+        self.client.post('/api/stories/', data={'id': 'mg-r1', 'number': 'STR9301', 'description': 'long'},
+                         content_type='application/json', **self.auth)
+        story = {'id': 'mg-1', 'number': 'STR9300', 'sprintId': 'mg-s2', 'assignedToId': 'u1', 'createdById': 'u1',
+                 'relatedStoryIds': ['mg-r1', 'gone']}
+        self.client.post('/api/stories/', data=story, content_type='application/json', **self.auth)
+        r = self.client.get('/api/stories/mg-1/detail/', **self.auth).json()
+        self.assertEqual(r['story']['id'], 'mg-1')
+        self.assertEqual([u['id'] for u in r['related']['users']], ['u1'])
+        self.assertNotIn('password', r['related']['users'][0])
+        self.assertEqual([s['id'] for s in r['related']['sprints']], ['mg-s2'])
+        self.assertEqual(r['related']['stories'], [{'id': 'mg-r1', 'number': 'STR9301'}])
+
+    def test_expand_references(self):
+        self.client.post('/api/teams/', data={'id': 'ex-t1', 'name': 'Core', 'leadId': 'u1', 'memberIds': ['u1', 'nobody']},
+                         content_type='application/json', **self.auth)
+        for n in range(2):
+            self.client.post('/api/stories/', data={'id': f'ex-{n}', 'number': f'STR940{n}', 'assignedToId': 'u1',
+                                                    'assignedTeamId': 'ex-t1', 'projectId': 'ex-p'},
+                             content_type='application/json', **self.auth)
+        r = self.client.get('/api/stories/?projectId=ex-p&expand=assignedToId,assignedTeamId&fields=number', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        for story in r.json():
+            self.assertEqual(story['expanded']['assignedToId']['firstName'], 'A')
+            self.assertNotIn('password', story['expanded']['assignedToId'])
+            self.assertEqual(story['expanded']['assignedTeamId'], {'id': 'ex-t1', 'name': 'Core'})
+        r = self.client.get('/api/teams/ex-t1/?expand=memberIds', **self.auth)
+        self.assertEqual([m['id'] for m in r.json()['expanded']['memberIds']], ['u1'])
+        self.assertEqual(self.client.get('/api/stories/?expand=password', **self.auth).status_code, 400)
+
+    def test_document_cache(self):
+        from core.cache import DocumentCache
+        from core.revisions import REVISION_FIELD, next_revision
+        cache = DocumentCache(max_entries=2, ttl=60, sync_interval=0.001)
+        db = get_db()
+        db['teams'].delete_many({'id': {'$in': ['dc1', 'dc2', 'dc3']}})
+        for n in (1, 2, 3):
+            db['teams'].insert_one({'id': f'dc{n}', 'name': f'Team {n}'})
+        self.assertEqual(cache.get('teams', 'dc1')['name'], 'Team 1')
+        self.assertEqual(cache.get('teams', 'dc1')['name'], 'Team 1')
+        cache.get('teams', 'dc2')
+        cache.get('teams', 'dc3')  # evicts dc1, the least recently used
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['entries']), (1, 3, 1, 2))
+        # Another worker renames dc2: its revision bump reaches this cache
+        db['teams'].update_one({'id': 'dc2'}, {'$set': {'name': 'Renamed', REVISION_FIELD: next_revision('teams')}})
+        import time
+        time.sleep(0.01)
+        self.assertEqual(cache.get('teams', 'dc2')['name'], 'Renamed')
+        self.assertEqual(cache.stats()['remote_invalidations'], 1)
+        # Local writes through the API invalidate straight away
+        from core.cache import documents
+        documents.get('teams', 'dc3')
+        self.client.put('/api/teams/dc3/', data={'name': 'Local'}, content_type='application/json', **self.auth)
+        self.assertEqual(documents.get('teams', 'dc3')['name'], 'Local')
+        self.assertIn('hit_ratio', self.client.get('/api/ops/document-cache/', **self.auth).json())
+
+    def test_conditional_get(self):
+        from unittest import mock
+        r = self.client.post('/api/epics/', data={'id': 'et1', 'name': 'Etag', 'projectId': 'etp'}, content_type='application/json', **self.auth)
+        self.assertEqual(r.status_code, 201)
+        r = self.client.get('/api/epics/?projectId=etp', **self.auth)
+        etag = r['ETag']
+        # Unchanged: answered from the revision clock without querying epics
+        with mock.patch('core.views.collection', side_effect=AssertionError('queried Mongo')):
+            r = self.client.get('/api/epics/?projectId=etp', HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual((r.status_code, r['ETag']), (304, etag))
+        self.assertNotEqual(self.client.get('/api/epics/?projectId=other', **self.auth)['ETag'], etag)
+        self.client.put('/api/epics/et1/', data={'name': 'Etag 2'}, content_type='application/json', **self.auth)
+        r = self.client.get('/api/epics/?projectId=etp', HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()[0]['name'], 'Etag 2')
+        # Chats are versioned per chat
+        r = self.client.get('/api/story-chats/ets1/', **self.auth)
+        chat_etag = r['ETag']
+        self.client.post('/api/story-chats/ets2/', data={'id': 'etm0', 'text': 'x'}, content_type='application/json', **self.auth)
+        self.assertEqual(self.client.get('/api/story-chats/ets1/', HTTP_IF_NONE_MATCH=chat_etag, **self.auth).status_code, 304)
+        self.client.post('/api/story-chats/ets1/', data={'id': 'etm1', 'text': 'x'}, content_type='application/json', **self.auth)
+        r = self.client.get('/api/story-chats/ets1/', HTTP_IF_NONE_MATCH=chat_etag, **self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([m['id'] for m in r.json()['messages']], ['etm1'])
+
+    @skipUnless(importlib.util.find_spec('orjson'), 'orjson is optional (API_JSON_ENGINE=orjson)')
+    def test_fast_json(self):
+        import io
+        from datetime import datetime
+        from bson import ObjectId
+        from rest_framework.renderers import JSONRenderer
+        from core.renderers import ORJSONParser, ORJSONRenderer
+        data = {'id': 'x', 'when': datetime(2024, 1, 2, 3, 4, 5, 678901), 'text': 'ünïcode \u2028\u2029', 'n': [1, 2.5, None, True]}
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(json.loads(ORJSONRenderer().render({'_id': ObjectId('0' * 24)})), {'_id': '0' * 24})
+        self.assertEqual(ORJSONParser().parse(io.BytesIO(b'{"a": [1]}')), {'a': [1]})
+
+    def test_compression(self):
+        import gzip
+        import zlib
+        from types import SimpleNamespace
+        from unittest import mock
+        for n in range(20):
+            self.client.post('/api/epics/', data={'id': f'gz{n}', 'name': 'Compressible ' * 10, 'projectId': 'gzp'}, content_type='application/json', **self.auth)
+        r = self.client.get('/api/epics/?projectId=gzp', HTTP_ACCEPT_ENCODING='gzip', **self.auth)
+        self.assertEqual(r['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', r['Vary'])
+        self.assertTrue(r['ETag'].startswith('W/'))
+        self.assertEqual(len(json.loads(gzip.decompress(r.content))), 20)
+        # Revalidating with the weakened tag still gets a 304
+        self.assertEqual(self.client.get('/api/epics/?projectId=gzp', HTTP_IF_NONE_MATCH=r['ETag'], **self.auth).status_code, 304)
+        r = self.client.get('/api/epics/gz0/', HTTP_ACCEPT_ENCODING='gzip', **self.auth)
+        self.assertFalse(r.has_header('Content-Encoding'))
+        # Brotli when the client accepts it and the package is there (a stand-in codec here)
+        codec = SimpleNamespace(compress=lambda data, quality: zlib.compress(data))
+        with mock.patch('core.middleware.brotli', codec):
+            r = self.client.get('/api/epics/?projectId=gzp', HTTP_ACCEPT_ENCODING='gzip, br', **self.auth)
+            self.assertEqual((r['Content-Encoding'], r['Content-Length']), ('br', str(len(r.content))))
+            self.assertTrue(r['ETag'].startswith('W/'))
+            self.assertIn('Accept-Encoding', r['Vary'])
+            self.assertEqual(len(json.loads(zlib.decompress(r.content))), 20)
+            r = self.client.get('/api/epics/?projectId=gzp', HTTP_ACCEPT_ENCODING='gzip', **self.auth)
+            self.assertEqual(r['Content-Encoding'], 'gzip')
+        with mock.patch('core.middleware.brotli', None):
+            r = self.client.get('/api/epics/?projectId=gzp', HTTP_ACCEPT_ENCODING='br, gzip', **self.auth)
+            self.assertEqual(r['Content-Encoding'], 'gzip')
+
+    def test_token_cache_and_revocation(self):
+        from core.auth import tokens
+        user = {'id': 'tk1', 'employeeId': 'E-tk1', 'email': 'tk1@example.com', 'role': 'Developer', 'status': 'active', 'firstName': 'T'}
+        get_db()['users'].delete_many({'id': 'tk1'})
+        get_db()['users'].insert_one(dict(user))
+        auth = {'HTTP_AUTHORIZATION': f'Bearer {create_token(user)}'}
+        self.assertEqual(self.client.get('/api/epics/', **auth).status_code, 200)
+        hits = tokens.stats()['hits']
+        self.assertEqual(self.client.get('/api/epics/', **auth).status_code, 200)
+        self.assertEqual(tokens.stats()['hits'], hits + 1)
+        self.assertEqual(self.client.post('/api/auth/refresh/', **auth).status_code, 200)
+        # Deactivating the user revokes the tokens it already holds
+        r = self.client.put('/api/users/tk1/', data={'status': 'inactive'}, content_type='application/json', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        # (rejected tokens get DRF's 403, as JWTAuthentication sends no challenge)
+        self.assertEqual(self.client.get('/api/epics/', **auth).status_code, 403)
+        self.assertEqual(self.client.post('/api/auth/refresh/', **auth).status_code, 403)
+        # Other workers learn about it from Mongo
+        tokens.clear()
+        tokens._not_before = {}
+        self.assertEqual(self.client.get('/api/epics/', **auth).status_code, 403)
+        self.assertEqual(self.client.get('/api/epics/', **self.auth).status_code, 200)
+        # A token issued in the same second, after the revocation, is valid
+        self.assertEqual(self.client.get('/api/epics/', HTTP_AUTHORIZATION=f'Bearer {create_token(user)}').status_code, 200)
+        import jwt
+        from asgiref.sync import async_to_sync
+        tokens.clear()
+        with self.assertRaises(jwt.InvalidTokenError):
+            async_to_sync(tokens.averify)(auth['HTTP_AUTHORIZATION'][7:])
+
+    def test_password_hashing_pool(self):
+        import threading
+        from core.hashing import HashingBusy, HashingPool
+        db = get_db()
+        db['users'].delete_many({'id': 'ph1'})
+        db['users'].insert_one({'id': 'ph1', 'employeeId': 'E-ph1', 'email': 'ph1@example.com', 'role': 'Developer', 'status': 'active', 'password': 'legacy'})
+        r = self.client.post('/api/auth/login/', data={'email': 'ph1@example.com', 'password': 'wrong'}, content_type='application/json')
+        self.assertEqual(r.status_code, 401)
+        r = self.client.post('/api/auth/login/', data={'email': 'ph1@example.com', 'password': 'legacy'}, content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+        # The plaintext password was replaced by a hash that still logs in
+        self.assertTrue(db['users'].find_one({'id': 'ph1'})['password'].startswith('pbkdf2_'))
+        r = self.client.post('/api/auth/login/', data={'email': 'ph1@example.com', 'password': 'legacy'}, content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+        # A full pool rejects at once instead of queueing
+        pool = HashingPool(workers=1, max_queue=1)
+        release = threading.Event()
+        busy = [threading.Thread(target=pool.run, args=(release.wait,)) for _ in range(2)]
+        for thread in busy:
+            thread.start()
+        while pool.stats()['in_flight'] < 2:
+            pass
+        with self.assertRaises(HashingBusy):
+            pool.run(len, 'x')
+        release.set()
+        for thread in busy:
+            thread.join()
+        self.assertEqual(pool.run(len, 'x'), 1)
+        stats = pool.stats()
+        self.assertEqual((stats['rejected'], stats['completed'], stats['peak_queued']), (1, 3, 1))
+
+    def test_mongo_connection_manager(self):
+        import os
+        from unittest import mock
+        from pymongo.monitoring import ConnectionCheckedInEvent, ConnectionCheckedOutEvent, ConnectionCheckOutStartedEvent
+        from core import mongo
+        with mock.patch.dict(os.environ, {'MONGO_MAX_POOL_SIZE': '7', 'MONGO_MAX_IDLE_TIME_MS': '1000'}):
+            options = mongo.client_options()
+        self.assertEqual((options['maxPoolSize'], options['maxIdleTimeMS']), (7, 1000))
+        # Paged lists may go to a secondary, single documents stay on the primary
+        self.assertEqual(mongo.get_collection('stories', route='list').read_preference.mongos_mode, 'secondaryPreferred')
+        self.assertEqual(mongo.get_collection('stories').read_preference.mongos_mode, 'primary')
+        self.assertEqual(mongo.collection_options('chat_messages')['write_concern'].document, {'w': 1})
+        self.assertEqual(mongo.get_collection('users').write_concern.document, {'w': 'majority', 'j': True})
+        self.assertNotIn('write_concern', mongo.collection_options('stories'))
+        with mock.patch.dict(os.environ, {'MONGO_LIST_READ_PREFERENCE': 'primary'}):
+            self.assertIsNone(mongo.stale_read_epoch('list'))
+        self.assertIsNotNone(mongo.stale_read_epoch('list'))
+        metrics = mongo.PoolMetrics()
+        address = ('db', 27017)
+        metrics.connection_check_out_started(ConnectionCheckOutStartedEvent(address))
+        metrics.connection_checked_out(ConnectionCheckedOutEvent(address, 1))
+        stats = metrics.stats()
+        self.assertEqual((stats['checkouts'], stats['in_use']), (1, 1))
+        metrics.connection_checked_in(ConnectionCheckedInEvent(address, 1))
+        self.assertEqual(metrics.stats()['in_use'], 0)
+        r = self.client.get('/api/ops/mongo-pool/', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('avg_wait_ms', r.json())
+        # A forked child opens its own client; the mock's in-memory store survives
+        client = mongo.get_client()
+        mongo._after_fork()
+        self.assertIs(mongo.get_client(), client)
+
+    def test_request_and_command_metrics(self):
+        from datetime import timedelta
+        from django.test import override_settings
+        from pymongo.monitoring import CommandStartedEvent, CommandSucceededEvent
+        from core import metrics
+        with override_settings(DEBUG=True):
+            r = self.client.get('/api/epics/', **self.auth)
+        self.assertIn('X-Mongo-Commands', r.headers)
+        self.assertGreaterEqual(metrics.request_seconds.count(route='api/epics/', method='GET'), 1)
+        # The listener attributes commands to their collection and the current request
+        tally, token = metrics.track_commands()
+        metrics.commands.reply_bytes = True
+        try:
+            address = ('db', 27017)
+            for request_id in (1, 2):
+                metrics.commands.started(CommandStartedEvent({'find': 'stories', 'filter': {}}, 'weintegrity', request_id, address, 1))
+                metrics.commands.succeeded(CommandSucceededEvent(timedelta(milliseconds=2), {'ok': 1}, 'find', request_id, address, 1))
+        finally:
+            metrics.commands.reply_bytes = False
+            metrics.current_request.reset(token)
+        self.assertEqual((tally.count, tally.by_collection), (2, {'stories': 2}))
+        self.assertGreater(tally.reply_bytes, 0)
+        r = self.client.get('/api/ops/metrics/')
+        self.assertEqual(r.status_code, 403)
+        r = self.client.get('/api/ops/metrics/', **self.auth)
+        self.assertEqual(r.status_code, 200)
+        body = r.content.decode()
+        self.assertIn('weintegrity_http_request_duration_seconds_bucket{route="api/epics/",method="GET",le="+Inf"}', body)
+        self.assertIn('weintegrity_mongo_commands_total{collection="stories",command="find",outcome="ok"}', body)
+        self.assertIn('weintegrity_mongo_pool_checkouts', body)
+        with override_settings(METRICS_TOKEN='scrape-me'):
+            r = self.client.get('/api/ops/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(r.status_code, 200)
+        # Scrapes merge the files every worker writes, including exited ones
+        import os
+        import tempfile
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(metrics.flusher, 'directory', directory):
+            gone = {'metrics': {metrics.ws_connects.name: [[['story'], 5]], metrics.ws_open.name: [[['story'], 5]]},
+                    'stats': [['weintegrity_token_cache_hits', 1]]}
+            with open(metrics.flusher.path(2 ** 30), 'w') as f:
+                json.dump(gone, f)
+            body = metrics.exposition()
+            self.assertTrue(os.path.exists(metrics.flusher.path(os.getpid())))
+        connects = metrics.ws_connects.value(chat_type='story')
+        self.assertIn(f'weintegrity_ws_connects_total{{chat_type="story"}} {connects + 5}', body)
+        self.assertNotIn(f'weintegrity_ws_open_connections{{chat_type="story"}} {metrics.ws_open.value(chat_type="story") + 5}', body)
+        self.assertIn(f'weintegrity_token_cache_hits{{pid="{os.getpid()}"}}', body)
+        self.assertNotIn(f'pid="{2 ** 30}"', body)
+
+    async def test_async_views_match_sync(self):
+        from asgiref.sync import sync_to_async
+        from django.test import AsyncRequestFactory
+        from core.async_views import AsyncChatView, AsyncCrudView
+        from core.views import EpicsView, ProjectChatsView, UsersView
+        factory = AsyncRequestFactory()
+        epics = AsyncCrudView.as_view(sync_view=EpicsView)
+        headers = {'headers': {'Authorization': self.auth['HTTP_AUTHORIZATION']}}
+        body = json.dumps({'id': 'ae1', 'name': 'Async', 'projectId': 'aep'})
+        r = await epics(factory.post('/api/epics/', body, content_type='application/json', **headers))
+        self.assertEqual(r.status_code, 201)
+        r = await epics(factory.put('/api/epics/ae1/', json.dumps({'name': 'Async 2'}), content_type='application/json', **headers), id='ae1')
+        self.assertEqual(json.loads(r.content)['name'], 'Async 2')
+        r = await epics(factory.get('/api/epics/?projectId=aep', **headers))
+        sync = await sync_to_async(self.client.get)('/api/epics/?projectId=aep', **self.auth)
+        self.assertEqual((r.content, r['ETag']), (sync.content, sync['ETag']))
+        r = await epics(factory.get('/api/epics/?projectId=aep', headers={**headers['headers'], 'If-None-Match': r['ETag']}))
+        self.assertEqual(r.status_code, 304)
+        r = await epics(factory.get('/api/epics/?projectId=aep&cursor=', **headers))
+        self.assertEqual([e['id'] for e in json.loads(r.content)['results']], ['ae1'])
+        self.assertEqual((await epics(factory.get('/api/epics/', headers={'Authorization': 'Bearer nope'}))).status_code, 403)
+        r = await epics(factory.delete('/api/epics/ae1/', **headers), id='ae1')
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual((await epics(factory.get('/api/epics/ae1/', **headers), id='ae1')).status_code, 404)
+        # Users keep their sync write logic (password hashing)
+        users = AsyncCrudView.as_view(sync_view=UsersView)
+        r = await users(factory.put('/api/users/u1/', json.dumps({'jobTitle': 'Async lead'}), content_type='application/json', **headers), id='u1')
+        self.assertEqual(json.loads(r.content)['jobTitle'], 'Async lead')
+        chat = AsyncChatView.as_view(sync_view=ProjectChatsView)
+        msg = json.dumps({'id': 'am1', 'authorId': 'u1', 'timestamp': '2024-01-01', 'text': 'hi'})
+        r = await chat(factory.post('/api/project-chats/acp/', msg, content_type='application/json'), projectId='acp')
+        self.assertEqual(r.status_code, 201)
+        r = await chat(factory.get('/api/project-chats/acp/'), projectId='acp')
+        self.assertEqual([m['id'] for m in json.loads(r.content)['messages']], ['am1'])
@@ -1,12 +1,27 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import AsyncChatView, AsyncCrudView
 from .views import (
     LoginView, RegisterView, RefreshView,
     ForgotPasswordView, VerifyOtpView, ResetPasswordView,
-    UsersView, TeamsView, ProjectsView, StoriesView,
+    UsersView, TeamsView, ProjectsView, StoriesView, StoryDetailView,
     EpicsView, SprintsView, NotificationsView,
-    StoryChatsView, ProjectChatsView
+    NotificationUnreadCountView, NotificationMarkReadView,
+    ChatView, StoryChatsView, ProjectChatsView, SyncView, BootstrapView,
+    NotificationDispatcherStatsView, DocumentCacheStatsView, TokenCacheStatsView, MongoPoolStatsView, MetricsView,
+    PasswordHashingStatsView,
 )
 
+
+def api_view(view):
+    """``view``, or its async twin (core.async_views) when ASYNC_API is on."""
+    if not settings.ASYNC_API:
+        return view.as_view()
+    if issubclass(view, ChatView):
+        return AsyncChatView.as_view(sync_view=view)
+    return AsyncCrudView.as_view(sync_view=view)
+
+
 urlpatterns = [
     path('auth/login/', LoginView.as_view(), name='login'),
     path('auth/register/', RegisterView.as_view(), name='register'),
@@ -15,29 +30,42 @@ urlpatterns = [
     path('auth/verify-otp/', VerifyOtpView.as_view(), name='verify-otp'),
     path('auth/reset-password/', ResetPasswordView.as_view(), name='reset-password'),
 
-    path('users/', UsersView.as_view(), name='users-list'),
-    path('users/<str:id>/', UsersView.as_view(), name='users-detail'),
+    path('users/', api_view(UsersView), name='users-list'),
+    path('users/<str:id>/', api_view(UsersView), name='users-detail'),
+
+    path('teams/', api_view(TeamsView), name='teams-list'),
+    path('teams/<str:id>/', api_view(TeamsView), name='teams-detail'),
+
+    path('projects/', api_view(ProjectsView), name='projects-list'),
+    path('projects/<str:id>/', api_view(ProjectsView), name='projects-detail'),
 
-    path('teams/', TeamsView.as_view(), name='teams-list'),
-    path('teams/<str:id>/', TeamsView.as_view(), name='teams-detail'),
+    path('stories/', api_view(StoriesView), name='stories-list'),
+    path('stories/<str:id>/', api_view(StoriesView), name='stories-detail'),
+    path('stories/<str:id>/detail/', StoryDetailView.as_view(), name='stories-detail-related'),
 
-    path('projects/', ProjectsView.as_view(), name='projects-list'),
-    path('projects/<str:id>/', ProjectsView.as_view(), name='projects-detail'),
+    path('epics/', api_view(EpicsView), name='epics-list'),
+    path('epics/<str:id>/', api_view(EpicsView), name='epics-detail'),
 
-    path('stories/', StoriesView.as_view(), name='stories-list'),
-    path('stories/<str:id>/', StoriesView.as_view(), name='stories-detail'),
+    path('sprints/', api_view(SprintsView), name='sprints-list'),
+    path('sprints/<str:id>/', api_view(SprintsView), name='sprints-detail'),
 
-    path('epics/', EpicsView.as_view(), name='epics-list'),
-    path('epics/<str:id>/', EpicsView.as_view(), name='epics-detail'),
+    path('notifications/', api_view(NotificationsView), name='notifications-list'),
+    path('notifications/unread-count/', NotificationUnreadCountView.as_view(), name='notifications-unread-count'),
+    path('notifications/mark-read/', NotificationMarkReadView.as_view(), name='notifications-mark-read'),
+    path('notifications/<str:id>/', api_view(NotificationsView), name='notifications-detail'),
 
-    path('sprints/', SprintsView.as_view(), name='sprints-list'),
-    path('sprints/<str:id>/', SprintsView.as_view(), name='sprints-detail'),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('bootstrap/', BootstrapView.as_view(), name='bootstrap'),
 
-    path('notifications/', NotificationsView.as_view(), name='notifications-list'),
-    path('notifications/<str:id>/', NotificationsView.as_view(), name='notifications-detail'),
+    path('story-chats/<str:storyId>/', api_view(StoryChatsView), name='story-chats'),
+    path('project-chats/<str:projectId>/', api_view(ProjectChatsView), name='project-chats'),
 
-    path('story-chats/<str:storyId>/', StoryChatsView.as_view(), name='story-chats'),
-    path('project-chats/<str:projectId>/', ProjectChatsView.as_view(), name='project-chats'),
+    path('ops/notification-dispatcher/', NotificationDispatcherStatsView.as_view(), name='ops-notification-dispatcher'),
+    path('ops/document-cache/', DocumentCacheStatsView.as_view(), name='ops-document-cache'),
+    path('ops/token-cache/', TokenCacheStatsView.as_view(), name='ops-token-cache'),
+    path('ops/password-hashing/', PasswordHashingStatsView.as_view(), name='ops-password-hashing'),
+    path('ops/mongo-pool/', MongoPoolStatsView.as_view(), name='ops-mongo-pool'),
+    path('ops/metrics/', MetricsView.as_view(), name='ops-metrics'),
 ]
 
 
@@ -3,13 +3,25 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from django.conf import settings
-from .mongo import get_db
-from .auth import create_token
+from django.http import HttpResponse
+from .mongo import get_collection, pool_metrics, stale_read_epoch
+from .auth import create_token, revoke_user_tokens, tokens
+from .revisions import REVISION_FIELD, reserved_revision, current_revisions, record_delete, deleted_since, clock
+from .streaming import snapshot_parts, streaming_response
+from .realtime import publish_notifications
+from .notifications import dispatcher
+from .cache import documents
+from .hashing import passwords
+from . import chats, etags, filters, metrics, search
+from .filters import Filter, boolean, number
+from .permissions import IsAdminOrPOForWrites, IsAdminForUserWrites, IsAdmin, IsAdminOrMetricsScraper
 import os
+import json
+import base64
 import random
 from datetime import datetime, timedelta
-from django.contrib.auth.hashers import make_password, check_password
-from .permissions import IsAdminOrPOForWrites, IsAdminForUserWrites
+from pymongo import ASCENDING, DESCENDING
+from django.utils.crypto import constant_time_compare
 
 
 def send_otp_email(to_email, otp):
@@ -53,8 +65,129 @@ def send_otp_email(to_email, otp):
         raise Exception(f'Gmail SMTP error: {e}')
 
 
-def collection(name):
-    return get_db()[name]
+def collection(name, route=None):
+    return get_collection(name, route)
+
+
+# Projection that leaves storage-internal fields in the database
+HIDDEN_FIELDS = {'_id': 0, REVISION_FIELD: 0}
+# Most ids accepted by one ?ids= multi-get
+MAX_IDS = 500
+
+
+def hidden_fields(view):
+    """Projection dropping storage internals and the view's private fields."""
+    return {**HIDDEN_FIELDS, **{field: 0 for field in view.private_fields}}
+
+
+def fetch_by_ids(name, ids, projection, query=None):
+    """``{id: doc}`` for ``ids`` with one ``$in`` on the unique id index."""
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    return {doc['id']: doc for doc in collection(name).find({**(query or {}), 'id': {'$in': ids}}, projection)}
+
+
+def reference_ids(value):
+    """Ids held by a reference field (a single id or a list of them)."""
+    if isinstance(value, list):
+        return [v for v in value if isinstance(v, str) and v]
+    return [value] if isinstance(value, str) and value else []
+
+
+def clean_doc(doc):
+    """Strip storage-internal fields before a document is returned."""
+    doc.pop('_id', None)
+    doc.pop(REVISION_FIELD, None)
+    return doc
+
+
+def encode_cursor(value) -> str:
+    """Encode a JSON-serialisable value as an opaque, URL-safe token."""
+    raw = json.dumps(value, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str):
+    """Inverse of encode_cursor; raises ValueError for malformed tokens."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception as exc:
+        raise ValueError('Invalid cursor') from exc
+
+
+def keyset_filter(field, direction, value, last_id):
+    """Match documents that sort strictly after (value, last_id).
+
+    Mongo orders missing/null values before everything else, so they are
+    handled explicitly to keep pages stable for partially populated fields.
+    """
+    after = '$gt' if direction == ASCENDING else '$lt'
+    if field == 'id':
+        return {'id': {after: last_id}}
+    if value is None:
+        same = {field: None, 'id': {after: last_id}}
+        return {'$or': [same, {field: {'$ne': None}}]} if direction == ASCENDING else same
+    clauses = [{field: {after: value}}, {field: value, 'id': {after: last_id}}]
+    if direction == DESCENDING:
+        clauses.append({field: None})
+    return {'$or': clauses}
+
+
+def page_params(request):
+    """``(page, page_size)`` from the query string, clamped to sane values."""
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except Exception:
+        page = 1
+    try:
+        page_size = min(100, max(1, int(request.GET.get('page_size', 20))))
+    except Exception:
+        page_size = 20
+    return page, page_size
+
+
+def search_offset(request, page, page_size):
+    """Where a search page starts: ``cursor`` ({'o': n}) or ``page``; ValueError if malformed."""
+    if 'cursor' not in request.GET:
+        return (page - 1) * page_size
+    token = request.GET.get('cursor')
+    try:
+        return int(decode_cursor(token)['o']) if token else 0
+    except (KeyError, TypeError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+
+def search_limit(offset, page_size):
+    """How many ranked matches a search page starting at ``offset`` needs."""
+    return max(settings.SEARCH_MAX_CANDIDATES, offset + page_size)
+
+
+def split_update(data):
+    """Fields to ``$set`` and (those sent as null) to ``$unset``."""
+    update_data, unset_data = {}, {}
+    for k, v in data.items():
+        if v is None:
+            # Explicitly unset fields that are None/null
+            unset_data[k] = ""
+        else:
+            update_data[k] = v
+    return update_data, unset_data
+
+
+def owner_scope(view, request):
+    """Filter restricting ``view`` to the caller's own documents.
+
+    Returns {} for shared collections and None when a per-user collection is
+    accessed without a token.
+    """
+    if not view.owner_field:
+        return {}
+    payload = getattr(request, 'jwt_payload', None)
+    if not payload or not payload.get('sub'):
+        return None
+    return {view.owner_field: payload['sub']}
 
 
 class LoginView(APIView):
@@ -65,21 +198,31 @@ class LoginView(APIView):
         password = request.data.get('password')
         if not email or not password:
             return Response({'detail': 'email and password required'}, status=400)
-        user = collection('users').find_one({'email': email})
+        users = collection('users')
+        user = users.find_one({'email': email})
         if not user:
+            # Hash anyway: an unknown email costs as much as a wrong password
+            passwords.make_password(password)
             return Response({'detail': 'Invalid credentials'}, status=401)
         if user.get('status') == 'inactive':
             return Response({'detail': 'Your account has been deactivated. Please contact an administrator.'}, status=403)
-        stored = user.get('password')
-        if stored and stored.startswith('pbkdf2_'):
-            if not check_password(password, stored):
+        stored = user.get('password') or ''
+        if stored.startswith('pbkdf2_'):
+            if not passwords.check_password(password, stored):
                 return Response({'detail': 'Invalid credentials'}, status=401)
         else:
-            if stored != password:
+            # Legacy plaintext password: verify it, then store it hashed
+            hashed = passwords.make_password(password)
+            if not stored or not constant_time_compare(stored, password):
                 return Response({'detail': 'Invalid credentials'}, status=401)
+            with reserved_revision('users') as rev:
+                users.update_one(
+                    {'id': user['id'], 'password': stored},
+                    {'$set': {'password': hashed, REVISION_FIELD: rev}}
+                )
+            documents.invalidate('users', user['id'])
         token = create_token(user)
-        safe_user = {k: user[k] for k in user if k not in ('password',)}
-        safe_user.pop('_id', None)
+        safe_user = clean_doc({k: user[k] for k in user if k not in ('password',)})
         return Response({'access': token, 'user': safe_user})
 
 
@@ -97,12 +240,14 @@ class RegisterView(APIView):
             return Response({'detail': 'Email already registered'}, status=400)
         data = dict(data)
         if data.get('password'):
-            data['password'] = make_password(data['password'])
-        users.insert_one(data)
+            data['password'] = passwords.make_password(data['password'])
+        with reserved_revision('users') as rev:
+            data[REVISION_FIELD] = rev
+            users.insert_one(data)
         user = users.find_one({'email': data['email']})
+        search.index_document('users', user)
         token = create_token(user)
-        safe_user = {k: user[k] for k in user if k not in ('password',)}
-        safe_user.pop('_id', None)
+        safe_user = clean_doc({k: user[k] for k in user if k not in ('password',)})
         return Response({'access': token, 'user': safe_user}, status=201)
 
 
@@ -113,10 +258,12 @@ class RefreshView(APIView):
         payload = getattr(request, 'jwt_payload', None)
         if not payload:
             return Response({'detail': 'No token'}, status=401)
-        # lookup user to ensure still valid
-        user = collection('users').find_one({'id': payload.get('sub')})
+        # Still valid? Usually answered by the user cache without a query
+        user = documents.get('users', payload.get('sub'))
         if not user:
             return Response({'detail': 'User not found'}, status=401)
+        if user.get('status') == 'inactive':
+            return Response({'detail': 'Your account has been deactivated. Please contact an administrator.'}, status=403)
         token = create_token(user)
         return Response({'access': token})
 
@@ -264,11 +411,15 @@ class ResetPasswordView(APIView):
             return Response({'detail': 'User not found'}, status=404)
         
         # Update password
-        hashed_password = make_password(new_password)
-        users_collection.update_one(
-            {'id': user['id']},
-            {'$set': {'password': hashed_password}}
-        )
+        hashed_password = passwords.make_password(new_password)
+        with reserved_revision('users') as rev:
+            users_collection.update_one(
+                {'id': user['id']},
+                {'$set': {'password': hashed_password, REVISION_FIELD: rev}}
+            )
+        documents.invalidate('users', user['id'])
+        # Sessions opened with the old password end here
+        revoke_user_tokens(user['id'])
         
         # Delete used OTP
         otp_collection.delete_one({'_id': reset_record['_id']})
@@ -278,54 +429,246 @@ class ResetPasswordView(APIView):
 
 class BaseCrudView(APIView):
     collection_name = ''
+    # Indexed sort key for cursor pagination ('-' prefix = descending);
+    # 'id' is always used as the tie-breaker so ordering is stable.
+    cursor_field = 'id'
+    # Set on per-user collections: reads, updates and deletes only ever see
+    # documents whose owner_field matches the JWT subject.
+    owner_field = None
+    # Never returned, whatever the request asks for
+    private_fields = ()
+    # Heavy fields left out of list responses unless ?fields=/?exclude= is given
+    summary_exclude = ()
+    # field -> core.filters.Filter: list filters this view accepts
+    filter_fields = {}
+    # Compound indexes backing common filter combinations (created in ready())
+    filter_indexes = ()
+    # Reference field -> collection it points into (id or list of ids)
+    references = {}
+    # References ?expand= may embed
+    expandable = ()
+    # Fields of this collection embedded when another view expands a reference to it
+    expand_summary = ('id', 'name')
+
+    @classmethod
+    def expand_projection(cls):
+        return {'_id': 0, **{field: 1 for field in cls.expand_summary}}
+
+    def expansions(self, request):
+        """Fields named by ``?expand=a,b``; ValueError for any not in ``expandable``."""
+        fields = [f.strip() for f in request.GET.get('expand', '').split(',') if f.strip()]
+        unknown = [f for f in fields if f not in self.expandable]
+        if unknown:
+            raise ValueError(f"Cannot expand: {', '.join(unknown)}")
+        return list(dict.fromkeys(fields))
+
+    def expand(self, docs, fields):
+        """Embed summaries of what ``fields`` reference under each doc's ``expanded``.
+
+        Ids are collected across all ``docs`` first, so each referenced
+        collection costs one ``$in`` and a repeated id is fetched once.
+        """
+        if not fields or not docs:
+            return docs
+        found = {name: fetch_by_ids(name, ids, CRUD_VIEWS[name].expand_projection())
+                 for name, ids in self.referenced_ids(docs, fields).items()}
+        return self.embed(docs, fields, found)
+
+    def referenced_ids(self, docs, fields):
+        """Referenced collection -> ids that ``fields`` of ``docs`` point at."""
+        wanted = {}
+        for doc in docs:
+            for field in fields:
+                wanted.setdefault(self.references[field], []).extend(reference_ids(doc.get(field)))
+        return wanted
+
+    def embed(self, docs, fields, found):
+        """Set each doc's ``expanded`` from ``found`` (collection -> {id: summary})."""
+        for doc in docs:
+            expanded = {}
+            for field in fields:
+                lookup = found[self.references[field]]
+                value = doc.get(field)
+                if isinstance(value, list):
+                    expanded[field] = [lookup[i] for i in reference_ids(value) if i in lookup]
+                else:
+                    expanded[field] = lookup.get(value) if isinstance(value, str) else None
+            doc['expanded'] = expanded
+        return docs
+
+    @classmethod
+    def summary_projection(cls):
+        return {**hidden_fields(cls), **{field: 0 for field in cls.summary_exclude}}
+
+    def projection(self, request, summary=False, expand=()):
+        """Mongo projection for ``?fields=a,b`` (only these, plus id and the
+        ``expand`` references) or ``?exclude=a,b``. Without either, list views
+        drop ``summary_exclude``; ``?exclude=`` with no value returns whole
+        documents. ``id`` is always kept: lookups and cursors are keyed on it.
+
+        Raises ValueError for field names Mongo would treat as operators and
+        for paths that overlap (``a`` and ``a.b``), which Mongo rejects.
+        """
+        def names(param):
+            fields = [f.strip() for f in request.GET.get(param, '').split(',') if f.strip()]
+            if any(f.startswith('$') or '..' in f for f in fields):
+                raise ValueError(f'Invalid field name in {param}')
+            return fields
+
+        def check_overlap(param, paths):
+            paths = sorted(set(paths))
+            if any(b.startswith(a + '.') for a, b in zip(paths, paths[1:])):
+                raise ValueError(f'Overlapping field paths in {param}')
+            return paths
+
+        private = set(self.private_fields)
+        if 'fields' in request.GET:
+            fields = [f for f in names('fields') if not f.startswith('_') and f.split('.')[0] not in private]
+            return {'_id': 0, **{f: 1 for f in check_overlap('fields', ['id', *fields, *expand])}}
+        if 'exclude' not in request.GET:
+            return self.summary_projection() if summary else hidden_fields(self)
+        excluded = [f for f in names('exclude') if f.split('.')[0] not in private and f.split('.')[0] != 'id']
+        return {**hidden_fields(self), **{f: 0 for f in check_overlap('exclude', excluded)}}
 
     def get(self, request, id=None):
-        coll = collection(self.collection_name)
+        """Conditional read: 304 while neither this collection nor (with
+        ``?expand=``) the ones it references changed since the client's ETag."""
+        scope = owner_scope(self, request)
+        if scope is None:
+            return Response({'detail': 'Authentication required'}, status=401)
+        names = [self.collection_name]
+        if request.GET.get('expand'):
+            names += sorted(set(self.references.values()))
+        return etags.conditional(request, clock.get(names), lambda: self.read(request, id, scope), *self.validators(id, scope))
+
+    @staticmethod
+    def validators(id, scope):
+        """What besides the revisions an ETag depends on: the owner scope and,
+        for lists that may be read from a secondary, the staleness epoch."""
+        epoch = None if id else stale_read_epoch('list')
+        return (scope,) if epoch is None else (scope, epoch)
+
+    def read(self, request, id, scope):
+        # Single documents from the primary, list pages per the 'list' route
+        coll = collection(self.collection_name, route=None if id else 'list')
+        try:
+            expand = self.expansions(request)
+            projection = self.projection(request, summary=not id, expand=expand)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
         if id:
-            doc = coll.find_one({'id': id})
+            doc = coll.find_one({'id': id, **scope}, projection)
             if not doc:
                 return Response(status=404)
-            doc.pop('_id', None)
-            return Response(doc)
+            return Response(self.expand([clean_doc(doc)], expand)[0])
         # list
-        query = {}
+        try:
+            query = {**filters.build_query(self.filter_fields, request.GET), **scope}
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
+        page, page_size = page_params(request)
+        if 'ids' in request.GET:
+            ids = [i.strip() for i in request.GET['ids'].split(',') if i.strip()]
+            if len(ids) > MAX_IDS:
+                return Response({'detail': f'At most {MAX_IDS} ids per request'}, status=400)
+            found = fetch_by_ids(self.collection_name, ids, projection, query)
+            return Response(self.expand([clean_doc(found[i]) for i in dict.fromkeys(ids) if i in found], expand))
         q = request.GET.get('q')
         if q:
-            query['$or'] = [
-                {'name': {'$regex': q, '$options': 'i'}},
-                {'shortDescription': {'$regex': q, '$options': 'i'}},
-                {'email': {'$regex': q, '$options': 'i'}},
-                {'number': {'$regex': q, '$options': 'i'}},
-            ]
-        # pagination
+            return self.search_page(coll, query, q, request, page, page_size, projection, expand)
+        if 'cursor' in request.GET:
+            return self.cursor_page(coll, query, request.GET.get('cursor'), page_size, projection, expand)
+        skip = (page - 1) * page_size
+        cursor = coll.find(query, projection).skip(skip).limit(page_size)
+        docs = [clean_doc(d) for d in cursor]
+        return Response(self.expand(docs, expand))
+
+    def cursor_page(self, coll, query, token, page_size, projection, expand=()):
+        """Keyset pagination: each page is an index range scan, however deep.
+
+        An empty ``cursor`` starts from the beginning; the response carries
+        ``next_cursor`` (None on the last page) to pass back verbatim.
+        """
         try:
-            page = max(1, int(request.GET.get('page', 1)))
-        except Exception:
-            page = 1
+            query, sort, projection = self.keyset(query, token, projection)
+        except ValueError:
+            return Response({'detail': 'Invalid cursor'}, status=400)
+        docs, next_cursor = self.cursor_results(list(coll.find(query, projection).sort(sort).limit(page_size + 1)), page_size)
+        return Response({'results': self.expand(docs, expand), 'next_cursor': next_cursor})
+
+    def keyset(self, query, token, projection):
+        """``(query, sort, projection)`` for the page after ``token``; ValueError if it is malformed."""
+        field = self.cursor_field.lstrip('-')
+        direction = DESCENDING if self.cursor_field.startswith('-') else ASCENDING
+        sort = [('id', direction)] if field == 'id' else [(field, direction), ('id', direction)]
+        if token:
+            try:
+                last = decode_cursor(token)
+                after = keyset_filter(field, direction, last['v'], last['id'])
+            except (KeyError, TypeError) as exc:
+                raise ValueError('Invalid cursor') from exc
+            query = {'$and': [query, after]} if query else after
+        # The next cursor is built from the sort key, so fetch it whatever
+        # ?fields= or ?exclude= asked for
+        projection = {k: v for k, v in projection.items() if k != field and not k.startswith(field + '.')}
+        if projection.get('id') == 1:
+            projection[field] = 1
+        return query, sort, projection
+
+    def cursor_results(self, docs, page_size):
+        """Trim the ``page_size + 1`` docs fetched to a page and its ``next_cursor``."""
+        next_cursor = None
+        if len(docs) > page_size:
+            docs = docs[:page_size]
+            last_doc = docs[-1]
+            next_cursor = encode_cursor({'v': last_doc.get(self.cursor_field.lstrip('-')), 'id': last_doc.get('id')})
+        return [clean_doc(d) for d in docs], next_cursor
+
+    def search_page(self, coll, scope, q, request, page, page_size, projection, expand=()):
+        """Documents matching every word of ``q``, most relevant first (see core.search).
+
+        Pages by ``page``/``page_size``, or by ``cursor`` like cursor_page.
+        ``truncated`` (``X-Search-Truncated`` on plain lists) says more
+        documents matched than were ranked for this page; later pages rank
+        further.
+        """
         try:
-            page_size = min(100, max(1, int(request.GET.get('page_size', 20))))
-        except Exception:
-            page_size = 20
-        skip = (page - 1) * page_size
-        cursor = coll.find(query).skip(skip).limit(page_size)
-        docs = list(cursor)
-        for d in docs:
-            d.pop('_id', None)
-        return Response(docs)
+            offset = search_offset(request, page, page_size)
+        except ValueError:
+            return Response({'detail': 'Invalid cursor'}, status=400)
+        ids, truncated = search.search(self.collection_name, q, search_limit(offset, page_size))
+        if scope and ids:
+            allowed = {d['id'] for d in coll.find({'id': {'$in': ids}, **scope}, {'id': 1})}
+            ids = [doc_id for doc_id in ids if doc_id in allowed]
+        page_ids = ids[offset:offset + page_size]
+        found = {d['id']: d for d in coll.find({'id': {'$in': page_ids}, **scope}, projection)} if page_ids else {}
+        docs = self.expand([clean_doc(found[doc_id]) for doc_id in page_ids if doc_id in found], expand)
+        if 'cursor' not in request.GET:
+            return Response(docs, headers={'X-Search-Truncated': 'true'} if truncated else None)
+        more = offset + page_size < len(ids) or truncated
+        return Response({'results': docs, 'next_cursor': encode_cursor({'o': offset + page_size}) if more else None,
+                         'truncated': truncated})
 
     def post(self, request):
         coll = collection(self.collection_name)
-        data = request.data
-        coll.insert_one(dict(data))
+        data = dict(request.data)
+        with reserved_revision(self.collection_name) as rev:
+            data[REVISION_FIELD] = rev
+            coll.insert_one(data)
         # Return the inserted document from database
         inserted = coll.find_one({'id': data.get('id')})
-        if inserted:
-            inserted.pop('_id', None)
-        return Response(inserted or data, status=status.HTTP_201_CREATED)
+        documents.invalidate(self.collection_name, data.get('id'))
+        search.index_document(self.collection_name, inserted)
+        return Response(clean_doc(inserted or data), status=status.HTTP_201_CREATED)
 
     def put(self, request, id):
         coll = collection(self.collection_name)
+        scope = owner_scope(self, request)
+        if scope is None:
+            return Response({'detail': 'Authentication required'}, status=401)
         data = dict(request.data)
+        data.pop('_id', None)
+        data.pop(REVISION_FIELD, None)
         
         # Debug logging for teams
         if self.collection_name == 'teams':
@@ -339,22 +682,14 @@ class BaseCrudView(APIView):
         if self.collection_name == 'users' and 'password' in data and data['password']:
             # Check if password is already hashed
             if not str(data['password']).startswith('pbkdf2_'):
-                data['password'] = make_password(data['password'])
+                data['password'] = passwords.make_password(data['password'])
         
         # Separate fields to set and fields to unset
-        update_data = {}
-        unset_data = {}
-        
-        for k, v in data.items():
-            if v is None:
-                # Explicitly unset fields that are None/null
-                unset_data[k] = ""
-            else:
-                update_data[k] = v
+        update_data, unset_data = split_update(data)
         
         # Build the update operation
         update_op = {}
-        if update_data:
+        if update_data or unset_data:
             update_op['$set'] = update_data
         if unset_data:
             update_op['$unset'] = unset_data
@@ -363,230 +698,410 @@ class BaseCrudView(APIView):
             print(f"Update operation: {update_op}")
         
         if update_op:
-            res = coll.update_one({'id': id}, update_op)
+            with reserved_revision(self.collection_name) as rev:
+                update_data[REVISION_FIELD] = rev
+                res = coll.update_one({'id': id, **scope}, update_op)
             if res.matched_count == 0:
                 return Response(status=404)
+            documents.invalidate(self.collection_name, id)
         
         # Return the updated document from database
-        updated = coll.find_one({'id': id})
+        updated = coll.find_one({'id': id, **scope})
         if updated:
-            updated.pop('_id', None)
+            search.index_document(self.collection_name, updated)
+            clean_doc(updated)
+            for field in self.private_fields:
+                updated.pop(field, None)
         
         if self.collection_name == 'teams':
             print(f"Updated document: {updated}")
             print("=========================")
         
-        return Response(updated or data)
+        return Response(updated or {k: v for k, v in data.items() if k not in self.private_fields})
 
     def delete(self, request, id):
         coll = collection(self.collection_name)
-        res = coll.delete_one({'id': id})
+        scope = owner_scope(self, request)
+        if scope is None:
+            return Response({'detail': 'Authentication required'}, status=401)
+        # The tombstone goes in before the revision is complete
+        with reserved_revision(self.collection_name) as rev:
+            res = coll.delete_one({'id': id, **scope})
+            if res.deleted_count:
+                record_delete(self.collection_name, id, rev)
         if res.deleted_count == 0:
             return Response(status=404)
+        documents.invalidate(self.collection_name, id)
+        search.remove_document(self.collection_name, id)
         return Response(status=204)
 
 
 class UsersView(BaseCrudView):
-    collection_name = 'users'
     permission_classes = [IsAdminForUserWrites]
+    collection_name = 'users'
+    private_fields = ('password',)
+    summary_exclude = ('notes', 'address', 'emergencyContact')
+    expand_summary = ('id', 'firstName', 'lastName', 'email', 'role', 'jobTitle')
+    filter_fields = {
+        'teamId': Filter(),
+        'projectId': Filter(),
+        'role': Filter(),
+        'department': Filter(),
+        'status': Filter(),
+    }
+    filter_indexes = (('teamId', 'status'), ('projectId', 'status'))
+
+    def put(self, request, id):
+        response = super().put(request, id)
+        if response.status_code == 200 and request.data.get('status') == 'inactive':
+            revoke_user_tokens(id)
+        return response
+
+    def delete(self, request, id):
+        response = super().delete(request, id)
+        if response.status_code == 204:
+            revoke_user_tokens(id)
+        return response
 
 
 class TeamsView(BaseCrudView):
     collection_name = 'teams'
+    references = {'leadId': 'users', 'memberIds': 'users', 'projectId': 'projects'}
+    expandable = tuple(references)
+    filter_fields = {'projectId': Filter(), 'leadId': Filter()}
+    filter_indexes = (('projectId',),)
     permission_classes = [AllowAny]
 
 
 class ProjectsView(BaseCrudView):
     collection_name = 'projects'
+    summary_exclude = ('description',)
+    expand_summary = ('id', 'name', 'status')
+    filter_fields = {
+        'status': Filter(),
+        'ownerId': Filter(),
+        'startDate': Filter(('exact', 'range')),
+        'endDate': Filter(('exact', 'range')),
+    }
+    filter_indexes = (('status', 'endDate'),)
     permission_classes = [IsAdminOrPOForWrites]
 
 
 class StoriesView(BaseCrudView):
     collection_name = 'stories'
+    cursor_field = 'number'
+    summary_exclude = ('description', 'workNotes', 'acceptanceCriteria', 'attachments')
+    references = {
+        'assignedToId': 'users',
+        'businessOwnerId': 'users',
+        'testedById': 'users',
+        'createdById': 'users',
+        'updatedById': 'users',
+        'assignedTeamId': 'teams',
+        'projectId': 'projects',
+        'epicId': 'epics',
+        'sprintId': 'sprints',
+        'relatedStoryIds': 'stories',
+    }
+    expandable = tuple(references)
+    expand_summary = ('id', 'number', 'shortDescription', 'state')
+    filter_fields = {
+        'projectId': Filter(),
+        'sprintId': Filter(),
+        'epicId': Filter(),
+        'assignedToId': Filter(),
+        'assignedTeamId': Filter(),
+        'state': Filter(),
+        'priority': Filter(),
+        'type': Filter(),
+        'release': Filter(),
+        'storyPoints': Filter(('exact', 'in', 'range'), cast=number),
+        'plannedStartDate': Filter(('exact', 'range')),
+        'plannedEndDate': Filter(('exact', 'range')),
+    }
+    # Project board, sprint board (per assignee), epic and team views; the
+    # trailing number keeps cursor pages on the same index
+    filter_indexes = (
+        ('projectId', 'state', 'number'),
+        ('projectId', 'number'),
+        ('sprintId', 'assignedToId', 'number'),
+        ('sprintId', 'state'),
+        ('epicId', 'state'),
+        ('assignedTeamId', 'state'),
+        ('assignedToId', 'state'),
+    )
     permission_classes = [AllowAny]
 
 
 class EpicsView(BaseCrudView):
     collection_name = 'epics'
+    filter_fields = {'projectId': Filter()}
+    filter_indexes = (('projectId',),)
     permission_classes = [AllowAny]
 
 
 class SprintsView(BaseCrudView):
     collection_name = 'sprints'
+    expand_summary = ('id', 'name', 'startDate', 'endDate')
+    filter_fields = {
+        'projectId': Filter(),
+        'startDate': Filter(('exact', 'range')),
+        'endDate': Filter(('exact', 'range')),
+    }
+    filter_indexes = (('projectId', 'startDate'),)
     permission_classes = [AllowAny]
 
 
 class NotificationsView(BaseCrudView):
     collection_name = 'notifications'
+    cursor_field = '-timestamp'
+    owner_field = 'userId'
+    filter_fields = {'isRead': Filter(('exact',), cast=boolean)}
     permission_classes = [AllowAny]
 
+    def post(self, request):
+        # Not scoped: users create notifications for each other
+        response = super().post(request)
+        publish_notifications([response.data])
+        return response
+
+
+class StoryDetailView(APIView):
+    """A story plus every document it references, in one round trip.
 
-class StoryChatsView(APIView):
+    ``related`` maps each referenced collection to its documents, fetched
+    with one ``$in`` per collection (summary fields only).
+    """
     permission_classes = [AllowAny]
-    
-    def get(self, request, storyId):
-        doc = collection('story_chats').find_one({'storyId': storyId})
-        if doc:
-            doc.pop('_id', None)
-        return Response(doc or {'storyId': storyId, 'messages': []})
-
-    def post(self, request, storyId):
-        msg = request.data
-        author_id = msg.get('authorId')
-        
-        # Save the message
-        collection('story_chats').update_one(
-            {'storyId': storyId},
-            {'$push': {'messages': msg}},
-            upsert=True
-        )
-        
-        # Create notifications for story team members (excluding the sender)
+
+    def get(self, request, id):
+        story = collection('stories').find_one({'id': id}, hidden_fields(StoriesView))
+        if not story:
+            return Response(status=404)
+        wanted = {}
+        for field, name in StoriesView.references.items():
+            wanted.setdefault(name, []).extend(reference_ids(story.get(field)))
+        related = {}
+        for name, ids in wanted.items():
+            view = CRUD_VIEWS[name]
+            found = fetch_by_ids(name, ids, view.summary_projection())
+            related[name] = [found[i] for i in dict.fromkeys(ids) if i in found]
+        return Response({'story': story, 'related': related})
+
+
+class NotificationUnreadCountView(APIView):
+    """Badge count, answered from the (userId, isRead, timestamp) index."""
+
+    def get(self, request):
+        count = collection('notifications').count_documents({'userId': request.jwt_payload['sub'], 'isRead': False})
+        return Response({'count': count})
+
+
+class NotificationMarkReadView(APIView):
+    """Mark the caller's notifications read in one update_many.
+
+    Body: ``{"ids": [...]}`` to mark specific notifications, or no ids to
+    mark everything unread.
+    """
+
+    def post(self, request):
+        ids = request.data.get('ids')
+        if ids is not None and not isinstance(ids, list):
+            return Response({'detail': 'ids must be a list'}, status=400)
+        query = {'userId': request.jwt_payload['sub'], 'isRead': False}
+        if ids is not None:
+            query['id'] = {'$in': ids}
+        with reserved_revision('notifications') as rev:
+            res = collection('notifications').update_many(
+                query,
+                {'$set': {'isRead': True, REVISION_FIELD: rev}}
+            )
+        return Response({'updated': res.modified_count})
+
+
+# Collections exposed through the delta-sync feed
+SYNC_VIEWS = (UsersView, TeamsView, ProjectsView, StoriesView, EpicsView, SprintsView, NotificationsView)
+CRUD_VIEWS = {view.collection_name: view for view in SYNC_VIEWS}
+
+
+def parse_since(value, names):
+    """Turn a ``since`` parameter into per-collection revisions.
+
+    Accepts nothing/0 (full snapshot), a plain integer applied to every
+    collection, or the opaque token returned by a previous sync.
+    """
+    if not value or value == '0':
+        return {}
+    if value.isdigit():
+        return {name: int(value) for name in names}
+    revisions = decode_cursor(value)
+    if not isinstance(revisions, dict) or not all(isinstance(v, int) for v in revisions.values()):
+        raise ValueError('Invalid since token')
+    return revisions
+
+
+def snapshot_response(request, views, stream='json'):
+    """Stream every document ``views`` expose to the caller, plus a sync token."""
+    names = [view.collection_name for view in views]
+    # Read counters before the documents: a write landing in between is
+    # sent now and again on the next sync, rather than not at all.
+    revisions = current_revisions(names)
+    sources = {}
+    for view in views:
+        scope = owner_scope(view, request)
+        if scope is not None:
+            sources[view.collection_name] = (lambda view=view, scope=scope: collection(view.collection_name).find(scope, hidden_fields(view)))
+    parts = snapshot_parts(sources, {'since': encode_cursor(revisions), 'revisions': revisions}, stream)
+    content_type = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+    return streaming_response(request, parts, content_type)
+
+
+class SyncView(APIView):
+    """Change feed: documents written and ids deleted since a revision.
+
+    Clients should apply ``deletes`` before ``upserts``, since a document can
+    be deleted and re-created between two syncs, then pass the returned
+    ``since`` token on the next call. Without ``since`` this is the same
+    streamed snapshot as BootstrapView.
+    """
+
+    def get(self, request):
+        names = [view.collection_name for view in SYNC_VIEWS]
         try:
-            story = collection('stories').find_one({'id': storyId})
-            if story and author_id:
-                # Get sender info
-                sender = collection('users').find_one({'id': author_id})
-                sender_name = f"{sender.get('firstName', '')} {sender.get('lastName', '')}".strip() if sender else 'Someone'
-                
-                # Get story team members
-                assigned_team_id = story.get('assignedTeamId')
-                assigned_to_id = story.get('assignedToId')
-                project_id = story.get('projectId')
-                
-                notify_user_ids = []
-                
-                # Get team members if team is assigned
-                if assigned_team_id:
-                    team = collection('teams').find_one({'id': assigned_team_id})
-                    if team:
-                        team_members = team.get('memberIds', [])
-                        if team.get('leadId'):
-                            team_members.append(team.get('leadId'))
-                        notify_user_ids.extend(team_members)
-                
-                # Add assigned user if different
-                if assigned_to_id and assigned_to_id not in notify_user_ids:
-                    notify_user_ids.append(assigned_to_id)
-                
-                # Add story creator and updater
-                created_by = story.get('createdById')
-                updated_by = story.get('updatedById')
-                if created_by and created_by not in notify_user_ids:
-                    notify_user_ids.append(created_by)
-                if updated_by and updated_by not in notify_user_ids:
-                    notify_user_ids.append(updated_by)
-                
-                # Exclude the sender
-                notify_user_ids = [uid for uid in notify_user_ids if uid and uid != author_id]
-                
-                # Create notifications
-                notifications_collection = collection('notifications')
-                timestamp = datetime.utcnow().isoformat() + 'Z'
-                message_preview = msg.get('text', '')[:100]  # First 100 chars
-                story_number = story.get('number', storyId)
-                
-                for user_id in notify_user_ids:
-                    notification = {
-                        'id': f'notif-{storyId}-{user_id}-{int(datetime.utcnow().timestamp() * 1000)}',
-                        'userId': user_id,
-                        'message': f'{sender_name} sent a message on story {story_number}: {message_preview}',
-                        'link': f'/stories/{storyId}',
-                        'isRead': False,
-                        'timestamp': timestamp
-                    }
-                    notifications_collection.insert_one(notification)
-        except Exception as e:
-            # Don't fail the message send if notification creation fails
-            import traceback
-            print(f"Error creating notifications: {e}")
-            traceback.print_exc()
-        
-        # Return updated chat document
-        doc = collection('story_chats').find_one({'storyId': storyId})
-        if doc:
-            doc.pop('_id', None)
-        return Response(doc or {'storyId': storyId, 'messages': [msg]}, status=201)
-
-    def delete(self, request, storyId):
-        messageId = request.GET.get('messageId')
-        if not messageId:
-            return Response({'detail': 'messageId required'}, status=400)
-        collection('story_chats').update_one(
-            {'storyId': storyId},
-            {'$pull': {'messages': {'id': messageId}}}
-        )
-        return Response(status=204)
+            since = parse_since(request.GET.get('since'), names)
+        except ValueError:
+            return Response({'detail': 'Invalid since token'}, status=400)
+        if not since:
+            return snapshot_response(request, SYNC_VIEWS)
+        revisions = current_revisions(names)
+        changes = {}
+        for view in SYNC_VIEWS:
+            name = view.collection_name
+            scope = owner_scope(view, request)
+            if scope is None:
+                continue
+            if name not in since:
+                # Collection added after the token was issued
+                changes[name] = {'upserts': list(collection(name).find(scope, hidden_fields(view))), 'deletes': []}
+                continue
+            query = {**scope, REVISION_FIELD: {'$gt': since[name]}}
+            changes[name] = {
+                'upserts': list(collection(name).find(query, hidden_fields(view))),
+                'deletes': deleted_since(name, since[name]),
+            }
+        return Response({'since': encode_cursor(revisions), 'revisions': revisions, 'collections': changes})
+
+
+class BootstrapView(APIView):
+    """Every collection the client loads at start-up, in one streamed body.
+
+    The JSON body matches a full sync snapshot (including the ``since``
+    token); ``?stream=ndjson`` switches to one document per line.
+    """
 
+    def get(self, request):
+        stream = request.GET.get('stream', 'json')
+        if stream not in ('json', 'ndjson'):
+            return Response({'detail': 'stream must be json or ndjson'}, status=400)
+        return snapshot_response(request, SYNC_VIEWS, stream)
 
-class ProjectChatsView(APIView):
+
+class ChatView(APIView):
+    """Story/project chat history, posting and deletion (see core.chats)."""
     permission_classes = [AllowAny]
-    
-    def get(self, request, projectId):
-        doc = collection('project_chats').find_one({'projectId': projectId})
-        if doc:
-            doc.pop('_id', None)
-        return Response(doc or {'projectId': projectId, 'messages': []})
-
-    def post(self, request, projectId):
-        msg = request.data
-        author_id = msg.get('authorId')
-        
-        # Save the message
-        collection('project_chats').update_one(
-            {'projectId': projectId},
-            {'$push': {'messages': msg}},
-            upsert=True
-        )
-        
-        # Create notifications for project members (excluding the sender)
+    chat_type = ''
+    # URL kwarg carrying the chat id, echoed back in responses
+    key_field = ''
+
+    def get(self, request, **kwargs):
+        chat_id = kwargs[self.key_field]
+        revisions = clock.get([chats.chat_revision(self.chat_type, chat_id)])
+        return etags.conditional(request, revisions, lambda: self.history(request, chat_id))
+
+    @staticmethod
+    def history_limit(request):
         try:
-            project = collection('projects').find_one({'id': projectId})
-            if project and author_id:
-                # Get sender info
-                sender = collection('users').find_one({'id': author_id})
-                sender_name = f"{sender.get('firstName', '')} {sender.get('lastName', '')}".strip() if sender else 'Someone'
-                
-                # Get all project members
-                member_ids = project.get('memberIds', [])
-                # Exclude the sender from notifications
-                notify_user_ids = [uid for uid in member_ids if uid != author_id]
-                
-                # Create notifications
-                notifications_collection = collection('notifications')
-                timestamp = datetime.utcnow().isoformat() + 'Z'
-                message_preview = msg.get('text', '')[:100]  # First 100 chars
-                
-                for user_id in notify_user_ids:
-                    notification = {
-                        'id': f'notif-{projectId}-{user_id}-{int(datetime.utcnow().timestamp() * 1000)}',
-                        'userId': user_id,
-                        'message': f'{sender_name} sent a message in {project.get("name", "project")}: {message_preview}',
-                        'link': f'/projects/{projectId}',
-                        'isRead': False,
-                        'timestamp': timestamp
-                    }
-                    notifications_collection.insert_one(notification)
-        except Exception as e:
-            # Don't fail the message send if notification creation fails
-            import traceback
-            print(f"Error creating notifications: {e}")
-            traceback.print_exc()
-        
-        # Return updated chat document
-        doc = collection('project_chats').find_one({'projectId': projectId})
-        if doc:
-            doc.pop('_id', None)
-        return Response(doc or {'projectId': projectId, 'messages': [msg]}, status=201)
-
-    def delete(self, request, projectId):
+            limit = int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE))
+            return min(settings.CHAT_HISTORY_MAX_PAGE_SIZE, max(1, limit))
+        except ValueError:
+            return settings.CHAT_HISTORY_PAGE_SIZE
+
+    def history(self, request, chat_id):
+        limit = self.history_limit(request)
+        try:
+            messages, has_more = chats.history(self.chat_type, chat_id, request.GET.get('before'), limit)
+        except LookupError:
+            return Response({'detail': 'Unknown message in before'}, status=400)
+        return Response({self.key_field: chat_id, 'messages': messages, 'hasMore': has_more})
+
+    def post(self, request, **kwargs):
+        chat_id = kwargs[self.key_field]
+        msg = chats.post_message(self.chat_type, chat_id, request.data)
+        return Response({self.key_field: chat_id, 'messages': [msg]}, status=201)
+
+    def delete(self, request, **kwargs):
         messageId = request.GET.get('messageId')
         if not messageId:
             return Response({'detail': 'messageId required'}, status=400)
-        collection('project_chats').update_one(
-            {'projectId': projectId},
-            {'$pull': {'messages': {'id': messageId}}}
-        )
+        chats.delete_message(self.chat_type, kwargs[self.key_field], messageId)
         return Response(status=204)
 
 
+class StoryChatsView(ChatView):
+    chat_type = 'story'
+    key_field = 'storyId'
+
+
+class ProjectChatsView(ChatView):
+    chat_type = 'project'
+    key_field = 'projectId'
+
+
+class DocumentCacheStatsView(APIView):
+    """Hit/miss/eviction counters of this worker's reference-document cache."""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(documents.stats())
+
+
+class PasswordHashingStatsView(APIView):
+    """Queue depth, waits and rejections of this worker's password-hashing pool."""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(passwords.stats())
+
+
+class TokenCacheStatsView(APIView):
+    """Hit/miss counters of this worker's verified-JWT cache."""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(tokens.stats())
+
+
+class MongoPoolStatsView(APIView):
+    """Connection checkouts and pool wait times of this worker's Mongo clients."""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(pool_metrics.stats())
+
+
+class MetricsView(APIView):
+    """Metrics (see core.metrics) in Prometheus text format: every worker's
+    with METRICS_MULTIPROC_DIR set, otherwise this worker's."""
+    authentication_classes = []
+    permission_classes = [IsAdminOrMetricsScraper]
+
+    def get(self, request):
+        return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class NotificationDispatcherStatsView(APIView):
+    """Queue depth, lag and throughput of the background notification fan-out."""
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(dispatcher.stats())
@@ -1,7 +1,27 @@
+import os
+
 bind = "0.0.0.0:8000"
 workers = 3
+# Threaded workers: a request waiting on the password-hashing pool
+# (core.hashing) no longer blocks its whole process
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
 timeout = 60
 accesslog = "-"
 errorlog = "-"
+# Load the app once in the master; forked workers open their own Mongo
+# clients (core.mongo drops the parent's after fork)
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+
+# Workers share their metrics through files here, so a scrape of the one
+# port reports every worker (core.metrics)
+os.environ.setdefault("METRICS_MULTIPROC_DIR", "/tmp/weintegrity-metrics")
 
 
+def on_starting(server):
+    # Counters restart with the server, not with each worker
+    directory = os.environ["METRICS_MULTIPROC_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    for entry in os.scandir(directory):
+        if entry.name.startswith(("metrics-", ".metrics-")):
+            os.unlink(entry.path)
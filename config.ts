@@ -1 +1,2 @@
 export const API_BASE_URL = import.meta.env.VITE_API_URL || '/api';
+export const WS_BASE_URL = import.meta.env.VITE_WS_URL || 'ws://localhost:8000';
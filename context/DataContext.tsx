@@ -1,6 +1,24 @@
-import React, { createContext, useState, useEffect, ReactNode } from 'react';
+import React, { createContext, useState, useEffect, useRef, useCallback, ReactNode } from 'react';
 import { User, Team, Project, Story, Epic, Sprint, StoryChat, ProjectChat, ChatMessage, Notification } from '../types';
-import { api } from '../utils/api';
+import { api, SyncChanges, SyncResponse } from '../utils/api';
+import { WS_BASE_URL } from '../config';
+import { useWebSocket } from '../hooks/useWebSocket';
+
+// Apply a delta-sync change set: deletes first, then upserts (a document can
+// be deleted and re-created between two syncs).
+const mergeChanges = <T extends { id: string }>(prev: T[], changes?: SyncChanges<T>): T[] => {
+  if (!changes || (changes.upserts.length === 0 && changes.deletes.length === 0)) return prev;
+  const deleted = new Set(changes.deletes);
+  const upserts = new Map(changes.upserts.map(doc => [doc.id, doc]));
+  const merged = prev
+    .filter(doc => !deleted.has(doc.id) || upserts.has(doc.id))
+    .map(doc => {
+      const updated = upserts.get(doc.id);
+      upserts.delete(doc.id);
+      return updated ?? doc;
+    });
+  return [...merged, ...upserts.values()];
+};
 
 export interface DataContextType {
   users: User[];
@@ -50,14 +68,44 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
   const [storyChats, setStoryChats] = useState<StoryChat>({});
   const [projectChats, setProjectChats] = useState<ProjectChat>({});
   const [notifications, setNotifications] = useState<Notification[]>([]);
+  const syncTokenRef = useRef<string | null>(null);
+
+  const applySync = (data: SyncResponse, snapshot: boolean) => {
+    const changes = data.collections;
+    const apply = <T extends { id: string }>(prev: T[], name: string): T[] =>
+      snapshot ? ((changes[name]?.upserts as T[]) || []) : mergeChanges(prev, changes[name] as SyncChanges<T>);
+    setUsers(prev => apply(prev, 'users'));
+    setTeams(prev => apply(prev, 'teams'));
+    setProjects(prev => apply(prev, 'projects'));
+    setStories(prev => apply(prev, 'stories'));
+    setEpics(prev => apply(prev, 'epics'));
+    setSprints(prev => apply(prev, 'sprints'));
+    setNotifications(prev => apply(prev, 'notifications'));
+    syncTokenRef.current = data.since;
+  };
+
+  // Pull only what changed since the last sync (a full snapshot the first time)
+  const syncChanges = async (): Promise<boolean> => {
+    const snapshot = syncTokenRef.current === null;
+    const res = snapshot ? await api.bootstrap() : await api.sync(syncTokenRef.current);
+    if (!res.data) return false;
+    applySync(res.data, snapshot);
+    return true;
+  };
 
   const fetchAllData = async () => {
     try {
+      if (await syncChanges()) {
+        return;
+      }
+
+      // The store keeps whole documents, so opt out of the list summaries
+      const full = { exclude: '' };
       const [usersRes, teamsRes, projectsRes, storiesRes, epicsRes, sprintsRes, notificationsRes] = await Promise.allSettled([
-        api.get<User[]>('users'),
+        api.get<User[]>('users', undefined, full),
         api.get<Team[]>('teams'),
-        api.get<Project[]>('projects'),
-        api.get<Story[]>('stories'),
+        api.get<Project[]>('projects', undefined, full),
+        api.get<Story[]>('stories', undefined, full),
         api.get<Epic[]>('epics'),
         api.get<Sprint[]>('sprints'),
         api.get<Notification[]>('notifications'),
@@ -108,14 +156,33 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     }
   };
 
+  // New notifications are pushed over a per-user socket
+  const handleNotificationMessage = useCallback((data: any) => {
+    if (data.type === 'notification' && data.notification) {
+      const incoming: Notification = data.notification;
+      setNotifications(prev => [incoming, ...prev.filter(n => n.id !== incoming.id)]);
+    }
+  }, []);
+  const authToken = sessionStorage.getItem('authToken');
+  const notificationsSocketUrl = authToken
+    ? `${WS_BASE_URL}/ws/notifications/?token=${encodeURIComponent(authToken)}`
+    : null;
+  const { isConnected: notificationsLive } = useWebSocket(notificationsSocketUrl, {
+    onMessage: handleNotificationMessage,
+  });
+
   useEffect(() => {
     const loadData = async () => {
       await fetchAllData();
       setIsDataReady(true);
     };
     loadData();
-    
-    // Poll for notifications every 10 seconds
+  }, []);
+
+  useEffect(() => {
+    if (notificationsLive) return;
+
+    // Fall back to polling for notifications every 10 seconds while the socket is down
     const notificationInterval = setInterval(async () => {
       try {
         const notificationsRes = await api.get<Notification[]>('notifications');
@@ -131,10 +198,12 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     return () => {
       clearInterval(notificationInterval);
     };
-  }, []);
+  }, [notificationsLive]);
 
   const refreshData = async () => {
-    await fetchAllData();
+    if (syncTokenRef.current === null || !(await syncChanges())) {
+      await fetchAllData();
+    }
   };
 
   const addNotification = async (notificationData: Omit<Notification, 'id' | 'timestamp' | 'isRead'>) => {
@@ -147,23 +216,24 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     
     const result = await api.post<Notification>('notifications', newNotification);
     if (result.data) {
-      setNotifications(prev => [result.data!, ...prev]);
+      // The socket may already have delivered it if we notified ourselves
+      setNotifications(prev => [result.data!, ...prev.filter(n => n.id !== result.data!.id)]);
     }
   };
 
   const markNotificationAsRead = async (notificationId: string) => {
-    const notification = notifications.find(n => n.id === notificationId);
-    if (notification) {
-      const result = await api.put<Notification>('notifications', notificationId, { ...notification, isRead: true });
-      if (result.data) {
-        setNotifications(prev => prev.map(n => n.id === notificationId ? result.data! : n));
-      }
+    const result = await api.markNotificationsRead([notificationId]);
+    if (!result.error) {
+      setNotifications(prev => prev.map(n => n.id === notificationId ? { ...n, isRead: true } : n));
     }
   };
 
   const markAllNotificationsAsRead = async (userId: string) => {
-    const userNotifications = notifications.filter(n => n.userId === userId && !n.isRead);
-    await Promise.all(userNotifications.map(n => markNotificationAsRead(n.id)));
+    // The server only ever marks the signed-in user's notifications
+    const result = await api.markNotificationsRead();
+    if (!result.error) {
+      setNotifications(prev => prev.map(n => n.userId === userId ? { ...n, isRead: true } : n));
+    }
   };
 
   const deleteNotification = async (notificationId: string) => {
@@ -218,16 +288,8 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     // Now delete the user
     const result = await api.delete('users', userId);
     if (!result.error) {
-      // Refresh data from backend
-      const [storiesRes, teamsRes, projectsRes] = await Promise.all([
-        api.get<Story[]>('stories'),
-        api.get<Team[]>('teams'),
-        api.get<Project[]>('projects')
-      ]);
-      
-      if (storiesRes.data) setStories(storiesRes.data);
-      if (teamsRes.data) setTeams(teamsRes.data);
-      if (projectsRes.data) setProjects(projectsRes.data);
+      // Pull the stories, teams and projects changed above
+      await syncChanges();
       
       setNotifications(prev => prev.filter(n => n.userId !== userId));
       setUsers(prev => prev.filter(u => u.id !== userId));
@@ -250,13 +312,10 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
       
       await Promise.all(userUpdatePromises);
       
-      // Refresh users from backend
-      const usersRes = await api.get<User[]>('users');
-      if (usersRes.data) {
-        setUsers(usersRes.data);
-      }
+      // Pull the user updates from backend
+      await syncChanges();
       
-      setTeams(prev => [...prev, result.data!]);
+      setTeams(prev => [...prev.filter(t => t.id !== result.data!.id), result.data!]);
     } else {
       throw new Error(result.error || 'Failed to add team');
     }
@@ -311,15 +370,9 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     if (result.data) {
       setTeams(prev => prev.map(t => t.id === teamId ? result.data! : t));
       
-      // Refresh users and stories from backend
+      // Pull changed users and stories from backend
       if (updatedData.memberIds) {
-        const [usersRes, storiesRes] = await Promise.all([
-          api.get<User[]>('users'),
-          api.get<Story[]>('stories')
-        ]);
-        
-        if (usersRes.data) setUsers(usersRes.data);
-        if (storiesRes.data) setStories(storiesRes.data);
+        await syncChanges();
       }
       
       // If projectId changed, update user projectIds accordingly
@@ -380,17 +433,8 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     // Now delete the team
     const result = await api.delete('teams', teamId);
     if (!result.error) {
-      // Refresh users from backend to get updated teamId values
-      const usersRes = await api.get<User[]>('users');
-      if (usersRes.data) {
-        setUsers(usersRes.data);
-      }
-      
-      // Refresh stories from backend
-      const storiesRes = await api.get<Story[]>('stories');
-      if (storiesRes.data) {
-        setStories(storiesRes.data);
-      }
+      // Pull updated users (teamId) and stories from backend
+      await syncChanges();
       
       // Remove team from local state
       setTeams(prev => prev.filter(t => t.id !== teamId));
@@ -545,14 +589,8 @@ export const DataProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
     // Now delete the project
     const result = await api.delete('projects', projectId);
     if (!result.error) {
-      // Refresh data from backend
-      const [teamsRes, usersRes] = await Promise.all([
-        api.get<Team[]>('teams'),
-        api.get<User[]>('users')
-      ]);
-      
-      if (teamsRes.data) setTeams(teamsRes.data);
-      if (usersRes.data) setUsers(usersRes.data);
+      // Pull updated teams and users from backend
+      await syncChanges();
       
       // Delete project chats
       setProjectChats(prev => {
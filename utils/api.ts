@@ -6,6 +6,17 @@ export interface ApiResponse<T> {
   status?: number;
 }
 
+export interface SyncChanges<T = any> {
+  upserts: T[];
+  deletes: string[];
+}
+
+export interface SyncResponse {
+  since: string;
+  revisions: Record<string, number>;
+  collections: Record<string, SyncChanges>;
+}
+
 class ApiService {
   private getAuthToken(): string | null {
     return sessionStorage.getItem('authToken');
@@ -151,6 +162,16 @@ class ApiService {
     return this.request<T>(endpoint);
   }
 
+  // Several documents by id in one request, returned in the order asked for
+  async getMany<T>(collection: string, ids: string[], params?: Record<string, any>) {
+    return this.get<T[]>(collection, undefined, { ...params, ids: ids.join(',') });
+  }
+
+  // A story plus its referenced users, team, project, epic, sprint and related stories
+  async getStoryDetail(storyId: string) {
+    return this.request<{ story: any; related: Record<string, any[]> }>(`/stories/${storyId}/detail/`);
+  }
+
   async post<T>(collection: string, data: any) {
     return this.request<T>(`/${collection}/`, {
       method: 'POST',
@@ -171,10 +192,35 @@ class ApiService {
     });
   }
 
+  // Every collection in one streamed response, shaped like a full sync snapshot
+  async bootstrap() {
+    return this.request<SyncResponse>('/bootstrap/');
+  }
+
+  // Delta sync: omit `since` for a full snapshot
+  async sync(since?: string | null) {
+    const query = since ? `?since=${encodeURIComponent(since)}` : '';
+    return this.request<SyncResponse>(`/sync/${query}`);
+  }
+
+  // Notification endpoints (always scoped to the signed-in user)
+  async getUnreadNotificationCount() {
+    return this.request<{ count: number }>('/notifications/unread-count/');
+  }
+
+  async markNotificationsRead(ids?: string[]) {
+    return this.request<{ updated: number }>('/notifications/mark-read/', {
+      method: 'POST',
+      body: JSON.stringify(ids ? { ids } : {}),
+    });
+  }
+
   // Chat endpoints
-  async getStoryChats(storyId: string) {
-    return this.request<{ storyId: string; messages: any[] }>(
-      `/story-chats/${storyId}/`
+  // History is paged newest-first: pass the oldest loaded message id as `before`
+  async getStoryChats(storyId: string, page?: { before?: string; limit?: number }) {
+    const query = new URLSearchParams(page as any).toString();
+    return this.request<{ storyId: string; messages: any[]; hasMore: boolean }>(
+      `/story-chats/${storyId}/${query ? `?${query}` : ''}`
     );
   }
 
@@ -191,9 +237,10 @@ class ApiService {
     });
   }
 
-  async getProjectChats(projectId: string) {
-    return this.request<{ projectId: string; messages: any[] }>(
-      `/project-chats/${projectId}/`
+  async getProjectChats(projectId: string, page?: { before?: string; limit?: number }) {
+    const query = new URLSearchParams(page as any).toString();
+    return this.request<{ projectId: string; messages: any[]; hasMore: boolean }>(
+      `/project-chats/${projectId}/${query ? `?${query}` : ''}`
     );
   }
 